@@ -1,3 +1,7 @@
+-- Locks the table for the whole run, so nothing can read it until it is done.
+-- To compress a table while the site is running use
+--   python3 manage.py compress_table <table>
+-- which builds the compressed table on the side and swaps it in.
 CREATE OR REPLACE PROCEDURE compress(target TEXT, version_from_col TEXT, version_to_col TEXT)
 LANGUAGE plpgsql
 AS $$
@@ -0,0 +1,198 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from hashlib import sha256
+import json
+from Mexer.models import PSUT, AggEtaPFU
+from utils.data import _query_sql
+from utils.shadow_table import quote
+from utils.translator import Translator
+
+# The filter columns translate_query() makes, besides the version range and years
+# in the order of the models' fields
+FILTER_COLUMNS = [
+    "Dataset", "Country", "Method", "EnergyType", "LastStage", "IncludesNEU",
+    "ChoppedMat", "ChoppedVar", "ProductAggregation", "IndustryAggregation",
+]
+
+def representative_queries(database: str) -> list[tuple]:
+    '''Make queries shaped exactly like translate_query() makes them, using real values from the tables
+
+    Outputs:
+        a list of (name, database target, translated query, values to get)
+    '''
+
+    translator = Translator(database)
+    queries = []
+
+    # any one row gives a set of filter values that is sure to have data
+    if sample := list(PSUT.objects.using(database).values(*FILTER_COLUMNS, "ValidFromVersion", "Year", "matname")[:1]):
+        sample = sample[0]
+        target = (database, PSUT)
+        common = {column: sample[column] for column in FILTER_COLUMNS}
+        common["ValidFromVersion__gte"] = sample["ValidFromVersion"]
+        common["ValidToVersion__lte"] = sample["ValidFromVersion"]
+
+        ruvy = [translator.matname_translate(matname) for matname in ("R", "U", "V", "Y")]
+        queries += [
+            ("sankey", target, {**common, "Year": sample["Year"], "matname__in": ruvy}, ["matname", "i", "j", "value"]),
+            ("matrix", target, {**common, "Year": sample["Year"], "matname": sample["matname"]}, ["i", "j", "value"]),
+            ("matrix year stack", target,
+             {**common, "Year__gte": sample["Year"] - 10, "Year__lte": sample["Year"], "matname": sample["matname"]},
+             ["Year", "i", "j", "value"]),
+        ]
+
+    if sample := list(AggEtaPFU.objects.using(database).values(*FILTER_COLUMNS, "GrossNet", "ValidFromVersion", "Year")[:1]):
+        sample = sample[0]
+        query = {column: sample[column] for column in FILTER_COLUMNS if column != "Country"}
+        query.update({
+            "Country__in": [sample["Country"]],
+            "GrossNet": sample["GrossNet"],
+            "ValidFromVersion__gte": sample["ValidFromVersion"],
+            "ValidToVersion__lte": sample["ValidFromVersion"],
+            "Year__gte": sample["Year"] - 10,
+            "Year__lte": sample["Year"],
+        })
+        queries.append(("xy plot", (database, AggEtaPFU), query, ["Year", "EXp", "Country", "EnergyType"]))
+
+    return queries
+
+# Class must be named exactly "Command"
+class Command(BaseCommand):
+    help = ("Run EXPLAIN ANALYZE on queries shaped like the ones plots make and "
+            "propose (or create) covering indexes so they can use index only scans")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", action="append", help="Database to check, can be given more than once. Defaults to default and sandbox")
+        parser.add_argument("--create", action="store_true", help="Create the proposed indexes (CONCURRENTLY, so the tables stay usable)")
+        parser.add_argument("--timeout", type=int, default=120, help="Seconds each EXPLAIN ANALYZE is allowed to run")
+
+    def handle(self, *args, **options):
+        for database in options["database"] or ["default", "sandbox"]:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"Database {database}"))
+            try:
+                queries = representative_queries(database)
+            except Exception as e:
+                self.stderr.write(f"Couldn't make queries for {database}: {e}")
+                continue
+
+            for name, target, query, values in queries:
+                self.explain(name, target, query, values, options["timeout"])
+
+            # one covering index per table, made to fit all of its queries
+            for model in (PSUT, AggEtaPFU):
+                model_queries = [(query, values) for _, target, query, values in queries if target[1] is model]
+                if not model_queries:
+                    continue
+
+                index_name, keys, include = self.propose_index(model, model_queries)
+                ddl = (
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{index_name}" ON "{model._meta.db_table}" '
+                    f'({", ".join(map(quote, keys))}) INCLUDE ({", ".join(map(quote, include))})'
+                )
+
+                if (existing := self.covering_index(database, model, keys, include)) is not None:
+                    self.stdout.write(f"{model._meta.db_table} is already covered by {existing}")
+                    continue
+
+                self.stdout.write(f"Proposed for {model._meta.db_table}:\n    {ddl};")
+                if options["create"]:
+                    self.stdout.write("Creating... (can take a while on big tables)")
+                    with connections[database].cursor() as cursor:
+                        cursor.execute(ddl)
+                        cursor.execute(f'ANALYZE "{model._meta.db_table}"')
+                    self.stdout.write(self.style.SUCCESS(f"Created {index_name}, plans now:"))
+                    for name, target, query, values in queries:
+                        if target[1] is model:
+                            self.explain(name, target, query, values, options["timeout"])
+
+    def explain(self, name: str, target, query: dict, values: list[str], timeout: int):
+        '''Run EXPLAIN ANALYZE on a query and print what it did'''
+
+        sql, params = _query_sql(target, query, values)
+        try:
+            with transaction.atomic(using=target[0]), connections[target[0]].cursor() as cursor:
+                cursor.execute(f"SET LOCAL statement_timeout = {int(timeout) * 1000}")
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+                result = cursor.fetchone()[0]
+        except Exception as e:
+            self.stderr.write(f"  {name}: couldn't explain ({e})")
+            return
+
+        # the database driver gives back parsed JSON, but not always
+        if isinstance(result, str):
+            result = json.loads(result)
+        plan = result[0]
+
+        scans = []
+        heap_fetches = 0
+        nodes = [plan["Plan"]]
+        while nodes:
+            node = nodes.pop()
+            if "Relation Name" in node:
+                scans.append(f'{node["Node Type"]} on {node.get("Index Name", node["Relation Name"])}')
+            heap_fetches += node.get("Heap Fetches", 0)
+            nodes += node.get("Plans", [])
+
+        top = plan["Plan"]
+        self.stdout.write(
+            f'  {name}: {plan["Execution Time"]:.1f} ms, {top.get("Actual Rows", 0)} rows, '
+            f'buffers hit {top.get("Shared Hit Blocks", 0)} read {top.get("Shared Read Blocks", 0)}, '
+            f'heap fetches {heap_fetches}\n'
+            f'    {"; ".join(scans)}'
+        )
+
+    def propose_index(self, model, queries: list[tuple[dict, list[str]]]) -> tuple[str, list[str], list[str]]:
+        '''Work out one index that all the queries on a model can use for an index only scan
+
+        Key columns are, in order:
+            columns every query checks for equality
+            columns only some queries check for equality
+            columns only checked by range (years, versions)
+        and every other column the queries get is INCLUDEd
+
+        Outputs:
+            the index name, its key columns, and its included columns
+        '''
+
+        fields = [field.name for field in model._meta.fields]
+        lookups = {} # column -> set of kinds of lookups on it
+        for query, _ in queries:
+            for key in query:
+                column, _, lookup = key.partition("__")
+                lookups.setdefault(column, set()).add("range" if lookup in ("gt", "gte", "lt", "lte") else "equal")
+
+        def is_equal_everywhere(column):
+            return lookups[column] == {"equal"} and all(
+                any(key.partition("__")[0] == column for key in query) for query, _ in queries
+            )
+
+        keys = (
+            [column for column in fields if column in lookups and is_equal_everywhere(column)]
+            + [column for column in fields if column in lookups and not is_equal_everywhere(column) and "equal" in lookups[column]]
+            + [column for column in fields if column in lookups and "equal" not in lookups[column]]
+        )
+        include = [column for column in fields if column not in keys and any(column in values for _, values in queries)]
+
+        digest = sha256(json.dumps([keys, include]).encode()).hexdigest()[:8]
+        return f"{model._meta.db_table}_covering_{digest}", keys, include
+
+    def covering_index(self, database: str, model, keys: list[str], include: list[str]) -> str | None:
+        '''Find an existing index that starts with the keys and has all the included columns, if there is one'''
+
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                "SELECT i.relname, ix.indnkeyatts, ARRAY("
+                "    SELECT a.attname FROM unnest(ix.indkey) WITH ORDINALITY AS k(attnum, ord)"
+                "    JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = k.attnum ORDER BY k.ord"
+                ") "
+                "FROM pg_index ix "
+                "JOIN pg_class i ON i.oid = ix.indexrelid "
+                "JOIN pg_class t ON t.oid = ix.indrelid "
+                "WHERE t.relname = %s AND ix.indisvalid",
+                [model._meta.db_table]
+            )
+            for name, key_count, columns in cursor.fetchall():
+                if columns[:len(keys)] == keys and len(keys) <= key_count and set(include) <= set(columns):
+                    return name
+
+        return None
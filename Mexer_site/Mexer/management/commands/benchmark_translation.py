@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from utils.translator import Translator
+from utils.data import translate_dataframe
+
+# Class must be named exactly "Command"
+class Command(BaseCommand):
+    help = "Compare cell by cell translation of a PSUT-like DataFrame against whole column translation"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000, help="How many rows the test DataFrame has")
+        parser.add_argument("--database", default="default", help="Which database's translations to use")
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        translator = Translator(options["database"])
+
+        # build a frame of real IDs so both ways do actual translations
+        rng = np.random.default_rng(0)
+        columns = {"Country": "country", "matname": "matname", "i": "index", "j": "index"}
+        df = pd.DataFrame({
+            col: rng.choice(np.fromiter(translator.get_id_map(attribute).keys(), dtype=int), size=rows)
+            for col, attribute in columns.items()
+        })
+        df["value"] = rng.random(rows)
+
+        # how get_translated_dataframe used to do it, one call per cell
+        per_cell = {
+            "Country": translator.country_translate,
+            "matname": translator.matname_translate,
+            "i": translator.index_translate,
+            "j": translator.index_translate,
+        }
+        t0 = perf_counter()
+        old = df.copy()
+        for col, translate_func in per_cell.items():
+            old[col] = old[col].apply(translate_func)
+        per_cell_time = perf_counter() - t0
+
+        t0 = perf_counter()
+        new = translate_dataframe(df.copy(), options["database"])
+        per_column_time = perf_counter() - t0
+
+        if not old.equals(new):
+            self.stderr.write("Translations do not match!")
+            return
+
+        self.stdout.write(f"Rows: {rows}")
+        self.stdout.write(f"Cell by cell: {per_cell_time:.3f}s")
+        self.stdout.write(f"Whole column: {per_column_time:.3f}s")
+        self.stdout.write(f"Speedup: {per_cell_time / per_column_time:.1f}x")
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, OperationalError
+from time import perf_counter
+from utils.availability import AVAILABILITY_TABLES, FIRST_YEAR, data_stamp, write_index
+from utils.shadow_table import quote
+from utils.translation_snapshot import get_snapshot
+
+# Class must be named exactly "Command"
+class Command(BaseCommand):
+    help = "Build the index of which years have data for each choice (see utils/availability.py). Run this after loading data into a database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", help="Database to index (default or sandbox)")
+
+    def handle(self, *args, **options):
+        database = options["database"]
+
+        # taken before reading, so anything written while reading makes the index out of date
+        try:
+            stamp = data_stamp(database)
+        except OperationalError as e:
+            raise CommandError(f"Couldn't read the fact tables' statistics: {e}")
+        versions = sorted(get_snapshot(database).tables["Version"].values())
+
+        tables = {}
+        for name, model in AVAILABILITY_TABLES.items():
+            t0 = perf_counter()
+            try:
+                tables[name] = self.index_table(database, model._meta.db_table, versions)
+            except OperationalError as e:
+                raise CommandError(f"Couldn't index {name}: {e}")
+            self.stdout.write(f"Indexed {name}: {len(tables[name])} combinations in {perf_counter() - t0:.1f}s")
+
+        write_index(database, tables, stamp)
+        self.stdout.write(f"Wrote the {database} availability index")
+
+    def index_table(self, database: str, table: str, versions: list[int]) -> list[tuple]:
+        '''Get the year bitmap of every Dataset x Version x Country x EnergyType x LastStage of a fact table
+
+        Outputs:
+            rows of (DatasetID, VersionID, CountryID, EnergyTypeID, LastStageID, year bitmap)
+        '''
+
+        # one row per range of versions, the table doesn't have a row per version
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                'SELECT "Dataset", "ValidFromVersion", "ValidToVersion", "Country", "EnergyType", "LastStage", '
+                'array_agg(DISTINCT "Year") '
+                f'FROM {quote(table)} '
+                'GROUP BY "Dataset", "ValidFromVersion", "ValidToVersion", "Country", "EnergyType", "LastStage"'
+            )
+            ranges = cursor.fetchall()
+
+        bitmaps = {}
+        for dataset, valid_from, valid_to, country, energy_type, last_stage, years in ranges:
+            mask = 0
+            for year in years:
+                if year >= FIRST_YEAR:
+                    mask |= 1 << (year - FIRST_YEAR)
+
+            # a row is in a version when a query for it would find it,
+            # i.e. ValidFromVersion >= version >= ValidToVersion (see translate_query() in utils/data.py)
+            for version in versions:
+                if valid_to <= version <= valid_from:
+                    key = (dataset, version, country, energy_type, last_stage)
+                    bitmaps[key] = bitmaps.get(key, 0) | mask
+
+        return [(*key, mask) for key, mask in bitmaps.items()]
@@ -0,0 +1,112 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, OperationalError
+from time import perf_counter
+from utils.data import _valid_database
+from utils.shadow_table import ShadowTable, quote
+
+# suffixes of the tables made along the way
+SHADOW_SUFFIX = "__compressing"
+OLD_SUFFIX = "__precompress"
+
+# Class must be named exactly "Command"
+class Command(BaseCommand):
+    help = ("Collapse rows that only differ by version into one row covering all the versions, "
+            "like the compress() procedure in Compress-Table.sql, but without making the table unreadable while it runs")
+
+    def add_arguments(self, parser):
+        parser.add_argument("table", help="Table to compress, e.g. PSUTReAllChopAllDsAllGrAll")
+        parser.add_argument("--database", default="default", help="Database the table is in")
+        parser.add_argument("--version-from-column", default="ValidFromVersion")
+        parser.add_argument("--version-to-column", default="ValidToVersion")
+        parser.add_argument("--jobs", type=int, default=4, help="How many parts of the table to compress at once")
+        parser.add_argument("--lock-timeout", type=int, default=5, help="Seconds to wait for the lock to swap tables before trying again")
+        parser.add_argument("--keep-old", action="store_true", help=f"Keep the uncompressed table as <table>{OLD_SUFFIX}")
+        parser.add_argument("--dry-run", action="store_true", help="Only count how many rows there are and how many there would be")
+
+    def handle(self, *args, **options):
+        database = options["database"]
+        if not _valid_database(database):
+            raise CommandError(f"Unknown database {database}")
+
+        table = options["table"]
+        self.shadow = shadow = ShadowTable(database, table, SHADOW_SUFFIX, OLD_SUFFIX, log = self.stdout.write)
+        self.version_cols = (options["version_from_column"], options["version_to_column"])
+        self.cols = shadow.columns(exclude = self.version_cols)
+        if not self.cols:
+            raise CommandError(f"Table {table} doesn't exist or has no columns besides the versions")
+        if not set(self.version_cols) <= set(shadow.columns()):
+            raise CommandError(f"Table {table} doesn't have the columns {self.version_cols}")
+        if shadow.is_partitioned():
+            # the compressed table would be made without the partitions
+            raise CommandError(f"Table {table} is partitioned, compress it before partitioning it (partition_table)")
+
+        # split the table up so the parts can be done at the same time
+        parts = shadow.parts()
+        estimated_rows = shadow.estimated_rows()
+        self.stdout.write(f"{table}: about {estimated_rows} rows in {len(parts)} parts")
+
+        if options["dry_run"]:
+            compressed = shadow.run_parts(parts, self.count_part, options["jobs"], "Counted")
+            self.stdout.write(
+                f"Would compress to {compressed} rows "
+                f"({compressed / estimated_rows:.1%} of the current size)" if estimated_rows > 0 else
+                f"Would compress to {compressed} rows"
+            )
+            return
+
+        self.compress(parts, options)
+
+    def compress(self, parts: list[dict], options: dict):
+        '''Build the compressed table next to the real one, then swap them
+
+        The real table is locked in SHARE mode the whole time, so it can still be read
+        (plots keep working) but not written to, so nothing is missed.
+        Only the swap at the end needs a short exclusive lock.
+        '''
+
+        shadow = self.shadow
+        with connections[shadow.database].cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {quote(shadow.shadow)}")
+            # indexes are made after the rows are in, which is much faster
+            cursor.execute(f"CREATE TABLE {quote(shadow.shadow)} (LIKE {quote(shadow.table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+
+        try:
+            with shadow.building() as cursor:
+                t0 = perf_counter()
+                rows = shadow.run_parts(parts, self.compress_part, options["jobs"], "Compressed")
+                self.stdout.write(f"Compressed to {rows} rows in {perf_counter() - t0:.1f}s")
+
+                shadow.copy_indexes(cursor)
+                shadow.swap(cursor, options["lock_timeout"])
+        except OperationalError as e:
+            raise CommandError(e)
+
+        dropped = shadow.finish(options["keep_old"])
+
+        self.stdout.write(self.style.SUCCESS(f"{shadow.table} compressed"))
+        if not dropped:
+            self.stdout.write(f"The uncompressed table is {shadow.old}")
+        self.stdout.write("Views on the table (e.g. the xy summaries) still show the old rows, refresh them (refresh_xy_summaries)")
+
+    def part_query(self, part: dict) -> tuple[str, list]:
+        # SELECT of a part's compressed rows
+        cols = ", ".join(map(quote, self.cols))
+        where, params = self.shadow.part_where(part)
+        return (
+            f"SELECT MIN({quote(self.version_cols[0])}), MAX({quote(self.version_cols[1])}), {cols} "
+            f"FROM {quote(self.shadow.table)} WHERE {where} GROUP BY {cols}",
+            params,
+        )
+
+    def compress_part(self, part: dict) -> int:
+        select, params = self.part_query(part)
+        cols = ", ".join(map(quote, [*self.version_cols, *self.cols]))
+        with connections[self.shadow.database].cursor() as cursor:
+            cursor.execute(f"INSERT INTO {quote(self.shadow.shadow)} ({cols}) {select}", params)
+            return cursor.rowcount
+
+    def count_part(self, part: dict) -> int:
+        select, params = self.part_query(part)
+        with connections[self.shadow.database].cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM ({select}) AS part", params)
+            return cursor.fetchone()[0]
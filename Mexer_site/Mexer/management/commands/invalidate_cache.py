@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from utils.cache import RESULT_CACHES
+from utils.translator import Translator
+from utils.translation_snapshot import rebuild_snapshot
+
+# Class must be named exactly "Command"
+class Command(BaseCommand):
+    help = "Make cached results (e.g. sankey diagrams) go stale. Run this after loading data into a database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", help="Database that was loaded (default or sandbox)")
+        parser.add_argument("--dataset", help="Only invalidate this dataset, e.g. CL-PFU MW")
+        parser.add_argument("--version", help="Only invalidate this version, e.g. v2.0")
+
+    def handle(self, *args, **options):
+        database = options["database"]
+
+        # new data may have new datasets, versions, countries, ...
+        snapshot = rebuild_snapshot(database)
+        self.stdout.write(f"Rebuilt the translation snapshot (version {snapshot.version})")
+
+        translator = Translator(database)
+
+        # the caches are keyed by IDs, not names
+        dataset = translator.dataset_translate(options["dataset"]) if options["dataset"] else None
+        version = translator.version_translate(options["version"]) if options["version"] else None
+
+        for cache in RESULT_CACHES:
+            cache.invalidate(database, dataset = dataset, version = version)
+            self.stdout.write(f"Invalidated {cache.name} cache")
@@ -0,0 +1,166 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, OperationalError
+from statistics import median
+from time import perf_counter
+import json
+from Mexer.management.commands.advise_indexes import representative_queries
+from utils.data import _valid_database, _query_sql
+from utils.shadow_table import ShadowTable, quote, suffixed
+
+# suffixes of the tables made along the way
+SHADOW_SUFFIX = "__partitioning"
+OLD_SUFFIX = "__unpartitioned"
+
+# every plot query filters on exactly one dataset, and one (or a few) countries
+LIST_COLUMN = "Dataset"
+HASH_COLUMN = "Country"
+
+# Class must be named exactly "Command"
+class Command(BaseCommand):
+    help = (f"Split a table (e.g. PSUTReAllChopAllDsAllGrAll or AggEtaPFU) into a partition per {LIST_COLUMN}, "
+            f"each split into hash partitions by {HASH_COLUMN}, so queries only read the partitions they need. "
+            "The table stays readable while it runs")
+
+    def add_arguments(self, parser):
+        parser.add_argument("table", help="Table to partition, e.g. PSUTReAllChopAllDsAllGrAll")
+        parser.add_argument("--database", default="default", help="Database the table is in")
+        parser.add_argument("--hash-partitions", type=int, default=8, help=f"How many partitions by {HASH_COLUMN} each {LIST_COLUMN} gets")
+        parser.add_argument("--jobs", type=int, default=4, help="How many parts of the table to copy at once")
+        parser.add_argument("--lock-timeout", type=int, default=5, help="Seconds to wait for the lock to swap tables before trying again")
+        parser.add_argument("--keep-old", action="store_true", help=f"Keep the unpartitioned table as <table>{OLD_SUFFIX}")
+        parser.add_argument("--benchmark", type=int, default=0, metavar="RUNS",
+                            help="Before swapping, time plot queries RUNS times on the old and partitioned tables")
+
+    def handle(self, *args, **options):
+        database = options["database"]
+        if not _valid_database(database):
+            raise CommandError(f"Unknown database {database}")
+        if options["hash_partitions"] < 1:
+            raise CommandError("--hash-partitions must be at least 1")
+
+        table = options["table"]
+        self.shadow = shadow = ShadowTable(database, table, SHADOW_SUFFIX, OLD_SUFFIX, log = self.stdout.write)
+        self.cols = shadow.columns()
+        if not {LIST_COLUMN, HASH_COLUMN} <= set(self.cols):
+            raise CommandError(f"Table {table} doesn't exist or doesn't have the columns {LIST_COLUMN} and {HASH_COLUMN}")
+
+        if shadow.is_partitioned():
+            raise CommandError(f"Table {table} is already partitioned")
+
+        with connections[database].cursor() as cursor:
+            cursor.execute(f"SELECT DISTINCT {quote(LIST_COLUMN)} FROM {quote(table)} ORDER BY 1")
+            datasets = [dataset for (dataset,) in cursor.fetchall()]
+
+        parts = shadow.parts()
+        self.stdout.write(
+            f"{table}: about {shadow.estimated_rows()} rows, {len(datasets)} partitions "
+            f"of {options['hash_partitions']} partitions each, copied in {len(parts)} parts"
+        )
+
+        self.make_partitions(datasets, options["hash_partitions"])
+
+        try:
+            with shadow.building() as cursor:
+                t0 = perf_counter()
+                rows = shadow.run_parts(parts, self.copy_part, options["jobs"], "Copied")
+                self.stdout.write(f"Copied {rows} rows in {perf_counter() - t0:.1f}s")
+
+                # unique indexes on a partitioned table have to include the partition columns
+                shadow.copy_indexes(cursor, skip = lambda name, definition: (
+                    definition.startswith("CREATE UNIQUE") and not
+                    (quote(LIST_COLUMN) in definition and quote(HASH_COLUMN) in definition)
+                ))
+
+                if options["benchmark"] > 0:
+                    self.benchmark(cursor, options["benchmark"])
+
+                shadow.swap(cursor, options["lock_timeout"])
+        except OperationalError as e:
+            raise CommandError(e)
+
+        dropped = shadow.finish(options["keep_old"])
+
+        self.stdout.write(self.style.SUCCESS(f"{table} partitioned"))
+        if not dropped:
+            self.stdout.write(f"The unpartitioned table is {shadow.old}")
+        self.stdout.write("Views on the table (e.g. the xy summaries) still use the old table, refresh them (refresh_xy_summaries)")
+
+    def make_partitions(self, datasets: list[int], hash_partitions: int):
+        '''Make the empty partitioned shadow table
+
+        <table>_ds<dataset> for each dataset, split into <table>_ds<dataset>_h<remainder>,
+        and <table>_ds_default for datasets added later
+        '''
+        shadow, table = self.shadow, self.shadow.table
+        with connections[shadow.database].cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {quote(shadow.shadow)}")
+            # indexes are made after the rows are in, which is much faster
+            cursor.execute(
+                f"CREATE TABLE {quote(shadow.shadow)} (LIKE {quote(table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+                f"PARTITION BY LIST ({quote(LIST_COLUMN)})"
+            )
+
+            for dataset in datasets:
+                partition = suffixed(table, f"_ds{int(dataset)}")
+                cursor.execute(
+                    f"CREATE TABLE {quote(partition)} PARTITION OF {quote(shadow.shadow)} "
+                    f"FOR VALUES IN (%s) PARTITION BY HASH ({quote(HASH_COLUMN)})",
+                    [dataset]
+                )
+                for remainder in range(hash_partitions):
+                    cursor.execute(
+                        f"CREATE TABLE {quote(suffixed(partition, f'_h{remainder}'))} PARTITION OF {quote(partition)} "
+                        f"FOR VALUES WITH (MODULUS {hash_partitions}, REMAINDER {remainder})"
+                    )
+
+            cursor.execute(f"CREATE TABLE {quote(suffixed(table, '_ds_default'))} PARTITION OF {quote(shadow.shadow)} DEFAULT")
+
+    def copy_part(self, part: dict) -> int:
+        where, params = self.shadow.part_where(part)
+        cols = ", ".join(map(quote, self.cols))
+        with connections[self.shadow.database].cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {quote(self.shadow.shadow)} ({cols}) SELECT {cols} FROM {quote(self.shadow.table)} WHERE {where}",
+                params
+            )
+            return cursor.rowcount
+
+    def benchmark(self, cursor, runs: int):
+        '''Time the plot queries on this table (see advise_indexes) against the old and partitioned tables
+
+        Reports the median time of runs runs (after one to warm the cache)
+        and how many tables (partitions) the query plan reads
+        '''
+        shadow = self.shadow
+        queries = [
+            (name, target, query, values) for name, target, query, values in representative_queries(shadow.database)
+            if target[1]._meta.db_table == shadow.table
+        ]
+        if not queries:
+            self.stdout.write(f"No plot queries use {shadow.table}, nothing to benchmark")
+            return
+
+        for name, target, query, values in queries:
+            sql, params = _query_sql(target, query, values)
+            for label, run_sql in (("unpartitioned", sql), ("partitioned", sql.replace(quote(shadow.table), quote(shadow.shadow)))):
+                cursor.execute("EXPLAIN (FORMAT JSON) " + run_sql, params)
+                plan = cursor.fetchone()[0]
+                # the database driver gives back parsed JSON, but not always
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+
+                scanned = 0
+                nodes = [plan[0]["Plan"]]
+                while nodes:
+                    node = nodes.pop()
+                    scanned += "Relation Name" in node
+                    nodes += node.get("Plans", [])
+
+                times = []
+                for _ in range(runs + 1):
+                    t0 = perf_counter()
+                    cursor.execute(run_sql, params)
+                    cursor.fetchall()
+                    times.append(perf_counter() - t0)
+
+                self.stdout.write(f"  {name} ({label}): {median(times[1:]) * 1000:.1f} ms median, reads {scanned} table(s)")
@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from time import perf_counter
+from Mexer.models import AggEtaPFU
+from utils.translator import Translator
+from utils.xy_summaries import summary_table_name, forget_available_summaries, XY_SUMMARY_ORDER
+
+# Class must be named exactly "Command"
+class Command(BaseCommand):
+    help = "Make or refresh the per dataset summaries of AggEtaPFU that xy plots use (see utils/xy_summaries.py). Run this after loading data into a database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", help="Database to make summaries in (default or sandbox)")
+        parser.add_argument("--dataset", action="append", help="Only this dataset, e.g. CL-PFU MW. Can be given more than once. Defaults to every dataset in AggEtaPFU")
+        parser.add_argument("--drop", action="store_true", help="Drop the summaries instead, so xy plots go back to AggEtaPFU")
+
+    def handle(self, *args, **options):
+        database = options["database"]
+        translator = Translator(database)
+
+        if options["dataset"]:
+            try:
+                datasets = [translator.dataset_translate(dataset) for dataset in options["dataset"]]
+            except KeyError as e:
+                raise CommandError(e)
+        else:
+            datasets = sorted(AggEtaPFU.objects.using(database).values_list("Dataset", flat=True).distinct())
+
+        for dataset in datasets:
+            name = summary_table_name(dataset)
+            if options["drop"]:
+                with connections[database].cursor() as cursor:
+                    cursor.execute(f'DROP MATERIALIZED VIEW IF EXISTS "{name}"')
+                self.stdout.write(f"Dropped {name} ({translator.dataset_translate(dataset)})")
+            else:
+                t0 = perf_counter()
+                rows = self.build_summary(database, dataset)
+                self.stdout.write(f"Built {name} ({translator.dataset_translate(dataset)}): {rows} rows in {perf_counter() - t0:.1f}s")
+
+        # this process sees the change right away, servers within SUMMARY_CHECK_TTL
+        forget_available_summaries(database)
+
+    def build_summary(self, database: str, dataset: int) -> int:
+        '''Build a dataset's summary next to the old one then swap it in
+
+        Queries keep using the old summary (or AggEtaPFU) while the new one is built,
+        and only have to wait for the quick swap at the end
+
+        Outputs:
+            how many rows the summary has
+        '''
+
+        name = summary_table_name(dataset)
+        new_name = name + "_new"
+        columns = ", ".join(f'"{column}"' for column in XY_SUMMARY_ORDER)
+
+        with connections[database].cursor() as cursor:
+            cursor.execute(f'DROP MATERIALIZED VIEW IF EXISTS "{new_name}"')
+
+            # rows sorted the way xy queries look them up, so each query
+            # reads a few neighboring pages instead of rows from all over the table
+            cursor.execute(
+                f'CREATE MATERIALIZED VIEW "{new_name}" AS '
+                f'SELECT * FROM "{AggEtaPFU._meta.db_table}" WHERE "Dataset" = %s '
+                f'ORDER BY {columns}',
+                [int(dataset)]
+            )
+            cursor.execute(f'CREATE INDEX "{new_name}_xy" ON "{new_name}" ({columns})')
+            cursor.execute(f'ANALYZE "{new_name}"')
+            cursor.execute(f'SELECT COUNT(*) FROM "{new_name}"')
+            rows = cursor.fetchone()[0]
+
+        with transaction.atomic(using=database), connections[database].cursor() as cursor:
+            cursor.execute(f'DROP MATERIALIZED VIEW IF EXISTS "{name}"')
+            cursor.execute(f'ALTER MATERIALIZED VIEW "{new_name}" RENAME TO "{name}"')
+            cursor.execute(f'ALTER INDEX "{new_name}_xy" RENAME TO "{name}_xy"')
+
+        return rows
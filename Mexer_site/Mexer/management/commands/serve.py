@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+import os
+import sys
+
+# Class must be named exactly "Command"
+class Command(BaseCommand):
+    help = "Run the production server, gunicorn with multiple workers (see Mexer_meta/gunicorn_conf.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bind", help="Address to listen on, e.g. 0.0.0.0:8000")
+        parser.add_argument("--workers", type=int, help="Number of worker processes, defaults to (2 x cores) + 1")
+        parser.add_argument("--asgi", action="store_true", help="Serve the ASGI app with uvicorn workers so async views run concurrently")
+
+    def handle(self, *args, **options):
+        command = [sys.executable, "-m", "gunicorn", "--config", "python:Mexer_meta.gunicorn_conf"]
+        if options["bind"]:
+            command += ["--bind", options["bind"]]
+        if options["workers"]:
+            # through the environment, so the database pools are sized for it too (see settings.py)
+            os.environ["MEXER_WORKERS"] = str(options["workers"])
+
+        if options["asgi"]:
+            os.environ["MEXER_ASGI"] = "1"
+
+        # replace this process with gunicorn so signals go straight to it:
+        # HUP to gracefully reload workers, TERM to gracefully shut down
+        os.execv(sys.executable, command)
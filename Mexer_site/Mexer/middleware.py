@@ -0,0 +1,78 @@
+####################################################################
+# middleware.py includes the site's own middleware
+#
+# MetricsMiddleware times every request, records it in the
+# request histograms (see utils/metrics.py) and writes one JSON line
+# per request to the metrics log with the stages it went through, e.g.
+#   {"view": "Mexer.views.visualizer.get_plot", "method": "POST", "status": 200,
+#    "seconds": 0.41, "bytes": 52311, "stages": [{"stage": "fetch", "seconds": 0.12, "rows": 18204, ...}, ...]}
+#
+# For streamed responses (e.g. CSV downloads) the time is until the
+# response starts, and the size isn't known
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import json
+from time import perf_counter
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from utils.logging import METRICS_LOGGER
+from utils.metrics import REQUEST_SECONDS, RESPONSE_BYTES, start_request, finish_request, save_metrics
+
+class MetricsMiddleware:
+    '''Measure every request, see the top of this file
+
+    Works in both sync (WSGI) and async (ASGI) servers
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        token, t0 = start_request(), perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            stages = finish_request(token)
+        self.record(request, response, perf_counter() - t0, stages)
+        return response
+
+    async def __acall__(self, request):
+        token, t0 = start_request(), perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            stages = finish_request(token)
+        self.record(request, response, perf_counter() - t0, stages)
+        return response
+
+    def record(self, request, response, seconds: float, stages: list[dict]):
+        # the view's name rather than the path, so there is a set number of label values
+        match = request.resolver_match
+        view = match.view_name if match is not None else "unmatched"
+        nbytes = None if response.streaming else len(response.content)
+
+        REQUEST_SECONDS.observe(seconds, view = view, method = request.method, status = response.status_code)
+        if nbytes is not None:
+            RESPONSE_BYTES.observe(nbytes, view = view)
+
+        METRICS_LOGGER.info(json.dumps(dict(
+            view = view,
+            method = request.method,
+            status = response.status_code,
+            seconds = round(seconds, 6),
+            bytes = nbytes,
+            stages = stages,
+        )))
+
+        # for /metrics to add up with the other workers' (see utils/metrics.py)
+        save_metrics()
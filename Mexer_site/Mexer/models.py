@@ -158,11 +158,10 @@ class IEAData(models.Model):
         managed = False
 
 
-class AggEtaPFU(models.Model):
-    """ Model representing a database table named 'AggEtaPFU'."""
+class AggEtaPFUBase(models.Model):
+    """ The columns of the 'AggEtaPFU' table, shared with its per dataset summaries (see utils/xy_summaries.py)."""
     class Meta:
-        db_table = "AggEtaPFU"
-        managed = False
+        abstract = True
 
     Dataset = models.PositiveSmallIntegerField()
     ValidFromVersion = models.PositiveSmallIntegerField()
@@ -184,6 +183,12 @@ class AggEtaPFU(models.Model):
     etapf = models.FloatField()
     etafu = models.FloatField()
     etapu = models.FloatField()
+
+class AggEtaPFU(AggEtaPFUBase):
+    """ Model representing a database table named 'AggEtaPFU'."""
+    class Meta:
+        db_table = "AggEtaPFU"
+        managed = False
     
 class EvizUser(DjangoUser):
     """ Model representing a database table named 'EvizUser'."""
@@ -206,3 +211,10 @@ class PassResetCode(models.Model):
     """ Model for storing password reset codes and the associated user."""
     code = models.TextField(max_length=255)
     user = models.ForeignKey(EvizUser, on_delete=models.CASCADE)
+
+class PlotHistory(models.Model):
+    """ Model for storing a user's plot history, found by the ID in their history cookie (see utils/history.py)."""
+    history_id = models.CharField(max_length=32, primary_key=True)
+    history = models.JSONField(default=list)
+    # histories not changed in HISTORY_TTL are expired
+    updated = models.DateTimeField(auto_now=True, db_index=True)
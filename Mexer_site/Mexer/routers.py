@@ -9,7 +9,7 @@ class DatabaseRouter:
     AUTH_APPS = ["auth", "sessions", "contenttypes", "admin"]
 
     # Models to go to the Users DB
-    USERS_DB_MODEL_NAMES = ["EvizUser", "EmailAuthCode", "PassResetCode"]
+    USERS_DB_MODEL_NAMES = ["EvizUser", "EmailAuthCode", "PassResetCode", "PlotHistory"]
 
     # Contains every app name that should be routed to the Users db 
     ALL_USERS_APPS = AUTH_APPS + ["captcha"]
@@ -1,4 +1,18 @@
-from django.test import TestCase
+import io
+import zipfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock, skipIf
+from django.test import SimpleTestCase
+from Mexer.models import PSUT, AggEtaPFU, IEAData
+from utils import availability, data
+from utils.availability import AvailabilityIndex, FIRST_YEAR, mask_years, query_has_data, year_mask
+from utils.copy_reader import BINARY_SIGNATURE, copy_arrays, parse_binary
+from utils.data import _columnar_schema, _columnar_table, _xlsx_sheet_name, write_xlsx_from_query
+from utils.sankey import OTHER_LABEL, _prune_sankey
+from utils.shared_files import write_json
 
 def test_matrix_sum(m):
 
@@ -30,4 +44,306 @@ def test_matrix_sum(m):
     assert(round(m.get("Primary solid biofuels [from Resources]", "Manufacture [of Primary solid biofuels]")) == 175218)
     assert(round(m.get("Refinery gas", "Oil refineries")) == 1732)
 
-    return "Passed all tests"
\ No newline at end of file
+    return "Passed all tests"
+
+
+def binary_copy(rows: list[tuple], dtype: np.dtype) -> bytes:
+    '''Make the stream a binary COPY sends for some rows, None values are NULL'''
+    stream = BINARY_SIGNATURE + (0).to_bytes(4, "big") + (0).to_bytes(4, "big")
+    for row in rows:
+        stream += len(row).to_bytes(2, "big", signed = True)
+        for name, value in zip(dtype.names, row):
+            if value is None:
+                stream += (-1).to_bytes(4, "big", signed = True)
+            else:
+                stream += dtype[name].itemsize.to_bytes(4, "big") + np.array(value, dtype = dtype[name].newbyteorder(">")).tobytes()
+    return stream + (-1).to_bytes(2, "big", signed = True)
+
+class FakeCopyConnection:
+    '''Just enough of a psycopg2 connection for copy_out() to COPY out of, answering with canned streams'''
+
+    def __init__(self, binary: bytes, csv: bytes):
+        self.streams = {"binary": binary, "csv": csv}
+        self.formats = [] # which COPYs were run
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mogrify(self, sql, params):
+        return sql.encode()
+
+    def copy_expert(self, sql, out):
+        copy_format = "binary" if "FORMAT binary" in sql else "csv"
+        self.formats.append(copy_format)
+        out.write(self.streams[copy_format])
+
+class CopyReaderTests(SimpleTestCase):
+    dtype = np.dtype([("i", np.int32), ("value", np.float64), ("flag", np.bool_)])
+
+    def test_parse_binary(self):
+        rows = [(1, 2.5, True), (2, -1.0, False)]
+        data = parse_binary(binary_copy(rows, self.dtype), self.dtype)
+        self.assertEqual(data.dtype, self.dtype)
+        self.assertEqual(data.tolist(), rows)
+
+    def test_parse_binary_empty(self):
+        data = parse_binary(binary_copy([], self.dtype), self.dtype)
+        self.assertEqual(len(data), 0)
+        self.assertEqual(data.dtype, self.dtype)
+
+    def test_parse_binary_null(self):
+        # a NULL has no value, so the rows don't fit the fixed layout
+        stream = binary_copy([(1, 2.5, True), (2, None, False)], self.dtype)
+        self.assertIsNone(parse_binary(stream, self.dtype))
+
+    def test_parse_binary_not_binary(self):
+        with self.assertRaises(ValueError):
+            parse_binary(b"1,2.5,t\n", self.dtype)
+
+    def test_copy_arrays_falls_back_to_csv(self):
+        connection = FakeCopyConnection(
+            binary_copy([(1, 2.5, True), (2, None, False)], self.dtype),
+            b"1,2.5,t\n2,,f\n",
+        )
+        data = copy_arrays(connection, "SELECT 1", [], self.dtype)
+        self.assertEqual(connection.formats, ["binary", "csv"])
+        self.assertEqual(data["i"].tolist(), [1, 2])
+        self.assertEqual(data["value"][0], 2.5)
+        self.assertTrue(np.isnan(data["value"][1])) # NULL
+        self.assertEqual(data["flag"].tolist(), [True, False])
+
+    def test_copy_arrays_null_ints(self):
+        # a NULL in an integer (or boolean) field makes it float, with NaN for the NULL
+        connection = FakeCopyConnection(
+            binary_copy([(None, 2.5, None), (2, 1.0, True)], self.dtype),
+            b",2.5,\n2,1.0,t\n",
+        )
+        data = copy_arrays(connection, "SELECT 1", [], self.dtype)
+        self.assertEqual(data.dtype["i"], np.float64)
+        self.assertEqual(data.dtype["flag"], np.float64)
+        self.assertEqual(data.dtype["value"], np.float64)
+        self.assertTrue(np.isnan(data["i"][0]) and np.isnan(data["flag"][0]))
+        self.assertEqual((data["i"][1], data["flag"][1]), (2.0, 1.0))
+
+    def test_copy_arrays_binary(self):
+        rows = [(1, 2.5, True)]
+        connection = FakeCopyConnection(binary_copy(rows, self.dtype), b"")
+        self.assertEqual(copy_arrays(connection, "SELECT 1", [], self.dtype).tolist(), rows)
+        self.assertEqual(connection.formats, ["binary"])
+
+class AvailabilityTests(SimpleTestCase):
+    # PSUT: dataset 1, version 2 has country 3 (energy type 4, last stage 5) in 2000 and 2001
+    index = AvailabilityIndex("default", {
+        "built": 0,
+        "stamp": {},
+        "tables": {"PSUT": [[1, 2, 3, 4, 5, format(year_mask(2000, 2001), "x")]]},
+    })
+
+    def query(self, **changes) -> dict:
+        return {"Dataset": 1, "ValidFromVersion__gte": 2, "ValidToVersion__lte": 2,
+                "Country": 3, "EnergyType": 4, "LastStage": 5, **changes}
+
+    def has_data(self, query: dict, model = PSUT, index = index) -> bool:
+        with mock.patch.object(availability, "get_index", return_value = index):
+            return query_has_data(("default", model), query)
+
+    def test_year_mask(self):
+        self.assertEqual(mask_years(year_mask(2000, 2002)), [2000, 2001, 2002])
+        # every year from 2000 on
+        self.assertTrue(year_mask(2000) & year_mask(2200, 2200))
+        self.assertFalse(year_mask(2000) & year_mask(FIRST_YEAR, 1999))
+        self.assertEqual(year_mask(2002, 2000), 0)
+        self.assertEqual(year_mask(FIRST_YEAR - 10, FIRST_YEAR), 1) # years before the first are left out
+
+    def test_mask_years(self):
+        self.assertEqual(mask_years(0), [])
+        self.assertEqual(mask_years(1 | 1 << 100 | 1 << 5), [FIRST_YEAR, FIRST_YEAR + 5, FIRST_YEAR + 100])
+
+    def test_query_has_data(self):
+        self.assertTrue(self.has_data(self.query()))
+        self.assertTrue(self.has_data(self.query(Year = 2001)))
+        self.assertTrue(self.has_data({**self.query(Year__gte = 1990, Year__lte = 2000)}))
+
+    def test_query_has_no_data(self):
+        self.assertFalse(self.has_data(self.query(Country = 9)))
+        self.assertFalse(self.has_data(self.query(Year = 2005)))
+        self.assertFalse(self.has_data(self.query(Year__gte = 2002)))
+
+    def test_query_has_data_in(self):
+        query = self.query()
+        del query["Country"]
+        self.assertTrue(self.has_data({**query, "Country__in": [9, 3]}))
+        self.assertFalse(self.has_data({**query, "Country__in": [9, 10]}))
+
+    def test_unknown_is_available(self):
+        # anything the index can't answer goes to the database
+        self.assertTrue(self.has_data(self.query(Dataset = 7))) # a dataset loaded after the index was built
+        self.assertTrue(self.has_data(self.query(ValidFromVersion__gte = 7)))
+        self.assertTrue(self.has_data(self.query(Country = 9), index = None)) # no index, or an out of date one
+        self.assertTrue(self.has_data(self.query(Country = 9), model = IEAData)) # a table it doesn't have
+        self.assertTrue(self.has_data(self.query(Country = 9), model = AggEtaPFU))
+        query = self.query(Country = 9)
+        del query["EnergyType"] # not filtered
+        self.assertTrue(self.has_data(query))
+
+    def test_stale_index_is_ignored(self):
+        # the index is only used while the data is what it was built from
+        contents = {"built": 0, "stamp": {"snapshot": "a", "writes": {"PSUT": 10}}, "tables": {"PSUT": []}}
+        with TemporaryDirectory() as directory, mock.patch.object(availability, "AVAILABILITY_DIR", Path(directory)):
+            for database in ["current", "stale"]:
+                write_json(availability.index_path(database), contents)
+
+            with mock.patch.object(availability, "data_stamp", return_value = contents["stamp"]):
+                self.assertIsNotNone(availability.get_index("current"))
+            with mock.patch.object(availability, "data_stamp", return_value = {"snapshot": "a", "writes": {"PSUT": 11}}):
+                self.assertIsNone(availability.get_index("stale"))
+            self.assertIsNone(availability.get_index("never built"))
+
+class PruneSankeyTests(SimpleTestCase):
+    # nodes A, B, C in column 0 and X, Y in column 1, B, C and Y have little flowing through them
+    labels = np.array(["A", "B", "C", "X", "Y"], dtype = object)
+    node_cols = np.array([0, 0, 0, 1, 1])
+    link_from = np.array([0, 1, 2, 0])
+    link_to = np.array([3, 3, 3, 4])
+    values = np.array([100.0, 1.0, 2.0, 1.5])
+
+    def prune(self, flow_threshold: float) -> dict:
+        colors = np.full(5, "blue", dtype = object)
+        pruned = _prune_sankey(
+            flow_threshold,
+            self.node_cols, np.arange(5), self.labels, colors, colors.copy(),
+            self.link_from, self.link_to, np.ones(4, dtype = bool), self.values,
+        )
+        names = ["node_cols", "first_seen", "node_labels", "node_colors", "carrier_colors",
+                 "link_from", "link_to", "carrier_rows", "values"]
+        return dict(zip(names, pruned))
+
+    def links(self, pruned: dict) -> dict:
+        # (from label, to label) -> value
+        labels = pruned["node_labels"]
+        return {
+            (labels[i], labels[j]): value
+            for i, j, value in zip(pruned["link_from"], pruned["link_to"], pruned["values"])
+        }
+
+    def test_total_flow_is_kept(self):
+        pruned = self.prune(5)
+        self.assertAlmostEqual(pruned["values"].sum(), self.values.sum())
+
+    def test_small_nodes_are_merged(self):
+        pruned = self.prune(5)
+        self.assertEqual(sorted(zip(pruned["node_cols"].tolist(), pruned["node_labels"].tolist())),
+                         [(0, "A"), (0, OTHER_LABEL), (1, OTHER_LABEL), (1, "X")])
+        self.assertEqual(self.links(pruned), {("A", "X"): 100.0, (OTHER_LABEL, "X"): 3.0, ("A", OTHER_LABEL): 1.5})
+
+        # every link is between nodes that are kept
+        node_count = len(pruned["node_cols"])
+        self.assertTrue((pruned["link_from"] < node_count).all() and (pruned["link_to"] < node_count).all())
+        self.assertEqual(len(pruned["link_from"]), len(pruned["carrier_rows"]))
+
+    def test_nothing_small(self):
+        pruned = self.prune(0.5)
+        self.assertEqual(pruned["node_labels"].tolist(), self.labels.tolist())
+        self.assertEqual(pruned["values"].tolist(), self.values.tolist())
+
+class XlsxTests(SimpleTestCase):
+
+    def test_sheet_name(self):
+        taken = set()
+        self.assertEqual(_xlsx_sheet_name("U", 1, taken), "U")
+        self.assertEqual(_xlsx_sheet_name("U", 2, taken), "U (2)")
+        self.assertEqual(_xlsx_sheet_name("a/b:c", 1, taken), "a b c") # characters Excel doesn't allow
+        self.assertEqual(_xlsx_sheet_name("", 1, taken), "Data")
+
+    def test_sheet_name_collisions(self):
+        # the same name after cleaning, or differing only by case
+        taken = set()
+        names = [_xlsx_sheet_name(key, 1, taken) for key in ["a/b", "a:b", "A b"]]
+        self.assertEqual(names, ["a b", "a b~2", "A b~3"])
+
+    def test_sheet_name_length(self):
+        taken = set()
+        long_name = "x" * 40
+        names = [_xlsx_sheet_name(long_name, 1, taken), _xlsx_sheet_name(long_name, 12, taken), _xlsx_sheet_name(long_name, 1, taken)]
+        self.assertTrue(all(len(name) <= 31 for name in names))
+        self.assertEqual(names[1], "x" * 26 + " (12)")
+        self.assertEqual(len(set(name.lower() for name in names)), 3)
+
+    def write(self, **limits) -> tuple[bool, list[str], int]:
+        # write 5 chunks of 10 rows, give back if it was complete, the sheet names and the rows of the first sheet
+        def chunks(*args):
+            for i in range(5):
+                yield pd.DataFrame({"Year": range(i * 10, i * 10 + 10), "matname": ["U"] * 10})
+
+        workbook = io.BytesIO()
+        with mock.patch.object(data, "iter_translated_chunks", chunks):
+            complete = write_xlsx_from_query(None, {}, ["Year", "matname"], workbook, **limits)
+
+        with zipfile.ZipFile(workbook) as files:
+            workbook_xml = files.read("xl/workbook.xml").decode()
+            rows = files.read("xl/worksheets/sheet1.xml").count(b"<row ")
+        names = [part.split('"')[0] for part in workbook_xml.split('<sheet name="')[1:]]
+        return complete, names, rows
+
+    @skipIf(data.xlsxwriter is None, "xlsxwriter isn't installed")
+    def test_workbook(self):
+        self.assertEqual(self.write(), (True, ["Data"], 51)) # with the header
+
+    @skipIf(data.xlsxwriter is None, "xlsxwriter isn't installed")
+    def test_workbook_cut_off(self):
+        self.assertEqual(self.write(max_rows = 25), (False, ["Data", "Truncated"], 26))
+        self.assertEqual(self.write(max_seconds = -1), (False, ["Data", "Truncated"], 1))
+
+@skipIf(data.pa is None, "pyarrow isn't installed")
+class ColumnarTests(SimpleTestCase):
+    columns = ["Country", "IncludesNEU", "Year", "value"]
+
+    def setUp(self):
+        # lookup tables without a database
+        translator = mock.patch.object(data, "Translator")
+        translator.start().return_value.get_id_map.return_value = {5: "Ghana", 2: "Chile", 9: "Kenya"}
+        self.addCleanup(translator.stop)
+        self.schema, self.dictionaries = _columnar_schema(("default", PSUT), self.columns)
+
+    def test_schema(self):
+        types = {field.name: str(field.type) for field in self.schema}
+        self.assertEqual(types, {
+            "Country": "dictionary<values=string, indices=int32, ordered=0>",
+            "IncludesNEU": "bool",
+            "Year": "int16",
+            "value": "double",
+        })
+        self.assertEqual(self.dictionaries["Country"][1].to_pylist(), ["Chile", "Ghana", "Kenya"]) # in ID order
+
+    def test_table(self):
+        chunk = pd.DataFrame({"Country": [5, 9, 5], "IncludesNEU": [1, 0, 1], "Year": [2000, 2001, 2002], "value": [1.5, 2.0, 0.0]})
+        table = _columnar_table(chunk, self.schema, self.dictionaries)
+        self.assertEqual(table.schema, self.schema)
+        self.assertEqual(table.to_pydict(), {
+            "Country": ["Ghana", "Kenya", "Ghana"],
+            "IncludesNEU": [True, False, True],
+            "Year": [2000, 2001, 2002],
+            "value": [1.5, 2.0, 0.0],
+        })
+
+    def test_table_nulls(self):
+        # NULLs from the database (NaN once in a DataFrame) stay null
+        chunk = pd.DataFrame({"Country": [5, None], "IncludesNEU": [None, 1], "Year": [2000, None], "value": [None, 2.0]})
+        table = _columnar_table(chunk, self.schema, self.dictionaries)
+        self.assertEqual(table.to_pydict(), {
+            "Country": ["Ghana", None],
+            "IncludesNEU": [None, True],
+            "Year": [2000, None],
+            "value": [None, 2.0],
+        })
+
+    def test_table_unknown_id(self):
+        chunk = pd.DataFrame({"Country": [5, 7], "IncludesNEU": [1, 0], "Year": [2000, 2001], "value": [1.0, 2.0]})
+        with self.assertRaises(KeyError):
+            _columnar_table(chunk, self.schema, self.dictionaries)
@@ -1,6 +1,7 @@
 from django.urls import path, re_path
 import Mexer.views.history as history_views
 import Mexer.views.misc as misc_views
+import Mexer.views.monitoring as monitoring_views
 import Mexer.views.user_accounts as accounts_views
 import Mexer.views.visualizer as visualizer_views
 
@@ -20,6 +21,7 @@ urlpatterns = [
     # visualizer tool pages
     path("plot", visualizer_views.get_plot),
     path("data", visualizer_views.get_data),
+    path("availability", visualizer_views.availability),
 
     # history tool pages
     path("history", history_views.render_history),
@@ -32,4 +34,8 @@ urlpatterns = [
     path('matrix-info/', misc_views.matrix_info, name="matrix-info"),
     re_path(r"static/(.*/[^(\.)]*\..*)", misc_views.handle_static),
     path("plot-stage/", misc_views.plot_stage),
+
+    # monitoring pages
+    path("stats", monitoring_views.stats),
+    path("metrics", monitoring_views.metrics),
 ]
@@ -11,18 +11,17 @@
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
-from utils.history import get_user_history, get_history_html
+from utils.history import get_user_history, get_history_html, save_user_history, set_history_cookie
 from django.http import HttpResponse
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 from Mexer.views.error_pages import *
-import pickle
 
 def render_history(request):
     """
     Render the user's plot history as HTML.
     
-    This function retrieves the user's plot history from cookies
+    This function retrieves the user's plot history from the history store
     and formats it as HTML buttons with delete functionality for each item.
     
     Args:
@@ -43,7 +42,7 @@ def delete_history_item(request):
     Delete a specific item from the user's plot history.
     
     This function handles POST requests to delete a history item.
-    It updates the user's history cookie after deletion.
+    It updates the user's stored history after deletion.
     
     Inputs:
         request: The HTTP request object containing the index of the item to delete.
@@ -62,13 +61,13 @@ def delete_history_item(request):
         user_history = get_user_history(request)
         
         # Check if the index is valid
-        if 0 > index >= len(user_history): return error_400(request, "Bad history index for user history received")
+        if index >= len(user_history): return error_400(request, "Bad history index for user history received")
 
         # Remove the item at the specified index
         del user_history[index]
         
-        # Serialize the updated history
-        serialized_data = pickle.dumps(user_history)
+        # Save the updated history
+        history_id = save_user_history(request, user_history)
         
         if user_history:
             # If there are still items in the history, render them
@@ -77,8 +76,8 @@ def delete_history_item(request):
             # If the history is now empty, return a message
             response = HttpResponse('<p>No history available.</p>')
         
-        # Update the user's history cookie
-        response.set_cookie('user_history', serialized_data.hex(), max_age=30 * 24 * 60 * 60)
+        # Make sure the user has their history ID
+        set_history_cookie(request, response, history_id)
         
         return response
     
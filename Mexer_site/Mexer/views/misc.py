@@ -54,19 +54,29 @@ def matrix_info(request):
     matricies = matname.objects.all()
     return render(request, 'matrix_info.html', context = {"matricies":matricies})
 
-from Mexer_meta.settings import STATIC_BASE
+from Mexer_meta.settings import STATIC_BASE, STATIC_MAX_AGE
+from utils.static_files import StaticFileCache
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+
+# static files kept in memory between requests
+STATIC_FILES = StaticFileCache(STATIC_BASE)
+
 def handle_static(request, filepath: str):
-    """Serve CSS static files directly from a specified directory.
+    """Serve static files directly from a specified directory.
 
-    This function reads a CSS file from a static files directory
+    This function gets a file from the static files directory (through an in memory cache)
     and serves it as an HTTP response with the appropriate content type.
+    Caching headers are sent along, and if the browser already has
+    the current version of the file, a 304 Not Modified is sent instead.
 
     Inputs:
-        request: The HTTP request object (not used in this function, but typically included for view functions)
-        filepath: The path to the CSS file relative to the static files directory
+        request: The HTTP request object, used for its caching and encoding headers
+        filepath: The path to the file relative to the static files directory
 
     Outputs:
-        HttpResponse containing the contents of the CSS file
+        HttpResponse containing the contents of the file
+        or HttpResponseNotModified if the browser's copy is current
     """
     # example filepath: css/toolbar.css OR admin/css/toolbar.css
     
@@ -90,7 +100,36 @@ def handle_static(request, filepath: str):
             return error_404(request, f"Couldn't figure out content type of {filepath}")
     
     try:
-        with open(f"{STATIC_BASE}/{filepath}", "rb") as f:
-                return HttpResponse(f.read(), headers = {"Content-Type": mime_type})
+        static_file = STATIC_FILES.get(filepath, mime_type)
     except Exception as e:
         return error_404(request, e)
+
+    encoding = static_file.pick_encoding(request.headers.get("Accept-Encoding", ""))
+    content, etag = static_file.encodings[encoding]
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(static_file.last_modified),
+        "Cache-Control": f"public, max-age={STATIC_MAX_AGE}",
+        "Vary": "Accept-Encoding",
+    }
+
+    # if the browser already has this version, don't send it again
+    # If-None-Match wins over If-Modified-Since when both are sent
+    if if_none_match := request.headers.get("If-None-Match"):
+        not_modified = if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    else:
+        modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+        not_modified = modified_since is not None and int(static_file.last_modified) <= modified_since
+
+    if not_modified:
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    headers["Content-Type"] = mime_type
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    return HttpResponse(content, headers = headers)
@@ -0,0 +1,45 @@
+####################################################################
+# monitoring.py includes views for keeping an eye on how the site is running
+#
+# Only staff can see these pages
+# (and /metrics from the server itself, so a local Prometheus can scrape it)
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu 
+#####################
+from django.http import JsonResponse, HttpResponse
+from Mexer.views.error_pages import *
+from utils.cache import RESULT_CACHES
+from utils.plot_pool import PLOT_POOL
+from utils.metrics import render_metrics
+
+# addresses of the server itself
+LOCAL_ADDRESSES = ["127.0.0.1", "::1"]
+
+def stats(request):
+    ''' Give cache and plot pool statistics as JSON for monitoring '''
+
+    # pretend the page doesn't exist for non-staff
+    if not request.user.is_staff:
+        return error_404(request, "Stats requested by non-staff user")
+
+    return JsonResponse({
+        # only the counts and pool of the worker that answered this request
+        **{f"{cache.name}_cache": cache.stats() for cache in RESULT_CACHES},
+        "plot_pool": PLOT_POOL.stats(),
+    })
+
+def metrics(request):
+    ''' Give the timing histograms (see utils/metrics.py) in Prometheus' text format
+
+    Added up over every server worker, not just the one that answered this request
+    '''
+
+    # pretend the page doesn't exist for anyone but staff and the server itself
+    # (a request passed on by a proxy on the server looks local too, but says who it is for)
+    local = request.META.get("REMOTE_ADDR") in LOCAL_ADDRESSES and "HTTP_X_FORWARDED_FOR" not in request.META
+    if not (request.user.is_staff or local):
+        return error_404(request, "Metrics requested by non-staff user")
+
+    return HttpResponse(render_metrics(), content_type = "text/plain; version=0.0.4; charset=utf-8")
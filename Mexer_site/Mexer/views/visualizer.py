@@ -3,8 +3,9 @@
 # 
 # The three main views are
 # The visualizer page itself - where users make queries and see plots
-# The plotting page - the page where, given a post request, plot html will be returned
-# The data page - the page where, given a post request, data in csv or excel (wip) will be returned
+# The plotting page - the page where, given a post request, plot html will be returned (async)
+# The data page - the page where, given a post request, data in csv, excel, parquet or arrow will be returned
+# And /availability, which tells the visualizer page which choices have data
 # 
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
@@ -14,17 +15,25 @@ from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from utils.misc import time_view, iea_valid, get_plot_title
 from utils.logging import LOGGER
-from Mexer.models import EvizUser, Version, AggEtaPFU
+from Mexer.models import AggEtaPFUBase
+from utils.option_catalog import get_option_catalog
+from utils.availability import get_index, mask_years
 from utils.translator import Translator
-from Mexer_meta.settings import SANDBOX_PREFIX
+from Mexer_meta.settings import DATABASES, SANDBOX_PREFIX
 from django.shortcuts import render
 from utils.data import *
-from django.http import HttpResponse
-from utils.sankey import get_sankey
-from utils.xy_plot import get_xy
-from utils.matrix import get_matrix, get_ruvy_matrix, visualize_matrix
-from plotly.offline import plot
-from utils.history import update_user_history
+from django.http import HttpResponse, StreamingHttpResponse, JsonResponse, FileResponse
+from tempfile import TemporaryFile
+from utils.sankey import prepare_sankey, build_sankey
+from utils.cache import SANKEY_CACHE
+from utils.xy_plot import get_xy_data, render_xy_html
+from utils.matrix import get_matrix, get_ruvy_matrix, get_matrix_stack, get_matrix_frame, get_matrix_stack_frame, render_matrix_html
+from utils.plot_pool import PLOT_POOL, PlotPoolFull
+from utils.history import update_user_history, set_history_cookie
+from asgiref.sync import sync_to_async
+from django.db import connections
+import pandas as pd
+import asyncio
 
 
 @login_required(login_url="/login")
@@ -45,85 +54,126 @@ def visualizer(request):
 
     # see if the user is iea approved
     iea_user = request.user.is_authenticated and request.user.has_perm("eviz.get_iea")
-    
-    # see if the user is an admin to get access to SandboxDB table
-    try:
-        admin_user = EvizUser.objects.get_by_natural_key(request.user.username).is_staff
-    except Exception as e:
-        print(e)
-        admin_user = False
-
-    # Fetch all available options for various parameters from the Translator
-    if admin_user:
-        datasets = Translator.get_all('datasets:admin')
-    else:
-        datasets = Translator.get_all('datasets:public')
-    
-    countries = Translator.get_all('country')
-    countries.sort()
-    versions = Translator.get_all('version')
-    if admin_user:
-        sandbox_versions = [SANDBOX_PREFIX + ver for ver in Version.objects.using("sandbox").values_list("Version", flat=True)]
-    else:
-        sandbox_versions = []
-    # methods = Translator.get_all('method')
-    methods = ["PCM"] # override, we don't show all the options
-    energy_types = Translator.get_all('energytype')
-    # last_stages = Translator.get_all('laststage')
-    last_stages = ["Final", "Useful"] # override, we don't show all the options
-    grossnets = Translator.get_all('grossnet')
-    product_aggregations = Translator.get_all('agglevel')
-    industry_aggregations = Translator.get_all('agglevel')
-    matnames = Translator.get_all('matname')
-    matnames.sort(key=len)  # sort matrix names by how long they are... seems reasonable
-    
-    # Prepare the context dictionary for the template
+
+    # admins get access to the SandboxDB tables
+    admin_user = request.user.is_staff
+
+    # the choices are worked out once per version of the lookup tables,
+    # and the template only renders them again when that version changes
     context = {
-        "datasets":datasets,
-        "default_dataset": "CL-PFU MW",
+        **get_option_catalog(admin_user),
+        "iea_user": iea_user,
+        }
 
-        "versions":versions,
-        "default_version": "v2.0",
+    return render(request, "visualizer.html", context)
 
-        "sandbox_versions":sandbox_versions,
-        "default_sandbox_version": SANDBOX_PREFIX + "v2.0a7",
+@time_view
+def availability(request):
+    """ Give which countries have data, and for which years, for the visualizer's current choices.
 
-        "countries":countries,
-        "default_country": "Ghana",
+    The answer comes from the availability index (see utils/availability.py), never the fact tables.
 
-        "methods":methods,
-        "default_method":methods[0],
+    Inputs:
+        request: The HTTP GET request, with the dataset, version, energy_type (any number of them),
+            last_stage and plot_type of the visualizer's form
 
-        "energy_types":energy_types,
-        "default_energy_type":energy_types[0],
+    Outputs:
+        JSON of {"known": false} if the database's index hasn't been built, is out of date,
+        or doesn't have the dataset and version, otherwise
+        {"known": true, "countries": {country: [years with data, in order], ...}}
+        with only the countries that have data
+    """
 
-        "last_stages":last_stages,
-        "default_last_stage":last_stages[0],
+    dataset = request.GET.get("dataset", "")
+    database = "sandbox" if dataset.startswith(SANDBOX_PREFIX) else "default"
+    if database == "sandbox" and not request.user.is_staff:
+        return JsonResponse({"error": "Unknown dataset"}, status = 404)
 
-        "grossnets":grossnets,
-        "default_grossnet":grossnets[0],
+    if (index := get_index(database)) is None:
+        return JsonResponse({"known": False})
 
-        "matnames":matnames,
-        "default_matname":matnames[0],
-        
-        "product_aggregations":product_aggregations,
-        "default_product_aggregation":product_aggregations[0],
+    translator = Translator(database)
+    try:
+        dataset = translator.dataset_translate(dataset.removeprefix(SANDBOX_PREFIX))
+        version = translator.version_translate(request.GET.get("version", "").removeprefix(SANDBOX_PREFIX))
+        energy_types = {translator.energytype_translate(v) for v in request.GET.getlist("energy_type")}
+        last_stage = translator.laststage_translate(request.GET.get("last_stage", ""))
+    except KeyError as e:
+        return JsonResponse({"error": f"Unknown choice {e}"}, status = 400)
+
+    # xy plots use AggEtaPFU, everything else PSUT (see _get_database_target() in utils/data.py)
+    table = "AggEtaPFU" if request.GET.get("plot_type") == "xy_plot" else "PSUT"
+
+    # a dataset and version loaded after the index was built aren't known
+    if (combinations := index.combinations(table, dataset, version)) is None:
+        return JsonResponse({"known": False})
+
+    # every energy type chosen is plotted, so a year has data if any of them has it
+    years = {}
+    for (country, energy_type, ecc_stage), mask in combinations.items():
+        if energy_type in energy_types and ecc_stage == last_stage:
+            years[country] = years.get(country, 0) | mask
+
+    countries = translator.get_id_map("country")
+    return JsonResponse({
+        "known": True,
+        "countries": {countries[country]: mask_years(mask) for country, mask in years.items() if country in countries},
+    })
+
+def _database_work(func):
+    '''Make a sync function that uses the database awaitable from an async view
+
+    Every call runs in its own thread, so several can run at once (see _get_xy_data),
+    and gives that thread's database connections back (to the pool, see settings.py) when it is done
+    '''
+
+    def run(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connections.close_all()
 
-        "industry_aggregations":industry_aggregations,
-        "default_industry_aggregation":industry_aggregations[0],
+    return sync_to_async(run, thread_sensitive = False)
 
-        "iea_user":iea_user
-        }
+# how many countries of an xy plot are fetched at once,
+# so one big plot can't take up every database connection
+# (never more than the database's pool has, see _fetch_concurrency())
+XY_FETCH_CONCURRENCY = 4
 
-    return render(request, "visualizer.html", context)
+def _fetch_concurrency(database: str) -> int:
+    # more fetches at once than the pool has connections would only wait on the pool
+    pool = DATABASES[database]["OPTIONS"].get("pool")
+    return min(XY_FETCH_CONCURRENCY, pool["max_size"]) if pool else XY_FETCH_CONCURRENCY
+
+async def _get_xy_data(efficiency_metric: str, target, query: dict, *plot_by) -> pd.DataFrame:
+    ''' Get the data of an xy plot (see get_xy_data()), fetching each country at the same time '''
+
+    countries = query.get("Country__in")
+    if not countries or len(countries) == 1:
+        return await _database_work(get_xy_data)(efficiency_metric, target, query, *plot_by)
+
+    limit = asyncio.Semaphore(_fetch_concurrency(target[0]))
+    async def get_country(country):
+        country_query = {k: v for k, v in query.items() if k != "Country__in"}
+        country_query["Country"] = country
+        async with limit:
+            return await _database_work(get_xy_data)(efficiency_metric, target, country_query, *plot_by)
+
+    frames = await asyncio.gather(*(get_country(country) for country in countries))
+    frames = [df for df in frames if df is not None]
+    return pd.concat(frames, ignore_index=True) if frames else None
 
 @csrf_exempt
 @time_view
-def get_plot(request):
+async def get_plot(request):
     """Generate and return a plot based on the POST request data.
     
     This function handles different types of plot types (sankey, xy_plots, matrices) and manages 
     user access to IEA data. It also updates the user's plot history.
+
+    This view is async: database work is run in threads and figures are
+    built in the plot pool (see utils/plot_pool.py), so a slow plot doesn't
+    hold up other requests. Serve with ASGI (python3 manage.py serve --asgi) to get the benefit.
     
     Inputs:
         request (HttpRequest): The HTTP request object.
@@ -132,13 +182,16 @@ def get_plot(request):
         HttpResponse: A response containing the plot HTML or an error message.
     """
 
+    user = await request.auser()
+
     # if user is not logged in their username is empty string
     # mark them as anonymous in the logs
-    LOGGER.info(f"Plot requested by {request.user.get_username() or 'anonymous user'}")
+    LOGGER.info(f"Plot requested by {user.get_username() or 'anonymous user'}")
     
     if request.method == "POST":
         # Extract plot type and query parameters from the POST request
-        query, plot_type, target = shape_post_request(request.POST, ret_plot_type = True, ret_database_target = True)
+        # (picking the database target can use the database)
+        query, plot_type, target = await _database_work(shape_post_request)(request.POST, ret_plot_type = True, ret_database_target = True)
 
         try:
             if query["dataset"].startswith(SANDBOX_PREFIX) != query["version"].startswith(SANDBOX_PREFIX):
@@ -152,103 +205,137 @@ def get_plot(request):
 
         # Check if the user has access to IEA data
         # TODO: make this work with status = 403, problem is HTMX won't show anything
-        if not iea_valid(request.user, query):
-            LOGGER.warning(f"IEA data requested by unauthorized user {request.user.get_username() or 'anonymous user'}")
+        if not await _database_work(iea_valid)(user, query):
+            LOGGER.warning(f"IEA data requested by unauthorized user {user.get_username() or 'anonymous user'}")
             return HttpResponse("You do not have access to IEA data. Please contact <a style='color: #00adb5' :visited='{color: #87CEEB}' href='mailto:matthew.heun@calvin.edu'>matthew.heun@calvin.edu</a> with questions."
                                 "You can also purchase WEB data at <a style='color: #00adb5':visited='{color: #87CEEB}' href='https://www.iea.org/data-and-statistics/data-product/world-energy-balances'> World Energy Balances</a>.")
         
         plot_div = None # where to store what html will be sent to the user
 
-        # Use match-case to handle different plot types
-        match plot_type:
-            case "sankey":
-                translated_query = translate_query(target, query)
-                nodes,links,options = get_sankey(target, translated_query)
-
-                if nodes is None:
-                    plot_div = "Error: No cooresponding data"
-                else:
-                    plot_div = f"<script>createSankey({nodes},{links},{options},\"{get_plot_title(query)}\")</script>\
-                                <button onclick='downloadSankey()' class='sankey-download-button'>Download Sankey</button>"
-
-            case "xy_plot":
-                # Extract specific parameters for xy_plot
-                efficiency_metric = query.get('efficiency')
-                color_by = query.get("color_by")
-                line_by = query.get("line_by")
-                facet_col_by = query.get("facet-col-by")
-                facet_row_by = query.get("facet-row-by")
-                energy_type = query.get("energy_type")
-                
-                # Handle combined Energy and Exergy case
-                if 'Energy' in energy_type and 'Exergy' in energy_type:
-                    energy_type = 'Energy, Exergy'
-                
-                translated_query = translate_query(target, query)
-                xy = get_xy(efficiency_metric, target, translated_query, color_by, line_by, facet_col_by, facet_row_by, energy_type)
-                if xy is None:
-                    plot_div = "Error: No corresponding data"
-                else:
-                    xy.update_layout(
-                        title=get_plot_title(query, exclude=[color_by, line_by, facet_col_by, facet_row_by, energy_type])
-                    )
-                    plot_div = plot(xy, output_type="div", include_plotlyjs=False)
-                    LOGGER.info("XY plot made")
-
-            case "matrices":
-                # Extract specific parameters for matrices
-                matrix_name = query.get("matname")
-                color_scale = query.get('color_scale', "inferno")
-
-                # Retrieve the matrix
-                coloring_method = query.get('coloring_method', 'weight')
-                translated_query = translate_query(target, query)
-                
-                matname = None
-                if matrix_name == "RUVY" and coloring_method == "ruvy":
-                    matrix, matname = get_ruvy_matrix(target, translated_query)
-                else:
-                    matrix = get_matrix(target, translated_query)
-
-                if matrix is None:
-                    plot_div = "Error: No corresponding data"
-                else:
-                    heatmap = visualize_matrix(target, matrix, matname, color_scale, coloring_method)
-                    heatmap = heatmap.properties(
-                        title=matrix_name + " Matrix: " + get_plot_title(query),
-                        autosize = {"type": "fit", "contains": "padding"}
-                    )
-                    plot_div = heatmap.to_html() # Render the figure as an HTML div
-                
-                LOGGER.info("Matrix visualization made")
-        
-
-            case _: # default
-                plot_div = "Error: Plot type not specified or supported"
-                LOGGER.warning("Unrecognized plot type requested")
+        try:
+            # Use match-case to handle different plot types
+            match plot_type:
+                case "sankey":
+                    # nodes with flows under the threshold are merged together, 0 keeps everything
+                    # the threshold is either a percent of the biggest node or an amount of energy
+                    try:
+                        flow_threshold = float(query.get("flow_threshold") or 0)
+                    except ValueError:
+                        flow_threshold = -1
+                    relative_threshold = query.get("flow_threshold_unit", "percent") == "percent"
+                    if relative_threshold:
+                        flow_threshold /= 100
+
+                    if flow_threshold < 0:
+                        plot_div = "Error: Flow threshold must be a non-negative number"
+                    else:
+                        translated_query = await _database_work(translate_query)(target, query)
+                        cache_key, sankey, build_args = await _database_work(prepare_sankey)(
+                            target, translated_query, flow_threshold, relative_threshold
+                        )
+                        if sankey is None:
+                            sankey = await PLOT_POOL.run(build_sankey, *build_args)
+                            await sync_to_async(SANKEY_CACHE.set)(cache_key, sankey)
+                        nodes,links,options = sankey
+
+                        if nodes is None:
+                            plot_div = "Error: No cooresponding data"
+                        else:
+                            plot_div = f"<script>createSankey({nodes},{links},{options},\"{get_plot_title(query)}\")</script>\
+                                        <button onclick='downloadSankey()' class='sankey-download-button'>Download Sankey</button>"
+
+                case "xy_plot":
+                    # Extract specific parameters for xy_plot
+                    efficiency_metric = query.get('efficiency')
+                    color_by = query.get("color_by")
+                    line_by = query.get("line_by")
+                    facet_col_by = query.get("facet-col-by")
+                    facet_row_by = query.get("facet-row-by")
+                    energy_type = query.get("energy_type")
+                    
+                    # Handle combined Energy and Exergy case
+                    if 'Energy' in energy_type and 'Exergy' in energy_type:
+                        energy_type = 'Energy, Exergy'
+                    
+                    translated_query = await _database_work(translate_query)(target, query)
+                    df = await _get_xy_data(efficiency_metric, target, translated_query, color_by, line_by, facet_col_by, facet_row_by)
+                    if df is None:
+                        plot_div = "Error: No corresponding data"
+                    else:
+                        title = get_plot_title(query, exclude=[color_by, line_by, facet_col_by, facet_row_by, energy_type])
+                        plot_div = await PLOT_POOL.run(
+                            render_xy_html, df, efficiency_metric, title,
+                            color_by, line_by, facet_col_by, facet_row_by, energy_type
+                        )
+                        LOGGER.info("XY plot made")
+
+                case "matrices":
+                    # Extract specific parameters for matrices
+                    matrix_name = query.get("matname")
+                    color_scale = query.get('color_scale', "inferno")
+
+                    # Retrieve the matrix
+                    coloring_method = query.get('coloring_method', 'weight')
+                    # whether to give every year separately, to be stepped through
+                    year_stack = query.get('year_stack') == "on"
+                    translated_query = await _database_work(translate_query)(target, query)
+                    
+                    matname = None
+                    if year_stack:
+                        matrix = await _database_work(get_matrix_stack)(target, translated_query)
+                    elif matrix_name == "RUVY" and coloring_method == "ruvy":
+                        matrix, matname = await _database_work(get_ruvy_matrix)(target, translated_query)
+                    else:
+                        matrix = await _database_work(get_matrix)(target, translated_query)
+
+                    if matrix is None:
+                        plot_div = "Error: No corresponding data"
+                    else:
+                        if year_stack:
+                            df = await _database_work(get_matrix_stack_frame)(target, matrix)
+                        else:
+                            df = await _database_work(get_matrix_frame)(target, matrix, matname, coloring_method)
+                        title = matrix_name + " Matrix: " + get_plot_title(query)
+                        # Render the figure as an HTML div
+                        plot_div = await PLOT_POOL.run(render_matrix_html, df, title, color_scale, year_stack)
+                    
+                    LOGGER.info("Matrix visualization made")
+            
+
+                case _: # default
+                    plot_div = "Error: Plot type not specified or supported"
+                    LOGGER.warning("Unrecognized plot type requested")
+
+        except PlotPoolFull:
+            LOGGER.warning("Plot pool full, plot request turned away")
+            plot_div = "Error: The server is busy making other plots, please try again in a moment"
         
         response = HttpResponse(plot_div) # the final response to be returned
         
         # Update user history only if there was no error
         if not plot_div.startswith("Error"):
-            serialized_data = update_user_history(request, plot_type, query)
+            history_id = await sync_to_async(update_user_history)(request, plot_type, query)
             response.content += b"<script>refreshHistory();</script>"
             if separate_window:
                 response.content += b"<script>plotInNewWindow();</script>"
-            # Set cookie to expire in 7 days
-            response.set_cookie('user_history', serialized_data.hex(), max_age=7 * 24 * 60 * 60)
+            # Make sure the user has their history ID
+            set_history_cookie(request, response, history_id)
 
     return response
 
 @time_view
 def get_data(request):
-    """ Handle data retrieval requests and return CSV data based on the query.
+    """ Handle data retrieval requests and return CSV or Excel data based on the query.
 
     Inputs:
-        request (HttpRequest): The HTTP request object.
+        request (HttpRequest): The HTTP request object,
+            data_format picks the file type (csv, the default, xlsx, parquet or arrow)
 
     Outputs:
-        HttpResponse: A response containing CSV data or an error message.
+        StreamingHttpResponse: A response streaming the CSV data
+        or StreamingHttpResponse: A response streaming the Parquet or Arrow file
+        or FileResponse: A response streaming the Excel workbook
+        or HttpResponse: A response containing an error message.
     """
 
     # if user is not logged in their username is empty string
@@ -265,30 +352,67 @@ def get_data(request):
             return HttpResponse("You do not have access to IEA data. Please contact <a style='color: #00adb5' :visited='{color: #87CEEB}' href='mailto:matthew.heun@calvin.edu'>matthew.heun@calvin.edu</a> with questions."
                                 "You can also purchase WEB data at <a style='color: #00adb5':visited='{color: #87CEEB}' href='https://www.iea.org/data-and-statistics/data-product/world-energy-balances'> World Energy Balances</a>.")
 
+        # the file type to give, csv, xlsx, parquet or arrow
+        query_format = query.get("data_format", "csv")
+
         # Translate the query to match database field names
-        query = translate_query(target, query)
+        translated_query = translate_query(target, query)
 
-        # Generate CSV data based on the query
-        if target[1] is AggEtaPFU:
+        # Pick the columns to give based on the query
+        if issubclass(target[1], AggEtaPFUBase):
             # get xy info
-            csv = get_csv_from_query(target, query, columns = META_COLUMNS + AGGETA_COLUMNS)
+            columns = META_COLUMNS + AGGETA_COLUMNS
         else:
             # get psut (sankey and matrix) info
-            csv = get_csv_from_query(target, query, columns = META_COLUMNS + PSUT_COLUMNS)
-
-        # set up the response:
-        # content is the csv made above
-        # then give csv MIME 
-        # and appropriate http header
-        final_response = HttpResponse(
-            content = csv,
-            content_type = "text/csv",
-            headers = {"Content-Disposition": 'attachment; filename="eviz_data.csv"'} # TODO: make this file name more descriptive
-        )
-        LOGGER.info("Made CSV data")
-
-        # TODO: excel downloads
-        # MIME for workbook is application/vnd.openxmlformats-officedocument.spreadsheetml.sheet
-        # file handle is xlsx for workbook 
+            columns = META_COLUMNS + PSUT_COLUMNS
+
+        if query_format == "xlsx":
+            if xlsxwriter is None:
+                return HttpResponse("Error: Excel downloads aren't available, please download a CSV instead")
+
+            # the workbook is built in a temporary file (deleted when the response closes it)
+            # a chunk of rows at a time, then streamed out from disk, so it is never all in memory
+            # each matrix (or dataset for xy data) can go in its own sheet
+            # nothing can be sent until it is finished, so big ones are cut off
+            # before the worker's timeout (see XLSX_MAX_EXPORT_ROWS in utils/data.py)
+            sheet_by = None
+            if query.get("split_sheets") == "on":
+                sheet_by = "Dataset" if issubclass(target[1], AggEtaPFUBase) else "matname"
+            workbook = TemporaryFile()
+            write_xlsx_from_query(target, translated_query, columns, workbook, sheet_by = sheet_by)
+            workbook.seek(0)
+
+            final_response = FileResponse(
+                workbook,
+                as_attachment = True,
+                filename = "eviz_data.xlsx", # TODO: make this file name more descriptive
+                content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
+            LOGGER.info("Streaming Excel data")
+        elif query_format in COLUMNAR_FORMATS:
+            if pa is None:
+                return HttpResponse("Error: Parquet and Arrow downloads aren't available, please download a CSV instead")
+
+            # typed, dictionary-encoded columns written a chunk at a time
+            # and streamed out as each chunk is written (see stream_columnar_from_query())
+            content_type, extension = COLUMNAR_FORMATS[query_format]
+            final_response = StreamingHttpResponse(
+                streaming_content = stream_columnar_from_query(target, translated_query, columns, query_format),
+                content_type = content_type,
+                headers = {"Content-Disposition": f'attachment; filename="eviz_data.{extension}"'} # TODO: make this file name more descriptive
+            )
+            LOGGER.info(f"Streaming {query_format} data")
+        else:
+            # set up the response:
+            # content is the csv, streamed out chunk by chunk as it is read from the database
+            # so big downloads never sit in memory all at once
+            # then give csv MIME 
+            # and appropriate http header
+            final_response = StreamingHttpResponse(
+                streaming_content = stream_csv_from_query(target, translated_query, columns),
+                content_type = "text/csv",
+                headers = {"Content-Disposition": 'attachment; filename="eviz_data.csv"'} # TODO: make this file name more descriptive
+            )
+            LOGGER.info("Streaming CSV data")
 
     return final_response
@@ -0,0 +1,69 @@
+"""
+Gunicorn config for running Mexer in production.
+
+Use through the serve management command (python3 manage.py serve)
+or directly with gunicorn -c python:Mexer_meta.gunicorn_conf
+
+Every setting can be overridden with an environment variable (MEXER_*).
+
+For more information on these settings, see
+https://docs.gunicorn.org/en/stable/settings.html
+"""
+
+import multiprocessing
+from os import environ
+
+# MEXER_ASGI=1 serves the ASGI app with uvicorn workers,
+# so async views (like /plot) can run many requests at once per worker
+if environ.get("MEXER_ASGI", "0") == "1":
+    wsgi_app = "Mexer_meta.asgi:application"
+    worker_class = "uvicorn_worker.UvicornWorker"
+else:
+    wsgi_app = "Mexer_meta.wsgi:application"
+
+bind = environ.get("MEXER_BIND", "0.0.0.0:8000")
+
+# the usual (2 x cores) + 1 workers, so one slow plot only holds up its own worker
+# the database pools are sized from the same number (see DATABASES in settings.py),
+# so change it with MEXER_WORKERS rather than gunicorn's --workers
+workers = int(environ.get("MEXER_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+
+# plots of big queries can take a while to make
+timeout = int(environ.get("MEXER_TIMEOUT", 120))
+
+# how long workers get to finish their requests on a reload (kill -HUP) or shutdown
+graceful_timeout = int(environ.get("MEXER_GRACEFUL_TIMEOUT", 30))
+
+# recycle workers after some number of requests so memory from big queries
+# is given back, jittered so they don't all restart at once
+max_requests = int(environ.get("MEXER_MAX_REQUESTS", 1000))
+max_requests_jitter = int(environ.get("MEXER_MAX_REQUESTS_JITTER", 100))
+
+accesslog = "-"
+
+def on_starting(server):
+    # start /metrics from zero, not from what the last server saved (see utils/metrics.py)
+    from utils.metrics import clear_metrics
+    clear_metrics()
+
+def worker_exit(server, worker):
+    # runs in the worker as it exits cleanly (not if it is killed)
+
+    # close the worker's database connection pools (see DATABASES in settings.py)
+    # so the database isn't left with connections nobody will use
+    from django.db import connections
+    for connection in connections.all(initialized_only = True):
+        if getattr(connection, "pool", None) is not None:
+            connection.close_pool()
+
+    # save the numbers it hasn't saved yet for /metrics (see utils/metrics.py)
+    from utils.metrics import flush_metrics
+    flush_metrics()
+
+def child_exit(server, worker):
+    # runs in the master after any worker has exited, even one that was killed,
+    # and before its pid can be given to a new worker
+
+    # keep the worker's numbers on /metrics after it is gone (see utils/metrics.py)
+    from utils.metrics import archive_metrics
+    archive_metrics(worker.pid)
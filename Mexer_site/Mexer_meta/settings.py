@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import multiprocessing
+import warnings
 from pathlib import Path
 from os import environ
 
@@ -47,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so it times everything else too
+    'Mexer.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,35 +84,145 @@ WSGI_APPLICATION = 'Mexer_meta.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
+# Connections
+# https://docs.djangoproject.com/en/5.2/ref/databases/#connection-pool
+# Each database gets a pool of open connections (psycopg's pool) in every worker,
+# so bursts of /plot and /data requests don't each wait on a new connection (TCP + auth).
+# Every worker has its own pools, so together they could open far more
+# connections than PostgreSQL allows (100 by default). So the pools share
+# MEXER_DB_MAX_CONNECTIONS connections (default 80, leaving some for admin work):
+# each of the MEXER_WORKERS workers (see Mexer_meta/gunicorn_conf.py) gets an equal part,
+# split between the databases by DATABASE_POOL_WEIGHTS.
+# Pools can also be set per database from the environment, e.g. for sandbox:
+#   MEXER_DB_SANDBOX_POOL_MIN, MEXER_DB_SANDBOX_POOL_MAX, MEXER_DB_SANDBOX_POOL_TIMEOUT
+# MEXER_DB_POOL=0 (or not having psycopg_pool) turns pooling off,
+# then connections are kept open for MEXER_DB_CONN_MAX_AGE seconds instead.
+#
+# In production, with many workers, put pgbouncer (in transaction mode) between
+# the site and PostgreSQL: the pools then hold cheap pgbouncer connections, and
+# MEXER_DB_MAX_CONNECTIONS can be raised to pgbouncer's max_client_conn while
+# pgbouncer's default_pool_size keeps PostgreSQL's connections down.
+# Set MEXER_DB_PGBOUNCER=1 then, pgbouncer in transaction mode
+# can't keep server-side cursors open between transactions
+try:
+    import psycopg_pool
+    DATABASE_POOLING = environ.get("MEXER_DB_POOL", "1") == "1"
+except ImportError:
+    DATABASE_POOLING = False
+
+# how many server worker processes there are (the serve command sets this from --workers)
+SERVER_WORKERS = int(environ.get("MEXER_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+
+# how many connections the pools of every worker can have together
+# (each pool needs at least one, see the check after DATABASES)
+DATABASE_MAX_CONNECTIONS = int(environ.get("MEXER_DB_MAX_CONNECTIONS", 80))
+
+# each database's share of a worker's connections,
+# plots read default (several queries at once for xy plots) much more than the others
+DATABASE_POOL_WEIGHTS = {"default": 2, "sandbox": 1, "users": 1}
+
+def pool_size(alias: str) -> int:
+    '''Get the largest a database's pool can be in each worker, see above'''
+    per_worker = DATABASE_MAX_CONNECTIONS // SERVER_WORKERS
+    share = per_worker * DATABASE_POOL_WEIGHTS[alias] // sum(DATABASE_POOL_WEIGHTS.values())
+    return max(1, share)
+
+def database(service: str, alias: str, pool_min: int, pool_max: int) -> dict:
+    '''Get the settings of a database, with its connections set up as described above'''
+    env = f"MEXER_DB_{alias.upper()}_"
+    settings = {
         "ENGINE": "django.db.backends.postgresql",
+        # check a connection is still alive before using it again
+        "CONN_HEALTH_CHECKS": True,
+        "DISABLE_SERVER_SIDE_CURSORS": environ.get("MEXER_DB_PGBOUNCER", "0") == "1",
         "OPTIONS": {
-            "service": "MexerDB",
+            "service": service,
             # All other information provided through environment variables
             # PGSERVICEFILE and PGPASSFILE
-            "application_name": "Mexer Site"
+            "application_name": "Mexer Site",
+        }
+    }
+
+    if DATABASE_POOLING:
+        settings["CONN_MAX_AGE"] = 0 # the pool keeps connections open instead
+        settings["OPTIONS"]["pool"] = {
+            "min_size": int(environ.get(env + "POOL_MIN", pool_min)),
+            "max_size": int(environ.get(env + "POOL_MAX", pool_max)),
+            # seconds to wait for a free connection before giving up
+            "timeout": float(environ.get(env + "POOL_TIMEOUT", 30)),
+            # close connections (above min_size) unused for this many seconds
+            "max_idle": float(environ.get(env + "POOL_MAX_IDLE", 10 * 60)),
         }
+    else:
+        settings["CONN_MAX_AGE"] = int(environ.get("MEXER_DB_CONN_MAX_AGE", 10 * 60))
+
+    return settings
+
+DATABASES = {
+    # plots read default and sandbox, several queries at once for xy plots
+    "default": database("MexerDB", "default", pool_min = 1, pool_max = pool_size("default")),
+    # only admins use sandbox, so no connections are kept open for it
+    "sandbox": database("SandboxDB", "sandbox", pool_min = 0, pool_max = pool_size("sandbox")),
+    # sessions and accounts, small quick queries
+    "users": database("users", "users", pool_min = 0, pool_max = pool_size("users")),
+}
+
+# every pool gets at least one connection, so with many workers the pools
+# can add up to more than the budget. Say so rather than silently going over it
+if DATABASE_POOLING:
+    DATABASE_POOL_TOTAL = SERVER_WORKERS * sum(db["OPTIONS"]["pool"]["max_size"] for db in DATABASES.values())
+    if DATABASE_POOL_TOTAL > DATABASE_MAX_CONNECTIONS:
+        warnings.warn(
+            f"{SERVER_WORKERS} workers' database pools can open {DATABASE_POOL_TOTAL} connections, "
+            f"more than MEXER_DB_MAX_CONNECTIONS ({DATABASE_MAX_CONNECTIONS}). Lower MEXER_WORKERS, "
+            "or put pgbouncer in front of PostgreSQL and raise MEXER_DB_MAX_CONNECTIONS (see Connections above)",
+            RuntimeWarning,
+        )
+
+DATABASE_ROUTERS = ["Mexer.routers.DatabaseRouter"]
+
+
+# Caches
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# see utils/cache.py for how results are cached
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
     },
-    "sandbox": {
-        "ENGINE": "django.db.backends.postgresql",
+    # finished sankey diagrams, kept on disk so they survive restarts
+    # and are shared by every worker process
+    "sankey": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "cache" / "sankey",
+        "TIMEOUT": None, # only go stale through invalidation
         "OPTIONS": {
-            "service": "SandboxDB",
-            "application_name": "Mexer Site"
+            "MAX_ENTRIES": 5000
         }
     },
-    'users': {
-        'ENGINE': 'django.db.backends.postgresql',
-        "OPTIONS":{
-            "service": "users",
-            "application_name": "Mexer Site"
-        }
-    }
-
+    # rendered parts of pages ({% cache %} in templates), e.g. the visualizer's choices,
+    # keyed by the version of what they show so they never need to expire
+    "template_fragments": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "TIMEOUT": None,
+    },
 }
 
-DATABASE_ROUTERS = ["Mexer.routers.DatabaseRouter"]
+# where the generations of the result caches are kept, they must never be culled (see utils/cache.py)
+CACHE_GENERATIONS_DIR = BASE_DIR / "cache" / "generations"
+
+# where xy plot DataFrames are cached, and how many bytes of them to keep
+XY_FRAME_CACHE_DIR = BASE_DIR / "cache" / "xy_frames"
+XY_FRAME_CACHE_MAX_BYTES = 512 * 1024 * 1024
 
+# where the translation snapshots (every lookup table of a database) are shared between workers (see utils/translation_snapshot.py)
+TRANSLATION_SNAPSHOT_DIR = BASE_DIR / "cache" / "translations"
+
+# where the availability indexes (which years have data for each choice) are kept (see utils/availability.py)
+AVAILABILITY_DIR = BASE_DIR / "cache" / "availability"
+
+# where each server worker saves its timing histograms for /metrics to add up (see utils/metrics.py)
+METRICS_DIR = BASE_DIR / "cache" / "metrics"
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -147,6 +261,10 @@ STATICFILES_DIRS = [
     BASE_DIR / "static/js",
 ]
 STATIC_BASE = BASE_DIR / "static"
+# How long browsers may use their copy of a static file before checking back
+# in *seconds*. Kept short since static URLs aren't versioned, checking back
+# is cheap anyways (a 304 Not Modified when the file didn't change)
+STATIC_MAX_AGE = 10 * 60
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -171,6 +289,11 @@ LOGGING = {
         "default": {
             "format": "[{asctime}] {levelname} (File:{filename} Function:{funcName} Line:{lineno}) {message}",
             "style": "{" # '{' to format above string
+        },
+        # the messages are already JSON (see Mexer/middleware.py)
+        "metrics": {
+            "format": '{{"time": "{asctime}", "request": {message}}}',
+            "style": "{"
         }
     },
     "handlers": {
@@ -178,13 +301,24 @@ LOGGING = {
             "class": "logging.FileHandler",
             "filename": "general.log",
             "formatter": "default"
+        },
+        "metrics_file": {
+            "class": "logging.FileHandler",
+            "filename": "metrics.log",
+            "formatter": "metrics"
         }
     },
     "loggers": {
         "Mexer_default": {
             "level": "DEBUG",
             "handlers": ["file"]
-        } 
+        },
+        # one JSON line per request, with how long each stage took
+        "Mexer_metrics": {
+            "level": "INFO",
+            "handlers": ["metrics_file"],
+            "propagate": False
+        }
     }
 }
 
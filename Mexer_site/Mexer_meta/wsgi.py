@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Mexer_meta.settings')
 
 application = get_wsgi_application()
+
+# load the lookup tables (see utils/warmup.py) before taking requests,
+# so no user request has to wait on them. Only done here, where the app is
+# about to serve (gunicorn and uvicorn workers, runserver), not in every process
+# that sets Django up (manage.py commands, plot pool processes, tests).
+# MEXER_PRELOAD=0 turns it off
+if os.environ.get("MEXER_PRELOAD", "1") == "1":
+    from utils.warmup import warm_up
+    warm_up()
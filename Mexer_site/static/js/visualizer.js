@@ -61,13 +61,21 @@ const initialize = () => {
     colorScale = document.getElementById("color-scale");
     menuInputs.push(colorScale);
 
+    yearStack = document.getElementById("year-stack-input");
+    menuInputs.push(yearStack);
+
     labelThreshold = document.getElementById("label-threshold");
     menuInputs.push(labelThreshold)
 
+    flowThreshold = document.getElementById("flow-threshold-input");
+    menuInputs.push(flowThreshold);
+    flowThresholdUnit = document.getElementById("flow-threshold-unit");
+    menuInputs.push(flowThresholdUnit);
+
     // menu setups
-    sankeyMenuInputs = [singleYearInput, labelThreshold];
+    sankeyMenuInputs = [singleYearInput, labelThreshold, flowThreshold, flowThresholdUnit];
     xyMenuInputs = [fromYearInput, toYearInput, efficiencyDropdown, colorBy, lineBy, facetColBy, facetRowBy];
-    matrixMenuInputs = [fromYearInput, toYearInput, matnameDropdown, colorScale];
+    matrixMenuInputs = [fromYearInput, toYearInput, matnameDropdown, colorScale, yearStack];
 
     // have specifics show differently for different plots
     let selectedValue = null; // to be filled in the following loop
@@ -102,6 +110,58 @@ const initialize = () => {
     else {
         startMenuSwitch();
     }
+
+    // keep which choices have data up to date with the form
+    document.getElementById("query-form").addEventListener("change", (event) => {
+        if (availabilityInputs.includes(event.target.name))
+            refreshAvailability();
+        else if (event.target.name === "country")
+            applyAvailability();
+    });
+    refreshAvailability();
+}
+
+// the inputs which choices have data depends on
+const availabilityInputs = ["dataset", "version", "energy_type", "last_stage", "plot_type"];
+
+// country -> years with data for the current choices, null if not known
+let availableYears = null;
+
+/** Ask the server which countries and years have data for the current choices (see /availability) */
+const refreshAvailability = async () => {
+    const form = new FormData(document.getElementById("query-form"));
+    const params = new URLSearchParams();
+    for (let name of availabilityInputs)
+        for (let value of form.getAll(name)) // disabled inputs (e.g. the hidden version dropdown) aren't in the form
+            params.append(name, value);
+
+    try {
+        const response = await fetch("/availability?" + params);
+        const availability = response.ok ? await response.json() : {known: false};
+        availableYears = availability.known ? availability.countries : null;
+    } catch {
+        availableYears = null; // not knowing only means nothing gets disabled
+    }
+
+    applyAvailability();
+}
+
+/** Disable the countries without data and limit the years to the ones the chosen countries have */
+const applyAvailability = () => {
+    const countryDropdowns = document.querySelectorAll('select[name="country"]');
+    for (let dropdown of countryDropdowns)
+        for (let option of dropdown.options)
+            option.disabled = availableYears !== null && !(option.value in availableYears);
+
+    const years = [];
+    if (availableYears !== null)
+        for (let dropdown of countryDropdowns)
+            years.push(...(availableYears[dropdown.value] ?? []));
+
+    for (let yearInput of [singleYearInput, fromYearInput, toYearInput]) {
+        yearInput.min = years.length ? Math.min(...years) : "";
+        yearInput.max = years.length ? Math.max(...years) : "";
+    }
 }
 
 /** Enables an input element and displays its container. */
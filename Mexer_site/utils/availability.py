@@ -0,0 +1,246 @@
+####################################################################
+# availability.py includes the index of which data actually exists
+#
+# Not every dataset has every version, country, energy type and last stage,
+# and not for every year. Rather than find that out with a full query
+# that comes back empty, the availability index keeps, for every
+#   fact table x Dataset x Version x Country x EnergyType x LastStage
+# a bitmap of the years with rows (bit year - FIRST_YEAR is set if that year has data).
+#
+# The index is built from the fact tables (PSUT, AggEtaPFU) with the
+# build_availability management command and written to
+# AVAILABILITY_DIR/<database>.json, which every worker reads.
+# Processes look for a newer file every AVAILABILITY_CHECK_INTERVAL seconds.
+#
+# Each index is stamped with what it was built from (see data_stamp()):
+# the version of the lookup tables and how many rows of the fact tables
+# have been written. Once data is loaded the stamp no longer matches
+# and the index is ignored until the command is run again,
+# so it can never hide new data.
+#
+# It is used to
+#   answer /availability, so the visualizer can disable choices without data
+#   skip queries that can't have any rows (see query_has_data() and utils/data.py)
+#   finish Translator.get_all_available()
+#
+# Until the command has been run for a database (or while its index is out of date)
+# nothing is known, and every query is let through. So is every query for
+# a dataset and version the index doesn't have.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+from time import time
+from django.db import connections
+from Mexer.models import PSUT, AggEtaPFU, AggEtaPFUBase
+from utils.logging import LOGGER
+from utils.shadow_table import quote
+from utils.shared_files import CheckedCache, file_mtime, read_json, write_json
+from utils.translation_snapshot import snapshot_version
+from Mexer_meta.settings import AVAILABILITY_DIR
+
+# fact table name -> its model
+AVAILABILITY_TABLES = {
+    "PSUT": PSUT,
+    "AggEtaPFU": AggEtaPFU,
+}
+
+# the fields every year bitmap is kept for, in order
+AVAILABILITY_FIELDS = ["Dataset", "Version", "Country", "EnergyType", "LastStage"]
+
+# the year of bit 0 in the year bitmaps
+FIRST_YEAR = 1900
+
+# how often (seconds) to look for an index file newer than the one in memory
+AVAILABILITY_CHECK_INTERVAL = 60
+
+# (Country, EnergyType, LastStage) -> bitmap of years
+Combinations = dict[tuple[int, int, int], int]
+
+class AvailabilityIndex:
+    '''Which years have data, for every combination of a database's choices, read-only
+
+    Attributes:
+        database, str: the database the index is of
+        built, float: when the index was built (seconds since the epoch)
+        stamp, dict: what it was built from (see data_stamp())
+        tables, dict: fact table name -> (DatasetID, VersionID) -> Combinations
+        mtime, float: of the file it was read from
+    '''
+
+    def __init__(self, database: str, contents: dict, mtime: float = None):
+        self.database = database
+        self.built: float = contents["built"]
+        self.stamp: dict = contents["stamp"]
+        self.tables: dict[str, dict[tuple[int, int], Combinations]] = {}
+        for table, rows in contents["tables"].items():
+            combinations = self.tables[table] = {}
+            for dataset, version, country, energy_type, last_stage, years in rows:
+                combinations.setdefault((dataset, version), {})[(country, energy_type, last_stage)] = int(years, 16)
+        self.mtime = mtime
+
+    def combinations(self, table: str, dataset: int, version: int) -> Combinations | None:
+        '''Get the year bitmaps of every (Country, EnergyType, LastStage) of a dataset and version with data,
+        None if the index doesn't know the dataset and version (e.g. they were loaded after it was built)'''
+        return self.tables.get(table, {}).get((dataset, version))
+
+    def ids(self, field: str) -> set[int]:
+        '''Get the IDs of a field (Dataset, Version, Country, EnergyType or LastStage) that have data in any table'''
+        if field not in AVAILABILITY_FIELDS:
+            raise ValueError(f"The availability index doesn't have {field}")
+        position = AVAILABILITY_FIELDS.index(field)
+
+        ids = set()
+        for table in self.tables.values():
+            for key, combinations in table.items():
+                if position < 2: # (Dataset, Version)
+                    ids.add(key[position])
+                else: # (Country, EnergyType, LastStage)
+                    ids.update(combination[position - 2] for combination in combinations)
+
+        return ids
+
+def year_mask(first: int, last: int = None) -> int:
+    '''Get the bitmap of every year from first to last (inclusive), or every year from first on if last is None'''
+    first = max(first, FIRST_YEAR)
+    if last is None:
+        return -1 << (first - FIRST_YEAR) # every bit from first up
+    if last < first:
+        return 0
+    return ((1 << (last - first + 1)) - 1) << (first - FIRST_YEAR)
+
+def mask_years(mask: int) -> list[int]:
+    '''Get the years of a bitmap, in order'''
+    years = []
+    while mask:
+        low = mask & -mask # lowest set bit
+        years.append(FIRST_YEAR + low.bit_length() - 1)
+        mask ^= low
+
+    return years
+
+def table_name(model) -> str | None:
+    '''Get the fact table name a model's queries are indexed under, None if it isn't indexed'''
+    if model is PSUT:
+        return "PSUT"
+    if isinstance(model, type) and issubclass(model, AggEtaPFUBase):
+        return "AggEtaPFU" # per dataset summaries have the same rows
+    return None
+
+def query_has_data(target, query: dict) -> bool:
+    '''See if a translated query (see utils/data.py) could have any rows
+
+    Only False when the index is sure there are none, so the query can be skipped.
+    Queries the index can't answer (no index yet, a table it doesn't have,
+    a filter it doesn't know) are always True
+    '''
+    database, model = target
+    if (table := table_name(model)) is None or (index := get_index(database)) is None:
+        return True
+
+    # versions are filtered with ValidFromVersion__gte = ValidToVersion__lte = the version
+    dataset, version = query.get("Dataset"), query.get("ValidFromVersion__gte")
+    countries = __filter_values(query, "Country")
+    energy_types = __filter_values(query, "EnergyType")
+    last_stages = __filter_values(query, "LastStage")
+    if None in (dataset, version, countries, energy_types, last_stages):
+        return True
+
+    if "Year" in query:
+        years = year_mask(query["Year"], query["Year"])
+    else:
+        years = year_mask(query.get("Year__gte", FIRST_YEAR), query.get("Year__lte"))
+
+    if (combinations := index.combinations(table, dataset, version)) is None:
+        return True
+
+    return any(
+        combinations.get((country, energy_type, last_stage), 0) & years
+        for country in countries for energy_type in energy_types for last_stage in last_stages
+    )
+
+def __filter_values(query: dict, field: str) -> list | None:
+    # the values a query filters a field to, None if it doesn't filter it
+    if field in query:
+        return [query[field]]
+    return query.get(field + "__in")
+
+# database name -> the index in memory, None if there is no usable one
+__indexes = CheckedCache(AVAILABILITY_CHECK_INTERVAL)
+
+def index_path(database: str):
+    return AVAILABILITY_DIR / f"{database}.json"
+
+def get_index(database: str) -> AvailabilityIndex | None:
+    '''Get the availability index of a database, None if it hasn't been built or is out of date'''
+    return __indexes.get(database, lambda current: __load(database, current))
+
+def data_stamp(database: str) -> dict:
+    '''Get what an index of a database would be built from now:
+    the version of its lookup tables (see utils/translation_snapshot.py) and how many rows
+    of each fact table (and its partitions) have been inserted, updated or deleted
+    '''
+    writes = {}
+    with connections[database].cursor() as cursor:
+        for name, model in AVAILABILITY_TABLES.items():
+            cursor.execute(
+                "SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0) FROM pg_stat_user_tables "
+                "WHERE relid IN (SELECT relid FROM pg_partition_tree(%s::regclass))",
+                [quote(model._meta.db_table)]
+            )
+            writes[name] = int(cursor.fetchone()[0])
+
+    return dict(snapshot = snapshot_version(database), writes = writes)
+
+def write_index(database: str, tables: dict[str, list[tuple]], stamp: dict) -> AvailabilityIndex:
+    '''Save a newly built availability index for every worker to read
+
+    Inputs:
+        database, str: the database the index is of
+        tables, dict: fact table name -> rows of (DatasetID, VersionID, CountryID, EnergyTypeID, LastStageID, year bitmap)
+        stamp, dict: data_stamp() from before the tables were read
+    '''
+    contents = dict(
+        built = time(),
+        stamp = stamp,
+        tables = {
+            table: [[*combination, format(years, "x")] for *combination, years in rows]
+            for table, rows in tables.items()
+        },
+    )
+
+    index = AvailabilityIndex(database, contents, write_json(index_path(database), contents))
+    __indexes.set(database, index)
+    return index
+
+def __load(database: str, current: AvailabilityIndex | None) -> AvailabilityIndex | None:
+    # the index in memory, or the file if it changed, as long as it is of the data there is now
+    index = current
+    if index is None or file_mtime(index_path(database)) != index.mtime:
+        index = __read(database)
+    if index is None:
+        return None
+
+    try:
+        stamp = data_stamp(database)
+    except Exception as e:
+        LOGGER.error(f"Couldn't check the {database} availability index is up to date, not using it: {e}")
+        return None
+
+    if stamp != index.stamp:
+        LOGGER.warning(f"The {database} availability index is out of date, not using it until build_availability is run again")
+        return None
+
+    return index
+
+def __read(database: str) -> AvailabilityIndex | None:
+    path = index_path(database)
+    if (read := read_json(path, "availability index")) is None:
+        return None
+
+    try:
+        return AvailabilityIndex(database, *read)
+    except (KeyError, TypeError, ValueError) as e:
+        LOGGER.warning(f"Ignoring unreadable availability index {path}: {e}")
+        return None
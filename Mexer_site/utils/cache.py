@@ -0,0 +1,279 @@
+####################################################################
+# cache.py includes the caching of finished results made from the databases
+#
+# PSUT and AggEtaPFU data only change when a database is loaded,
+# so anything built from a query (like sankey JSON) can be kept
+# and handed back the next time the same query comes in.
+#
+# Results are stored in one of the Django caches in Mexer_meta/settings.py
+# and are keyed by the database, the model, and the translated query.
+#
+# Invalidation is done with "generations". Every key also includes the
+# generation of the query's dataset and version. Invalidating a dataset
+# or version gives it a new generation, so all the old keys are never
+# looked up again (and are eventually culled by the cache itself).
+# See the invalidate_cache management command.
+# Generations must never be culled, so they aren't kept in the Django
+# caches but in a file per cache in CACHE_GENERATIONS_DIR,
+# read again by every process whenever it changes.
+#
+# Hit and miss counts are kept in memory, per server worker
+# (like the histograms in utils/metrics.py), so counting costs nothing.
+#
+# DataFrames (like xy plot data) are too big for the Django caches,
+# so FrameCache keeps them as files on local disk instead, throwing
+# out the least recently used files when they take up too much space.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import os
+import json
+import pandas as pd
+from pathlib import Path
+from threading import Lock
+from time import time_ns
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from django.core.cache import caches
+from utils.logging import LOGGER
+from utils.shared_files import file_lock, file_mtime, read_json, write_json
+from Mexer_meta.settings import CACHE_GENERATIONS_DIR, XY_FRAME_CACHE_DIR, XY_FRAME_CACHE_MAX_BYTES
+
+# pyarrow is optional, DataFrames are stored as parquet with it and pickles without
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+class ResultCache:
+    '''A cache of results keyed by translated queries
+
+    Inputs:
+        name, str: the name of the Django cache (in settings.CACHES) to store results in,
+            also the name of its generations file
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = Lock() # the counts and generations are shared by every request's thread
+        self._counts = {"hits": 0, "misses": 0}
+        # the generations file as last read: (when it was last changed, database -> tag -> generation)
+        self._generations_read = (None, {})
+
+    @property
+    def _cache(self):
+        # looked up every time, Django caches are per thread
+        return caches[self.name]
+
+    @staticmethod
+    def _generation_tags(query: dict) -> list[str]:
+        # everything is in the "all" generation
+        # then the more specific dataset and version generations
+        tags = ["all"]
+        if (dataset := query.get("Dataset")) is not None:
+            tags.append(f"dataset:{dataset}")
+        if (version := query.get("ValidFromVersion__gte")) is not None:
+            tags.append(f"version:{version}")
+        return tags
+
+    def _generations_path(self) -> Path:
+        return CACHE_GENERATIONS_DIR / f"{self.name}.json"
+
+    def _all_generations(self) -> dict:
+        # database -> tag -> generation, read again only when the file changes
+        path = self._generations_path()
+        mtime = file_mtime(path)
+        if mtime is None:
+            # no file (e.g. the cache directory was cleared), start a new "all" generation
+            # so nothing cached before it can be mistaken for current
+            self._write_generations(lambda generations: None)
+            mtime = file_mtime(path)
+
+        with self._lock:
+            read_mtime, generations = self._generations_read
+            if mtime != read_mtime and (read := read_json(path, "cache generations")) is not None:
+                generations, read_mtime = read
+                self._generations_read = (read_mtime, generations)
+            return generations
+
+    def _write_generations(self, change):
+        # change(database -> tag -> generation) the generations file, one process at a time
+        path = self._generations_path()
+        with file_lock(path.with_suffix(".lock")):
+            read = read_json(path, "cache generations")
+            generations = read[0] if read is not None else {"*": time_ns()}
+            change(generations)
+            write_json(path, generations)
+
+    def _generations(self, database: str, query: dict) -> list[int]:
+        generations = self._all_generations()
+        # "*" is the generation of the file itself, new whenever it has to be made again
+        database_generations = generations.get(database, {})
+        return [generations.get("*", 0), *(database_generations.get(tag, 0) for tag in self._generation_tags(query))]
+
+    def key(self, database: str, model_name: str, query: dict, **extra) -> str:
+        '''Make the key for a query's result
+
+        Inputs:
+            database, str: the database the query is for
+            model_name, str: the model the query is for
+            query, dict: the translated query (see translate_query())
+            extra: anything else that changes the result, e.g. options
+
+        Outputs:
+            a string key to use with get() and set()
+        '''
+
+        # normalize the query so the same query always makes the same key
+        # order of lists doesn't matter for __in lookups
+        normalized = {
+            k: sorted(v) if isinstance(v, (list, tuple, set)) else v
+            for k, v in query.items()
+        }
+
+        raw = json.dumps(
+            [database, model_name, normalized, extra, self._generations(database, query)],
+            sort_keys = True, default = str
+        )
+        return f"result:{sha256(raw.encode()).hexdigest()}"
+
+    def _count(self, stat: str):
+        with self._lock:
+            self._counts[stat] += 1
+
+    def get(self, key: str):
+        '''Get a cached result, or None if it isn't cached'''
+        result = self._cache.get(key)
+        self._count("hits" if result is not None else "misses")
+        return result
+
+    def set(self, key: str, result):
+        '''Cache a result under a key made by key()'''
+        self._cache.set(key, result, timeout = None)
+
+    def invalidate(self, database: str, dataset: int = None, version: int = None):
+        '''Make cached results go stale
+
+        Inputs:
+            database, str: the database whose results should go stale
+            dataset, int: only results for this dataset ID
+            version, int: only results for this version ID
+            If neither dataset nor version is given, every result for the database goes stale
+        '''
+
+        tags = []
+        if dataset is not None:
+            tags.append(f"dataset:{dataset}")
+        if version is not None:
+            tags.append(f"version:{version}")
+
+        def change(generations):
+            for tag in tags or ["all"]:
+                generations.setdefault(database, {})[tag] = time_ns()
+        self._write_generations(change)
+
+        LOGGER.info(f"Invalidated {self.name} cache for {database} {tags or 'all'}")
+
+    def stats(self) -> dict:
+        '''Get the hit and miss counts of the cache (for this server worker)'''
+        with self._lock:
+            hits, misses = self._counts["hits"], self._counts["misses"]
+        return dict(
+            hits = hits,
+            misses = misses,
+            hit_ratio = hits / (hits + misses) if hits + misses else None,
+        )
+
+class FrameCache(ResultCache):
+    '''A cache of DataFrames keyed by translated queries, stored as files on local disk
+
+    Keys, invalidation, and stats work like ResultCache,
+    only the DataFrames themselves are kept as files instead of in a Django cache
+
+    Inputs:
+        name, str: the name of the cache, for its generations file and in stats
+        directory, Path: where to keep the DataFrame files
+        max_bytes, int: how many bytes of files to keep, the least recently used go first
+    '''
+
+    suffix = ".parquet" if pyarrow is not None else ".pkl"
+
+    def __init__(self, name: str, directory: Path, max_bytes: int):
+        super().__init__(name)
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> Path:
+        return self.directory / (key.removeprefix("result:") + self.suffix)
+
+    def get(self, key: str) -> pd.DataFrame | None:
+        '''Get a cached DataFrame, or None if it isn't cached'''
+        path = self._path(key)
+        try:
+            df = pd.read_parquet(path) if pyarrow is not None else pd.read_pickle(path)
+            os.utime(path) # mark as the most recently used
+        except FileNotFoundError:
+            df = None
+        except Exception as e:
+            # a broken file is just a miss, get rid of it so it gets remade
+            LOGGER.warning(f"Couldn't read cached DataFrame {path.name}: {e}")
+            path.unlink(missing_ok = True)
+            df = None
+
+        self._count("hits" if df is not None else "misses")
+        return df
+
+    def set(self, key: str, df: pd.DataFrame):
+        '''Cache a DataFrame under a key made by key()'''
+        self.directory.mkdir(parents = True, exist_ok = True)
+
+        # write to a temporary file then move it into place
+        # so no other process ever reads a half written file
+        with NamedTemporaryFile(dir = self.directory, suffix = ".tmp", delete = False) as f:
+            if pyarrow is not None:
+                df.to_parquet(f, index = False)
+            else:
+                df.to_pickle(f)
+        os.replace(f.name, self._path(key))
+
+        self._evict()
+
+    def _files(self) -> list[tuple[float, int, Path]]:
+        # (last used time, size, path) of every cached file, files can be removed by other processes at any time
+        files = []
+        for path in self.directory.glob("*" + self.suffix):
+            try:
+                file_stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((file_stat.st_mtime, file_stat.st_size, path))
+        return files
+
+    def _evict(self):
+        # throw out the least recently used files until everything fits
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok = True)
+            total -= size
+
+    def stats(self) -> dict:
+        '''Get the hit and miss counts of the cache and how much is in it'''
+        files = self._files()
+        return dict(
+            super().stats(),
+            files = len(files),
+            bytes = sum(size for _, size, _ in files),
+            max_bytes = self.max_bytes,
+        )
+
+SANKEY_CACHE = ResultCache("sankey")
+XY_CACHE = FrameCache("xy", XY_FRAME_CACHE_DIR, XY_FRAME_CACHE_MAX_BYTES)
+
+# every result cache, for anything that needs to go through all of them
+# e.g. invalidation after a database load
+RESULT_CACHES = [SANKEY_CACHE, XY_CACHE]
@@ -0,0 +1,160 @@
+####################################################################
+# copy_reader.py includes the functions to read query results with COPY
+#
+# Fetching rows through a cursor makes Python objects for every value
+# of every row before they end up in NumPy arrays or DataFrames.
+# Instead, the query is run as
+#   COPY (SELECT ...) TO STDOUT (FORMAT binary)
+# and the binary stream is read straight into NumPy arrays:
+# every column is cast to a fixed size type, so every row of the stream
+# has the same layout, and the whole stream is one big-endian structured array.
+#
+# Rows with NULLs don't have that fixed layout, and not every type
+# has a fixed size (text), so those results are read as CSV instead.
+#
+# Parameters are merged into the query by the database driver,
+# so they are quoted properly (COPY can't take bound parameters).
+#
+# Works with both psycopg 3 and psycopg2 connections.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+from io import BytesIO
+import numpy as np
+import pandas as pd
+
+# the PostgreSQL type each NumPy type is read as
+PG_TYPES = {
+    np.dtype(np.int16): "smallint",
+    np.dtype(np.int32): "integer",
+    np.dtype(np.int64): "bigint",
+    np.dtype(np.float64): "double precision",
+    np.dtype(np.bool_): "boolean",
+}
+
+# start of every binary COPY stream
+BINARY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+def copy_out(connection, sql: str, params, copy_format: str) -> bytes:
+    '''Run a query with COPY ... TO STDOUT and get everything it sent
+
+    Inputs:
+        connection: a DB-API connection (psycopg 3 or psycopg2), e.g. from utils.data.raw_connection()
+        sql, str: a SELECT with %s placeholders, e.g. from utils.data._query_sql()
+        params: the values of the placeholders
+        copy_format, str: "binary" or "csv"
+    '''
+    copy_sql = f"COPY ({sql}) TO STDOUT (FORMAT {copy_format})"
+    with connection.cursor() as cursor:
+        if hasattr(cursor, "copy"): # psycopg 3
+            with cursor.copy(copy_sql, params) as copy:
+                return b"".join(copy)
+        else: # psycopg2
+            out = BytesIO()
+            cursor.copy_expert(cursor.mogrify(copy_sql, params).decode(), out)
+            return out.getvalue()
+
+def parse_binary(stream: bytes, dtype: np.dtype) -> np.ndarray | None:
+    '''Read a binary COPY stream of fixed size columns into a structured array
+
+    Inputs:
+        stream, bytes: everything a binary COPY sent
+        dtype, np.dtype: the structured type of a row, every field's type in PG_TYPES
+
+    Outputs:
+        the rows as an array of dtype, or None if a row doesn't fit it (e.g. it has a NULL)
+    '''
+    if stream[:len(BINARY_SIGNATURE)] != BINARY_SIGNATURE:
+        raise ValueError("Not a binary COPY stream")
+
+    # header: signature, flags (int32), header extension length (int32) and extension
+    extension_length = int.from_bytes(stream[15:19], "big")
+    body = memoryview(stream)[19 + extension_length:-2] # -2 for the trailer (int16 -1)
+
+    # each row: field count (int16), then each field's length (int32) and value
+    fields = [("field count", ">i2")]
+    for name in dtype.names:
+        fields += [(f"{name} length", ">i4"), (name, dtype[name].newbyteorder(">"))]
+    row_dtype = np.dtype(fields)
+
+    if len(body) % row_dtype.itemsize != 0:
+        return None
+
+    rows = np.frombuffer(body, dtype = row_dtype)
+    if (rows["field count"] != len(dtype.names)).any() or any(
+        (rows[f"{name} length"] != dtype[name].itemsize).any() for name in dtype.names
+    ):
+        return None
+
+    data = np.empty(len(rows), dtype = dtype)
+    for name in dtype.names:
+        data[name] = rows[name]
+
+    return data
+
+def parse_csv(stream: bytes, names: list[str]) -> pd.DataFrame:
+    '''Read a CSV COPY stream into a DataFrame, pandas works out the column types and NULLs become NaN
+
+    Inputs:
+        stream, bytes: everything a CSV COPY sent
+        names, list[str]: the column names
+    '''
+    return pd.read_csv(
+        BytesIO(stream), names = names, header = None,
+        true_values = ["t"], false_values = ["f"], keep_default_na = False, na_values = [""],
+    )
+
+def copy_arrays(connection, sql: str, params, dtype: np.dtype) -> np.ndarray:
+    '''Get the results of a query as a structured array, through a binary COPY
+
+    Falls back to a CSV COPY if the results don't fit the fixed layout (e.g. NULLs),
+    NULLs then become NaN. Only float fields can hold NaN, so integer and boolean
+    fields with NULLs come back as float64 instead (like pandas' read_sql_query gives them)
+
+    Inputs:
+        connection: a DB-API connection (psycopg 3 or psycopg2)
+        sql, str: a SELECT with %s placeholders, its columns in the order of dtype's fields
+        params: the values of the placeholders
+        dtype, np.dtype: the structured type of a row, every field's type in PG_TYPES
+
+    Outputs:
+        a structured array with one field per column, e.g. data["i"], data["value"]
+    '''
+    # cast every column so its size is known, whatever the table's column types are
+    columns = ", ".join(
+        f'"copied"."{i}"::{PG_TYPES[dtype[name]]}' for i, name in enumerate(dtype.names)
+    )
+    column_names = ", ".join(f'"{i}"' for i in range(len(dtype.names)))
+    cast_sql = f'SELECT {columns} FROM ({sql}) AS "copied"({column_names})'
+
+    data = parse_binary(copy_out(connection, cast_sql, params, "binary"), dtype)
+    if data is None:
+        df = parse_csv(copy_out(connection, sql, params, "csv"), list(dtype.names))
+        data = np.empty(len(df), dtype = np.dtype([
+            (name, np.float64 if dtype[name].kind != "f" and df[name].isna().any() else dtype[name])
+            for name in dtype.names
+        ]))
+        for name in dtype.names:
+            data[name] = df[name].to_numpy(dtype = data.dtype[name])
+
+    return data
+
+def copy_dataframe(connection, sql: str, params, names: list[str], dtype: np.dtype = None) -> pd.DataFrame:
+    '''Get the results of a query as a DataFrame, through a COPY
+
+    If every column's type is known (dtype is given), the binary COPY of copy_arrays() is used,
+    otherwise a CSV COPY (and pandas works out the column types)
+
+    Inputs:
+        connection: a DB-API connection (psycopg 3 or psycopg2)
+        sql, str: a SELECT with %s placeholders
+        params: the values of the placeholders
+        names, list[str]: the column names
+        dtype, np.dtype: the structured type of a row, every field's type in PG_TYPES, or None
+    '''
+    if dtype is not None:
+        return pd.DataFrame(copy_arrays(connection, sql, params, dtype), columns = names)
+
+    return parse_csv(copy_out(connection, sql, params, "csv"), names)
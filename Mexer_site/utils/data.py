@@ -20,31 +20,119 @@
 #   shape_post_request(ret_database_target = True)
 # And is passed to the "get" functions
 #
+# xy plot queries go to a dataset's summary of AggEtaPFU
+# when it has one (see utils/xy_summaries.py)
+#
+# Filters are written so PostgreSQL can skip the partitions
+# of partitioned tables (see _pruning_predicates())
+#
+# Queries the availability index knows have no rows (see utils/availability.py)
+# come back empty without going to the database
+#
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
-from Mexer.models import models, PSUT, IEAData, AggEtaPFU
+from Mexer.models import models, PSUT, IEAData, AggEtaPFU, AggEtaPFUBase
+import io
+from os import environ
+from time import perf_counter
 import pandas as pd
+import numpy as np
+from itertools import islice
+from contextlib import contextmanager
 from utils.logging import LOGGER
-from utils.misc import Silent
-import pandas.io.sql as pd_sql  # for getting data into a pandas dataframe
+from utils.copy_reader import copy_arrays, copy_dataframe
+from utils.availability import query_has_data
+from utils.metrics import stage
 from django.db import connections
 from utils.translator import Translator
+from utils.xy_summaries import available_summaries, summary_model
 from Mexer_meta.settings import DATABASES, SANDBOX_PREFIX
 
+# xlsxwriter is optional, Excel downloads are only available with it
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+# pyarrow is optional, Parquet and Arrow downloads are only available with it
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 DatabaseTarget = tuple[str, models.Model]
 
+# How many rows to pull from a server-side cursor at a time
+# when streaming data out (see iter_translated_chunks())
+# Memory use while streaming is bounded by this, not by the size of the result
+DATA_CHUNK_SIZE = 50_000
+
+# Most rows an Excel sheet can have (see write_xlsx_from_query()), counting the header
+XLSX_MAX_ROWS = 1_048_576
+
+# Excel workbooks are built whole before any of the download can be sent
+# (see write_xlsx_from_query()), and a sync gunicorn worker is killed if a request
+# takes longer than its timeout (120 seconds, see Mexer_meta/gunicorn_conf.py).
+# So a workbook stops at this many rows or after this many seconds of writing
+# (leaving time to finish the file), whichever comes first, and says so in a "Truncated" sheet.
+# All of the data can always be downloaded as CSV, Parquet or Arrow
+XLSX_MAX_EXPORT_ROWS = int(environ.get("MEXER_XLSX_MAX_ROWS", 1_000_000))
+XLSX_MAX_SECONDS = float(environ.get("MEXER_XLSX_MAX_SECONDS", 60))
+
+# Which NumPy type each kind of model field is fetched as
+FIELD_DTYPES = {
+    "PositiveSmallIntegerField": np.int16,
+    "SmallIntegerField": np.int16,
+    "IntegerField": np.int32,
+    "BooleanField": np.bool_,
+    "FloatField": np.float64,
+}
+
 def _get_database_target(query: dict) -> DatabaseTarget:
     dataset = query.get("dataset")
+    database = "sandbox" if dataset.startswith(SANDBOX_PREFIX) else "default"
 
     plot_type = query.get("plot_type")
     if plot_type == "xy_plot":
-        model = AggEtaPFU
+        model = _get_xy_model(database, dataset.removeprefix(SANDBOX_PREFIX))
     else:
         model = IEAData if dataset == "IEAEWEB2022" else PSUT
     
-    return "sandbox" if dataset.startswith(SANDBOX_PREFIX) else "default", model
+    return database, model
+
+def _get_xy_model(database: str, dataset: str) -> type[AggEtaPFUBase]:
+    # use the dataset's summary if it has one (see utils/xy_summaries.py)
+    try:
+        dataset_id = Translator(database).dataset_translate(dataset)
+    except KeyError:
+        return AggEtaPFU # let translate_query() complain about the unknown dataset
+
+    if dataset_id in available_summaries(database):
+        return summary_model(dataset_id)
+
+    return AggEtaPFU
+
+def _pruning_predicates(query: dict) -> dict:
+    '''Write a translated query's filters in the form PostgreSQL can prune partitions with
+
+    Partitioned tables (see the partition_table command) are only skipped
+    when the planner can match a filter's values against the partition bounds:
+        a one value __in becomes plain equality (Country = 5, not Country IN (5))
+        __in values are deduplicated and sorted, so the same choices always make the same SQL
+    Other filters are left as they are
+    '''
+    pruned = {}
+    for key, value in query.items():
+        if key.endswith("__in") and isinstance(value, (list, tuple, set)):
+            value = sorted(set(value))
+            if len(value) == 1:
+                key, value = key.removesuffix("__in"), value[0]
+        pruned[key] = value
+
+    return pruned
 
 def _query_database(target: DatabaseTarget, query: dict, values: list[str]):
     db = target[0]
@@ -57,80 +145,437 @@ def _query_database(target: DatabaseTarget, query: dict, values: list[str]):
         model.objects
         .using(db)
         .values_list(*values)
-        .filter(**query)
+        .filter(**_pruning_predicates(query))
     )
 
     LOGGER.debug(f"Query is {query}")
 
     return data
 
+def _query_database_chunks(target: DatabaseTarget, query: dict, values: list[str], chunk_size: int = DATA_CHUNK_SIZE):
+    '''Lazily get the results of a query as DataFrames of at most chunk_size rows
+
+    .iterator() makes Django use a server-side cursor, so only one chunk
+    of the result is ever held in memory at a time
+    '''
+    if not query_has_data(target, query):
+        return # no rows, see utils/availability.py
+
+    rows = _query_database(target, query, values).iterator(chunk_size = chunk_size)
+
+    while chunk := list(islice(rows, chunk_size)):
+        yield pd.DataFrame.from_records(chunk, columns = values)
+
+def _query_sql(target: DatabaseTarget, query: dict, values: list[str]) -> tuple[str, tuple]:
+    '''Get the SQL (and its parameters) Django would run for a query, to run it ourselves'''
+    db = target[0]
+    model = target[1]
+
+    if not _valid_database(db):
+        raise ValueError("Unknown database specified for query")
+
+    queryset = model.objects.using(db).values_list(*values).filter(**_pruning_predicates(query))
+    return queryset.query.get_compiler(using = db).as_sql()
+
+def _fetch_dtype(model, values: list[str]) -> np.dtype | None:
+    '''Get the NumPy structured type of rows of a model's values, None if one of them has no fixed size type'''
+    types = [FIELD_DTYPES.get(model._meta.get_field(v).get_internal_type()) for v in values]
+    if None in types:
+        return None
+
+    return np.dtype(list(zip(values, types)))
+
+def _fetch_arrays(target: DatabaseTarget, query: dict, values: list[str]) -> np.ndarray:
+    '''Get the results of a query as a NumPy structured array
+
+    The query is run as a binary COPY and the stream is read straight
+    into the array (see utils/copy_reader.py), so no Python object
+    per value is ever made like with a queryset
+
+    Inputs:
+        target, DatabaseTarget: where to run the query
+        query, dict: a translated query (see translate_query())
+        values, list[str]: the fields to get, each becomes a field of the array
+
+    Outputs:
+        a structured array with one field per value, e.g. data["i"], data["value"]
+    '''
+    if (dtype := _fetch_dtype(target[1], values)) is None:
+        raise ValueError(f"Not every one of {values} is a number field")
+
+    if not query_has_data(target, query):
+        return np.empty(0, dtype = dtype) # no rows, see utils/availability.py
+
+    sql, params = _query_sql(target, query, values)
+    with stage("fetch") as measured, raw_connection(target[0]) as connection:
+        data = copy_arrays(connection, sql, params, dtype)
+        measured.rows, measured.nbytes = len(data), data.nbytes
+
+    LOGGER.debug(f"Query is {query}")
+
+    return data
+
 def _valid_database(database_name: str):
     return database_name in DATABASES.keys()
 
+@contextmanager
+def raw_connection(database: str):
+    '''Borrow the thread's plain DB-API connection to a database, e.g. for pandas' read_sql_query or a COPY
+
+    It is the thread's usual Django connection (taken from the database's pool
+    if pooling is on, see DATABASES in settings.py), not another one,
+    so a thread never holds more than one connection to a database
+
+    Example:
+        with raw_connection("default") as connection:
+            df = pd.read_sql_query(sql, connection)
+    '''
+    django_connection = connections[database]
+    django_connection.ensure_connection()
+    yield django_connection.connection
+
 def get_dataframe(target: DatabaseTarget, query: dict, columns: list) -> pd.DataFrame:
     if not _valid_database(target[0]):
         return pd.DataFrame() # empty data frame if database is wrong
     
-    # get the data from database
-    db_query = target[1].objects.filter(**query).values(*columns).query
-    with Silent():
-        df = pd_sql.read_sql_query(
-            str(db_query),
-            con=connections[target[0]].cursor().connection # get the connection associated with the requested database
-        )
+    if not query_has_data(target, query):
+        return pd.DataFrame(columns = columns) # no rows, see utils/availability.py
+
+    # get the data from database, typed columns straight from a COPY (see utils/copy_reader.py)
+    sql, params = _query_sql(target, query, columns)
+    with stage("fetch") as measured, raw_connection(target[0]) as connection:
+        df = copy_dataframe(connection, sql, params, columns, _fetch_dtype(target[1], columns))
+        measured.rows, measured.nbytes = len(df), int(df.memory_usage(index = False).sum())
+
+    LOGGER.debug(f"Query is {query}")
 
     return df
 
 META_COLUMNS = ["Dataset", "ValidFromVersion", "ValidToVersion", "Country", "Method", "EnergyType", "LastStage", "IncludesNEU", "Year", "ChoppedMat", "ChoppedVar", "ProductAggregation", "IndustryAggregation"]
 PSUT_COLUMNS = ["matname", "i", "j", "value"]
 AGGETA_COLUMNS = ["GrossNet", "EXp", "EXf", "EXu", "etapf", "etafu", "etapu"]
+
+# Which translation (see Translator.get_id_map()) each column holding IDs uses
+TRANSLATE_COLUMNS = {
+    'Dataset': 'dataset',
+    'ValidFromVersion': 'version',
+    'ValidToVersion': 'version',
+    'Country': 'country',
+    'Method': 'method',
+    'EnergyType': 'energytype',
+    'LastStage': 'laststage',
+    'ChoppedMat': 'matname',
+    'ChoppedVar': 'index',
+    'ProductAggregation': 'agglevel',
+    'IndustryAggregation': 'agglevel',
+    'matname': 'matname',
+    'GrossNet': 'grossnet',
+    'i': 'index',
+    'j': 'index'
+}
+
+def translate_dataframe(df: pd.DataFrame, database: str) -> pd.DataFrame:
+    '''Turn the IDs in a DataFrame from the given database into human readable values
+
+    Only columns known to hold IDs are translated, any other column is left alone
+    '''
+
+    translator = Translator(database) # get a translator for the correct database
+
+    with stage("translate") as measured:
+        measured.rows = len(df)
+
+        # Translate each column that exists in the DataFrame all at once
+        # with its whole ID -> name mapping, rather than cell by cell
+        for col, attribute in TRANSLATE_COLUMNS.items():
+            if col in df.columns:
+                translated = df[col].map(translator.get_id_map(attribute))
+
+                # same as translating a single value, an unknown ID is an error
+                unknown = translated.isna() & df[col].notna()
+                if unknown.any():
+                    raise KeyError("Unrecognized key '" + str(df[col][unknown].iloc[0]) + "' for " + attribute)
+
+                df[col] = translated
+
+        # Handle IncludesNEU separately as it's a boolean
+        if 'IncludesNEU' in df.columns:
+            df['IncludesNEU'] = df['IncludesNEU'].astype(bool).map({True: 'Yes', False: 'No'})
+    
+    return df
+
 def get_translated_dataframe(target: DatabaseTarget, query: dict, columns: list) -> pd.DataFrame:
     df = get_dataframe(target, query, columns)
 
     # no need to do work if dataframe is empty (no data was found for the query)
     if df.empty: return df
 
-    translator = Translator(target[0]) # get a translator for the correct database
-    
-    # Translate the DataFrame's column names
-    translate_columns = {
-        'Dataset': translator.dataset_translate,
-        'ValidFromVersion': translator.version_translate,
-        'ValidToVersion': translator.version_translate,
-        'Country': translator.country_translate,
-        'Method': translator.method_translate,
-        'EnergyType': translator.energytype_translate,
-        'LastStage': translator.laststage_translate,
-        'ChoppedMat': translator.matname_translate,
-        'ChoppedVar': translator.index_translate,
-        'ProductAggregation': translator.agglevel_translate,
-        'IndustryAggregation': translator.agglevel_translate,
-        'matname': translator.matname_translate,
-        'grossnet': translator.grossnet_translate,
-        'i': translator.index_translate,
-        'j': translator.index_translate
-    }
-
-    # Apply the translation functions to each column if it exists in the DataFrame
-    for col, translate_func in translate_columns.items():
-        if col in df.columns:
-            df[col] = df[col].apply(translate_func)
-    
-    # Handle IncludesNEU separately as it's a boolean
-    if 'IncludesNEU' in df.columns:
-        df['IncludesNEU'] = df['IncludesNEU'].apply(lambda x: 'Yes' if x else 'No')
-    
-    return df
+    return translate_dataframe(df, target[0])
+
+def iter_translated_chunks(target: DatabaseTarget, query: dict, columns: list, chunk_size: int = DATA_CHUNK_SIZE):
+    '''Like get_translated_dataframe(), but yields the result in translated chunks
+
+    Use this for anything that can be written out incrementally (i.e. downloads)
+    so the full result set never has to be in memory at once
+    '''
+    if not _valid_database(target[0]):
+        return # nothing to give if database is wrong
+
+    for chunk in _query_database_chunks(target, query, columns, chunk_size):
+        yield translate_dataframe(chunk, target[0])
 
 def get_csv_from_query(target: DatabaseTarget, query: dict, columns: list):
     
     # index false to not have column of row numbers
     return get_translated_dataframe(target, query, columns).to_csv(index=False)
 
-def get_excel_from_query(target: DatabaseTarget, query: dict, columns = PSUT_COLUMNS):
+def stream_csv_from_query(target: DatabaseTarget, query: dict, columns: list):
+    '''Generator of CSV text for a query, made to be given to a StreamingHttpResponse
 
-    # index false to not have column of row numbers
-    return get_translated_dataframe(target, query, columns).to_excel(index=False)
+    The header is sent first and straight away,
+    then each chunk of rows as it comes from the database
+    '''
+
+    # header on its own so the first bytes go out before the query finishes
+    yield pd.DataFrame(columns = columns).to_csv(index=False)
+
+    for chunk in iter_translated_chunks(target, query, columns):
+        with stage("serialize") as measured:
+            # index false to not have column of row numbers
+            text = chunk.to_csv(index=False, header=False)
+            measured.rows, measured.nbytes = len(chunk), len(text)
+        yield text
+
+def write_xlsx_from_query(target: DatabaseTarget, query: dict, columns: list, file, sheet_by: str = None,
+                          max_rows: int = XLSX_MAX_EXPORT_ROWS, max_seconds: float = XLSX_MAX_SECONDS) -> bool:
+    '''Write the data of a query into an Excel workbook, chunk by chunk as it is read from the database
+
+    The workbook is write-only (xlsxwriter's constant_memory mode): each row goes
+    to a temporary file as soon as the next one starts, so memory use is bounded
+    by the chunk size, not the size of the result.
+    A sheet that runs out of rows carries on in a new one, e.g. "Data", "Data (2)"
+
+    Writing stops after max_rows rows or max_seconds seconds (see XLSX_MAX_EXPORT_ROWS),
+    and a "Truncated" sheet at the front says where the data was cut off
+
+    Inputs:
+        target, DatabaseTarget: where to run the query
+        query, dict: a translated query (see translate_query())
+        columns, list: the columns to give
+        file: a path or binary file to write the .xlsx to
+        sheet_by, str: a column whose values each get their own sheet (e.g. matname), None for one sheet
+        max_rows, int: the most rows to write
+        max_seconds, float: the longest to spend writing rows
+
+    Outputs:
+        bool: whether every row was written
+    '''
+    if xlsxwriter is None:
+        raise RuntimeError("Excel downloads need xlsxwriter installed")
+
+    # NaN values become #NUM! cells instead of stopping the download
+    workbook = xlsxwriter.Workbook(file, {"constant_memory": True, "nan_inf_to_errors": True})
+
+    # sheet key (a sheet_by value) -> [worksheet, its next row, how many sheets of the key there are]
+    sheets = {}
+    sheet_names = set() # in lower case, Excel doesn't let two sheets differ only by case
+
+    def next_sheet(key):
+        sheet = sheets.get(key)
+        part = sheet[2] + 1 if sheet is not None else 1
+        name = _xlsx_sheet_name(key if sheet_by else "Data", part, sheet_names)
+        worksheet = workbook.add_worksheet(name)
+        worksheet.write_row(0, 0, columns)
+        sheets[key] = [worksheet, 1, part]
+        return sheets[key]
+
+    written, complete, t0 = 0, True, perf_counter()
+    chunks = iter_translated_chunks(target, query, columns)
+    for chunk in chunks:
+        if perf_counter() - t0 > max_seconds:
+            complete = False
+            break
+        if written + len(chunk) > max_rows:
+            complete = False
+            chunk = chunk.iloc[:max_rows - written]
+
+        with stage("serialize") as measured:
+            measured.rows = len(chunk)
+            groups = chunk.groupby(sheet_by, sort = False) if sheet_by else [(None, chunk)]
+            for key, rows in groups:
+                sheet = sheets.get(key) or next_sheet(key)
+                for row in rows.itertuples(index = False, name = None):
+                    if sheet[1] == XLSX_MAX_ROWS:
+                        sheet = next_sheet(key)
+                    sheet[0].write_row(sheet[1], 0, row)
+                    sheet[1] += 1
+            written += len(chunk)
+
+        if not complete:
+            break
+    chunks.close() # stop reading from the database if it was cut off
+
+    # a workbook needs at least one sheet
+    if not sheets:
+        next_sheet(None)
+
+    if not complete:
+        LOGGER.warning(f"Excel download cut off after {written} rows ({perf_counter() - t0:.0f}s)")
+        note = workbook.add_worksheet(_xlsx_sheet_name("Truncated", 1, sheet_names))
+        note.write_column(0, 0, [
+            f"This workbook only has the first {written} rows of the data, it was too big to make as an Excel file.",
+            "Download the data as CSV, Parquet or Arrow to get all of it, or choose less data.",
+        ])
+        note.activate() # open on the note
+        note.set_first_sheet()
+
+    workbook.close()
+    return complete
+
+def _xlsx_sheet_name(key, part: int, taken: set[str]) -> str:
+    # Excel sheet names are at most 31 characters, without []:*?/\
+    name = "".join(" " if c in "[]:*?/\\" else c for c in str(key)).strip() or "Data"
+    suffix = f" ({part})" if part > 1 else ""
+    name = name[:31 - len(suffix)] + suffix
+
+    # the same name after cleaning (e.g. "a/b" and "a:b"), number it
+    unique, n = name, 1
+    while unique.lower() in taken:
+        n += 1
+        unique = name[:31 - len(f"~{n}")] + f"~{n}"
+    taken.add(unique.lower())
+
+    return unique
+
+# Types of columnar downloads (see stream_columnar_from_query())
+# -> (MIME type, file extension)
+COLUMNAR_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.file", "arrow"),
+}
+
+def stream_columnar_from_query(target: DatabaseTarget, query: dict, columns: list, data_format: str = "parquet"):
+    '''Generator of a Parquet or Arrow IPC file of a query's data, made to be given to a StreamingHttpResponse
+
+    Unlike a CSV, the columns keep their types, so the file loads (e.g. into pandas or R) without parsing:
+        columns holding IDs are dictionary-encoded, with every name of their lookup table
+        as the dictionary (the same for every chunk, so they load as one categorical column)
+        IncludesNEU is a boolean, Year and the values keep their number types
+
+    Each chunk from the database becomes one Parquet row group (or Arrow record batch),
+    sent as soon as it is written, so memory use is bounded by the chunk size
+
+    Inputs:
+        target, DatabaseTarget: where to run the query
+        query, dict: a translated query (see translate_query())
+        columns, list: the columns to give
+        data_format, str: parquet or arrow (see COLUMNAR_FORMATS)
+    '''
+    if pa is None:
+        raise RuntimeError("Parquet and Arrow downloads need pyarrow installed")
+    if data_format not in COLUMNAR_FORMATS:
+        raise ValueError(f"Unknown columnar format {data_format}")
+    if not _valid_database(target[0]):
+        return # nothing to give if database is wrong
+
+    schema, dictionaries = _columnar_schema(target, columns)
+
+    # the writer writes into sink, whatever it wrote is sent after each chunk
+    sink = _StreamSink()
+    if data_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression = "zstd")
+    else:
+        writer = pa.ipc.new_file(sink, schema, options = pa.ipc.IpcWriteOptions(compression = "zstd"))
+
+    with writer:
+        for chunk in _query_database_chunks(target, query, columns):
+            with stage("serialize") as measured:
+                table = _columnar_table(chunk, schema, dictionaries)
+                if data_format == "parquet":
+                    writer.write_table(table, row_group_size = len(table))
+                else:
+                    writer.write_table(table, max_chunksize = len(table))
+                data = sink.take()
+                measured.rows, measured.nbytes = len(chunk), len(data)
+            yield data
+
+    # the footer is written when the writer closes
+    yield sink.take()
+
+def _columnar_schema(target: DatabaseTarget, columns: list) -> tuple:
+    '''Get the Arrow schema of a columnar download, and the dictionary of each dictionary-encoded column
+
+    Outputs:
+        the schema, and a dict of column -> (its lookup table's IDs in order, their names as an Arrow array)
+    '''
+    translator = Translator(target[0])
+
+    fields, dictionaries = [], {}
+    for column in columns:
+        if attribute := TRANSLATE_COLUMNS.get(column):
+            id_map = translator.get_id_map(attribute)
+            ids = np.array(sorted(id_map), dtype = np.int64)
+            dictionaries[column] = (ids, pa.array([id_map[id] for id in ids.tolist()], type = pa.string()))
+            fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+        elif column == "IncludesNEU":
+            fields.append(pa.field(column, pa.bool_()))
+        elif dtype := FIELD_DTYPES.get(target[1]._meta.get_field(column).get_internal_type()):
+            fields.append(pa.field(column, pa.from_numpy_dtype(dtype)))
+        else:
+            fields.append(pa.field(column, pa.string()))
+
+    return pa.schema(fields), dictionaries
+
+def _columnar_table(chunk: pd.DataFrame, schema, dictionaries: dict):
+    '''Turn a chunk of IDs from the database into an Arrow table of the schema (see _columnar_schema())'''
+    arrays = []
+    for field in schema:
+        values = chunk[field.name].to_numpy()
+        nulls = pd.isna(values) # NULLs stay null, they aren't IDs or values
+        if field.name in dictionaries:
+            # each ID's place in the lookup table is its index into the dictionary
+            ids, names = dictionaries[field.name]
+            known = values[~nulls]
+            positions = np.zeros(len(values), dtype = np.int64)
+            positions[~nulls] = np.searchsorted(ids, known).clip(max = max(len(ids) - 1, 0))
+
+            # same as translating, an unknown ID is an error
+            unknown = ids[positions[~nulls]] != known if len(ids) else np.ones(len(known), dtype = bool)
+            if unknown.any():
+                raise KeyError("Unrecognized key '" + str(known[unknown][0]) + "' for " + TRANSLATE_COLUMNS[field.name])
+
+            indices = pa.array(positions, type = pa.int32(), mask = nulls if nulls.any() else None)
+            arrays.append(pa.DictionaryArray.from_arrays(indices, names))
+        elif pa.types.is_boolean(field.type):
+            arrays.append(pa.array(np.where(nulls, False, values).astype(bool), mask = nulls if nulls.any() else None))
+        else:
+            arrays.append(pa.array(values, type = field.type, from_pandas = True))
+
+    return pa.Table.from_arrays(arrays, schema = schema)
+
+class _StreamSink(io.RawIOBase):
+    '''A write-only file that keeps what is written until it is taken, so a file can be sent as it is made'''
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self) -> bytes:
+        '''Get everything written since it was last taken'''
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
 
 def shape_post_request(
     payload, ret_plot_type = False, ret_database_target = False
@@ -6,20 +6,51 @@
 # The queue (really a list, but treated like a queue) stores
 # MAX_HISTORY number of previous queries in it
 #
+# Histories are stored server side as JSON (the PlotHistory model, in the users database),
+# the user only gets a cookie with the ID of their history
+#
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
-import pickle
 import json
+from datetime import timedelta
+from time import monotonic
+from uuid import uuid4
+from django.utils import timezone
+from Mexer.models import PlotHistory
 
 # Maximum number of items to keep in the user's history
-# Can't be too big because too many in history
-# Will overflow the cookie size limit
-MAX_HISTORY = 5
+MAX_HISTORY = 200
+
+# The cookie only holds an ID for the user's history,
+# the history itself is kept server side in the PlotHistory table
+HISTORY_COOKIE = "history_id"
+
+# How long a history (and its cookie) is kept after it was last changed
+# in *seconds*
+HISTORY_TTL = 30 * 24 * 60 * 60
+
+# How often expired histories are deleted, at most
+# in *seconds*
+HISTORY_EXPIRE_INTERVAL = 60 * 60
+
+# when this process last deleted expired histories
+__expired_at = None
+
+# old cookie that held the whole pickled history
+LEGACY_HISTORY_COOKIE = "user_history"
+
+def _get_history_id(request) -> str | None:
+    history_id = request.COOKIES.get(HISTORY_COOKIE)
+
+    # ignore anything that isn't an ID we could have made
+    if history_id and len(history_id) == 32 and all(c in "0123456789abcdef" for c in history_id):
+        return history_id
+    return None
 
 def get_user_history(request) -> list:
-    """Retrieve the user's plot history from cookies.
+    """Retrieve the user's plot history from the history store.
 
     Inputs:
         request: The HTTP request object containing cookies.
@@ -27,15 +58,62 @@ def get_user_history(request) -> list:
     Outputs:
         list: The user's plot history, or an empty list if no history exists.
     """
-    # Get the serialized user history from cookies
-    serialized_data = request.COOKIES.get('user_history')
+    history_id = _get_history_id(request)
+    if not history_id:
+        return list() # Return an empty list if no history exists
 
-    if serialized_data:
-        user_history = pickle.loads(bytes.fromhex(serialized_data)) # Deserialize the data if it exists
-    else:
-        user_history = list() # Return an empty list if no history exists
+    # expired histories may not have been deleted yet
+    stored = PlotHistory.objects.filter(history_id=history_id, updated__gte=_expiry()).first()
+
+    return stored.history if stored is not None else list()
+
+def save_user_history(request, user_history: list) -> str:
+    """Save a user's plot history to the history store.
+
+    Inputs:
+        request: The HTTP request object.
+        user_history (list): The whole history to save.
+
+    Outputs:
+        str: The ID of the user's history, to be given back in a cookie (see set_history_cookie()).
+    """
+    # give the user a new history if they don't have one yet
+    history_id = _get_history_id(request) or uuid4().hex
+
+    PlotHistory.objects.update_or_create(history_id=history_id, defaults={"history": user_history})
+    _delete_expired()
+
+    return history_id
+
+def _expiry():
+    # histories last changed before this have expired
+    return timezone.now() - timedelta(seconds=HISTORY_TTL)
+
+def _delete_expired():
+    # delete expired histories, at most every HISTORY_EXPIRE_INTERVAL seconds
+    global __expired_at
+    if __expired_at is not None and monotonic() - __expired_at < HISTORY_EXPIRE_INTERVAL:
+        return
+    __expired_at = monotonic()
+
+    PlotHistory.objects.filter(updated__lt=_expiry()).delete()
+
+def set_history_cookie(request, response, history_id: str):
+    """Give the user their history ID.
+
+    The cookie is sent every time the history is saved,
+    so it expires HISTORY_TTL after the history was last changed, like the history itself.
+
+    Inputs:
+        request: The HTTP request object.
+        response: The HTTP response to put the cookie on.
+        history_id (str): The ID from save_user_history().
+    """
+    response.set_cookie(HISTORY_COOKIE, history_id, max_age=HISTORY_TTL, httponly=True, samesite="Lax")
 
-    return user_history
+    # get rid of the old whole-history cookie so it stops being sent
+    if LEGACY_HISTORY_COOKIE in request.COOKIES:
+        response.delete_cookie(LEGACY_HISTORY_COOKIE)
 
 def update_user_history(request, plot_type, query):
     """Update the user's plot history with a new plot query.
@@ -46,7 +124,7 @@ def update_user_history(request, plot_type, query):
         query (dict): The query parameters for the plot.
 
     Outputs:
-        bytes: Serialized updated user history.
+        str: The ID of the user's updated history (see set_history_cookie()).
     """
     # Get the current user history
     user_history = get_user_history(request)
@@ -74,9 +152,8 @@ def update_user_history(request, plot_type, query):
         # If user_history is empty, append the new history_data
         user_history.append(history_data)
 
-    # Serialize the updated user history
-    serialized_data = pickle.dumps(user_history)
-    return serialized_data
+    # Save the updated user history
+    return save_user_history(request, user_history)
 
 from django.urls import reverse
 def get_history_html(user_history: list[dict]) -> str:
@@ -0,0 +1,76 @@
+####################################################################
+# index_registry.py contains the in memory copy of the Index table
+#
+# The Index table holds every row/column label of the PSUT matrices.
+# Matrices need its size (the matrix dimension) and plots need
+# each index's name, order, and sankey color, so it is loaded once per database
+# and kept as NumPy arrays. The arrays are indexed by IndexID, so
+# whole arrays of IDs (e.g. coo_matrix.row) can be looked up at once:
+#   IndexRegistry(database).names[mat.row]
+#
+# Like the Translator, it is made from the database's translation snapshot
+# (see utils/translation_snapshot.py), and remade when the snapshot changes.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import numpy as np
+from utils.logging import LOGGER
+from utils.translation_snapshot import get_snapshot, TranslationSnapshot
+
+class IndexRegistry:
+    # A dictionary where keys are database names and
+    # values are tuples of snapshot versions and the table made from that snapshot
+    # the table is a dict of the registry's attributes (see __make_table)
+    __tables: dict[str: tuple[str, dict]] = {}
+
+    def __init__(self, database: str):
+        self._db = database
+
+        table = IndexRegistry.__load_table(database)
+
+        # number of rows (and columns) in a PSUT matrix
+        self.dimension: int = table["dimension"]
+        # IndexID -> Order, -1 for IDs not in the table
+        self.orders: np.ndarray = table["orders"]
+        # IndexID -> Index name, None for IDs not in the table
+        self.names: np.ndarray = table["names"]
+        # IndexID -> sankey color of the index as an energy carrier, None if it has none
+        self.colors: np.ndarray = table["colors"]
+
+    @staticmethod
+    def __load_table(database: str) -> dict:
+        # remake the table if the snapshot changed since it was made
+        snapshot = get_snapshot(database)
+        entry = IndexRegistry.__tables.get(database)
+        if entry is None or entry[0] != snapshot.version:
+            entry = IndexRegistry.__tables[database] = (snapshot.version, IndexRegistry.__make_table(snapshot))
+
+        return entry[1]
+
+    @staticmethod
+    def __make_table(snapshot: TranslationSnapshot) -> dict:
+        LOGGER.info(f"Making {snapshot.database}:Index registry from snapshot {snapshot.version}")
+
+        ids, names = zip(*snapshot.tables["Index"].inverse.items())
+        ids = np.array(ids)
+
+        # arrays big enough to be indexed by any ID in the table
+        size = ids.max() + 1
+        order_lookup = np.full(size, -1, dtype=np.int32)
+        order_lookup[ids] = [snapshot.index_orders[id] for id in ids.tolist()]
+        name_lookup = np.full(size, None, dtype=object)
+        name_lookup[ids] = names
+
+        # work out sankey colors once here, instead of for every sankey node
+        from utils.sankey import sankey_color # not at the top, utils.sankey uses the registry
+        color_lookup = np.full(size, None, dtype=object)
+        color_lookup[ids] = [sankey_color(name) for name in names]
+
+        return dict(
+            dimension = len(ids),
+            orders = order_lookup,
+            names = name_lookup,
+            colors = color_lookup,
+        )
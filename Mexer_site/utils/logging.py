@@ -1,7 +1,8 @@
 ####################################################################
 # logging.py includes all functions related to logging
 # 
-# It is 2 lines. It gives developers a logger to use called LOGGER.
+# It gives developers a logger to use called LOGGER.
+# METRICS_LOGGER is for the metrics log, one JSON line per request (see Mexer/middleware.py)
 #
 # The logging format is defined in Mexer_meta/settings.py
 #
@@ -14,4 +15,5 @@
 #####################
 import logging
 
-LOGGER = logging.getLogger("Mexer_default")
\ No newline at end of file
+LOGGER = logging.getLogger("Mexer_default")
+METRICS_LOGGER = logging.getLogger("Mexer_metrics")
@@ -5,16 +5,19 @@
 # and turn those matricies into HTML to display
 #
 # The matricies are represented by scipy's sparse coo_matrix
+# A range of years can also be gotten as a "stack",
+# a dict of year -> scipy csr_matrix (see get_matrix_stack())
 # 
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
-import plotly.graph_objects as pgo
-from scipy.sparse import coo_matrix
-from utils.data import _query_database, DatabaseTarget
-from Mexer.models import PSUT, Index
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from utils.data import _fetch_arrays, DatabaseTarget
 from utils.translator import Translator
+from utils.index_registry import IndexRegistry
+from utils.metrics import stage
 
 def get_matrix(target: DatabaseTarget, query: dict) -> coo_matrix:
     '''Collects, constructs, and returns one of the RUVY matrices
@@ -29,71 +32,119 @@ def get_matrix(target: DatabaseTarget, query: dict) -> coo_matrix:
 
     # Get the sparse matrix representation
     # i, j, x for row, column, value
-    # in 3-tuples
-    sparse_matrix = _query_database(target, query, ["i", "j", "value"])
+    # as one array each
+    sparse_matrix = _fetch_arrays(target, query, ["i", "j", "value"])
 
     # if nothing was returned
-    if not sparse_matrix:
+    if len(sparse_matrix) == 0:
         return None
 
     # Get dimensions for a matrix (rows and columns will be the same)
-    # len() would evaluate the query set, so use count() instead for better performance
-    matrix_nrow = Index.objects.all().count()
-
-    # For each 3-tuple in sparse_matrix
-    # Put together all the first values, all the second, etc.
-    # All first values across the tupes are rows, second are columns, etc.
-    row, col, val = zip(*sparse_matrix)
+    matrix_nrow = IndexRegistry(target[0]).dimension
 
     # Make and return the sparse matrix
     return coo_matrix(
-        (val, (row, col)),
+        (sparse_matrix["value"], (sparse_matrix["i"], sparse_matrix["j"])),
         shape=(matrix_nrow, matrix_nrow),
     )
 
 def get_ruvy_matrix(target: DatabaseTarget, query: dict) -> tuple:
-    sparse_matrix = _query_database(target, query, ["i", "j", "value", "matname"])
-    if not sparse_matrix:
+    sparse_matrix = _fetch_arrays(target, query, ["i", "j", "value", "matname"])
+    if len(sparse_matrix) == 0:
         return None, None
-    matrix_nrow = Index.objects.all().count()
-    row, col, val, matname = zip(*sparse_matrix)
+    matrix_nrow = IndexRegistry(target[0]).dimension
     mat = coo_matrix(
-        (val, (row, col)),
+        (sparse_matrix["value"], (sparse_matrix["i"], sparse_matrix["j"])),
         shape=(matrix_nrow, matrix_nrow),
     )
 
-    return mat, matname
+    return mat, sparse_matrix["matname"]
+
+def get_matrix_stack(target: DatabaseTarget, query: dict) -> dict[int, csr_matrix]:
+    '''Collects one of the RUVY matrices for every year of a query, all in one query
+
+    Inputs:
+        a query ready to hit the database, i.e. translated as neccessary (see translate_query())
+        normally a range of years (Year__gte and Year__lte)
+
+    Outputs:
+        A dict of year -> scipy csr_matrix for that year, in order of year
+        or None if the given query related to no data 
+    '''
+
+    sparse_matrix = _fetch_arrays(target, query, ["Year", "i", "j", "value"])
+    if len(sparse_matrix) == 0:
+        return None
+
+    matrix_nrow = IndexRegistry(target[0]).dimension
+
+    # group the rows by year
+    # then each group is one year's matrix
+    sparse_matrix = sparse_matrix[np.argsort(sparse_matrix["Year"], kind="stable")]
+    years, year_starts = np.unique(sparse_matrix["Year"], return_index=True)
+
+    return {
+        int(year): coo_matrix(
+            (year_matrix["value"], (year_matrix["i"], year_matrix["j"])),
+            shape=(matrix_nrow, matrix_nrow),
+        ).tocsr() # csr sums any duplicates
+        for year, year_matrix in zip(years, np.split(sparse_matrix, year_starts[1:]))
+    }
 
 import altair as alt
 import pandas as pd
-def visualize_matrix(target: DatabaseTarget, mat: coo_matrix, matnames: list = None ,color_scale: str = 'inferno', coloring_method: str = 'weight') -> pgo.Figure:
-    """Visualize a sparse matrix as a heatmap using Plotly.
+def _matrix_frame(registry: IndexRegistry, mat: coo_matrix) -> dict:
+    # columns to be used in dataframe
+    # the registry arrays are indexed by ID, so look up all rows and columns at once
+    return {
+        'x': registry.names[mat.col],
+        'y': registry.names[mat.row],
+        'value': mat.data,
+        'x_order': registry.orders[mat.col],
+        'y_order': registry.orders[mat.row]
+    }
+
+def _heatmap(df: pd.DataFrame, colors: str, tooltip: list, color_scale: alt.Scale) -> alt.Chart:
+    return alt.Chart(df).mark_rect(stroke='blue', strokeWidth=1).encode(
+            x=alt.X('x', axis=alt.Axis(orient='top', labelAngle=-45, title=""), sort=alt.EncodingSortField(field='x_order', order='ascending')),
+            y=alt.Y('y', axis=alt.Axis(title=""), sort=alt.EncodingSortField(field='y_order', order='ascending')),
+            color=alt.Color(
+                colors, 
+                scale=color_scale
+            ),
+            tooltip=tooltip
+        )
+
+@stage("translate")
+def get_matrix_frame(target: DatabaseTarget, mat: coo_matrix, matnames = None, coloring_method: str = 'weight') -> pd.DataFrame:
+    """Get the data to plot for a sparse matrix, with human readable labels.
 
     Inputs:
         mat (coo_matrix): A scipy sparse matrix in COOrdinate format.
-        color_scale (str, optional): The color scale to use for the heatmap. Defaults to 'viridis'.
+        matnames: the matname ID of each entry of mat, for coloring by matrix (see get_ruvy_matrix())
+        coloring_method (str, optional): 'ruvy' to color by matrix, anything else colors by weight.
 
     Outputs:
-        pgo.Figure: A Plotly graph object Figure containing the heatmap.
+        pd.DataFrame: one row per entry of the matrix (see matrix_chart())
     """
-    
+
     translator = Translator(target[0]) # get a translator for the correct database
+    registry = IndexRegistry(target[0]) # names and orders of the indices in the correct database
     
-    # Create a dictionary mapping index IDs to their orders.
-    index_orders = {id: order for id, order in Index.objects.values_list("IndexID", "Order")}
+    frame_columns = _matrix_frame(registry, mat)
     
-    # columns to be used in dataframe
-    frame_columns = {
-        'x': [translator.index_translate(col) for col in mat.col],
-        'y': [translator.index_translate(row) for row in mat.row],
-        'value': mat.data,
-        'x_order': [index_orders[col] for col in mat.col],
-        'y_order': [index_orders[row] for row in mat.row]
-    }
+    if coloring_method == 'ruvy' and matnames is not None:
+        frame_columns.update({'matname': pd.Series(matnames).map(translator.get_id_map('matname'))})
+    
+    return pd.DataFrame(frame_columns)
+
+def matrix_chart(df: pd.DataFrame, color_scale: str = 'inferno') -> alt.Chart:
+    """Make a heatmap from the data of get_matrix_frame().
+
+    Colored by matrix if the data has matnames, otherwise by weight.
+    """
     
-    # Create a Plotly Heatmap object
-    if coloring_method == 'ruvy' and matnames:
-        frame_columns.update({'matname': [translator.matname_translate(i) for i in matnames]})
+    if 'matname' in df.columns:
         tooltip = [
                 alt.Tooltip('y', title='From'),
                 alt.Tooltip('x', title='To'),
@@ -106,16 +157,98 @@ def visualize_matrix(target: DatabaseTarget, mat: coo_matrix, matnames: list = N
                 alt.Tooltip('x', title='To'),
                 alt.Tooltip('value')]
         colors = 'value:Q'
-    
-    df = pd.DataFrame(frame_columns)
         
-    heatmap = alt.Chart(df).mark_rect(stroke='blue', strokeWidth=1).encode(
-            x=alt.X('x', axis=alt.Axis(orient='top', labelAngle=-45, title=""), sort=alt.EncodingSortField(field='x_order', order='ascending')),
-            y=alt.Y('y', axis=alt.Axis(title=""), sort=alt.EncodingSortField(field='y_order', order='ascending')),
-            color=alt.Color(
-                colors, 
-                scale=alt.Scale(scheme=color_scale)
-            ),
-            tooltip=tooltip
-        )
-    return heatmap
\ No newline at end of file
+    heatmap = _heatmap(df, colors, tooltip, alt.Scale(scheme=color_scale))
+    return heatmap
+
+def visualize_matrix(target: DatabaseTarget, mat: coo_matrix, matnames = None ,color_scale: str = 'inferno', coloring_method: str = 'weight') -> alt.Chart:
+    """Visualize a sparse matrix as a heatmap using Altair.
+
+    Inputs:
+        mat (coo_matrix): A scipy sparse matrix in COOrdinate format.
+        color_scale (str, optional): The color scale to use for the heatmap. Defaults to 'inferno'.
+
+    Outputs:
+        alt.Chart: An Altair Chart containing the heatmap.
+    """
+    
+    return matrix_chart(get_matrix_frame(target, mat, matnames, coloring_method), color_scale)
+
+@stage("translate")
+def get_matrix_stack_frame(target: DatabaseTarget, stack: dict[int, csr_matrix]) -> pd.DataFrame:
+    """Get the data to plot for a stack of matrices (see get_matrix_stack()), with human readable labels.
+
+    Outputs:
+        pd.DataFrame: one row per entry of each matrix, with a year column (see matrix_stack_chart())
+    """
+
+    registry = IndexRegistry(target[0]) # names and orders of the indices in the correct database
+
+    frames = []
+    for year, mat in stack.items():
+        frame = pd.DataFrame(_matrix_frame(registry, mat.tocoo()))
+        frame['year'] = year
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+def matrix_stack_chart(df: pd.DataFrame, color_scale: str = 'inferno') -> alt.Chart:
+    """Make one heatmap with a year slider from the data of get_matrix_stack_frame().
+
+    All years are in the one chart, so stepping through years happens
+    in the browser without any more requests.
+    """
+
+    years = sorted(df['year'].unique().tolist())
+    year_slider = alt.param(
+        name='selected_year',
+        value=years[0],
+        bind=alt.binding_range(min=years[0], max=years[-1], step=1, name='Year ')
+    )
+
+    tooltip = [
+            alt.Tooltip('y', title='From'),
+            alt.Tooltip('x', title='To'),
+            alt.Tooltip('value'),
+            alt.Tooltip('year')]
+
+    # keep the same colors for the same values across every year
+    # so years can be compared while stepping through them
+    color_domain = [float(df['value'].min()), float(df['value'].max())]
+
+    heatmap = _heatmap(df, 'value:Q', tooltip, alt.Scale(scheme=color_scale, domain=color_domain))
+    return heatmap.add_params(year_slider).transform_filter(alt.datum.year == year_slider)
+
+def visualize_matrix_stack(target: DatabaseTarget, stack: dict[int, csr_matrix], color_scale: str = 'inferno') -> alt.Chart:
+    """Visualize a stack of matrices (see get_matrix_stack()) as one heatmap with a year slider.
+
+    Inputs:
+        stack (dict): year -> sparse matrix of that year
+        color_scale (str, optional): The color scale to use for the heatmap. Defaults to 'inferno'.
+
+    Outputs:
+        alt.Chart: the heatmap, showing the year picked on its slider
+    """
+
+    return matrix_stack_chart(get_matrix_stack_frame(target, stack), color_scale)
+
+@stage("figure")
+def render_matrix_html(df: pd.DataFrame, title: str, color_scale: str = 'inferno', stacked: bool = False) -> str:
+    """Make the heatmap for matrix data and render it as HTML with the given title.
+
+    Needs no database, so it can be run in another process (see utils/plot_pool.py)
+
+    Inputs:
+        df: data from get_matrix_frame() or, if stacked, get_matrix_stack_frame()
+    """
+
+    heatmap = matrix_stack_chart(df, color_scale) if stacked else matrix_chart(df, color_scale)
+    heatmap = heatmap.properties(
+        title=title,
+        autosize = {"type": "fit", "contains": "padding"}
+    )
+
+    with stage("serialize") as measured:
+        html = heatmap.to_html()
+        measured.rows, measured.nbytes = len(df), len(html)
+
+    return html
@@ -0,0 +1,285 @@
+####################################################################
+# metrics.py includes everything for measuring how long making plots and data takes
+#
+# A request goes through stages (getting data from the database,
+# translating it, building the figure, serializing it), each timed with stage():
+#
+#   with stage("fetch") as s:
+#       data = ...
+#       s.rows = len(data)      # optional
+#       s.nbytes = data.nbytes  # optional
+#
+# or as a decorator, @stage("figure"), which only times.
+# Stages can be inside other stages, e.g. a figure's serialize stage
+# is part of its figure stage.
+#
+# Every stage's time, rows and bytes go into histograms, shown in
+# Prometheus' text format on /metrics (see Mexer/views/monitoring.py).
+# The stages of each request are also collected (see start_request())
+# and written to the metrics log by Mexer/middleware.py, one JSON line per request.
+#
+# Each server worker (and each plot pool process) has its own histograms,
+# stages run in the plot pool are sent back with the result (see utils/plot_pool.py).
+# So /metrics covers every worker, not just the one answering it, each worker
+# saves its histograms to METRICS_DIR/<pid>.json after its requests
+# (see save_metrics(), at most every METRICS_SAVE_INTERVAL seconds)
+# and render_metrics() adds up every worker's file. A worker that exits
+# cleanly saves what it has left (see flush_metrics()), then, however it
+# exited (even killed), gunicorn's master folds its file into
+# METRICS_DIR/archive.json (see archive_metrics() and Mexer_meta/gunicorn_conf.py)
+# before its pid can be used again, so the totals never go down while the server runs.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import os
+import shutil
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+from threading import Lock, Timer
+from time import monotonic, perf_counter
+from utils.shared_files import file_lock, read_json, write_json
+from Mexer_meta.settings import METRICS_DIR
+
+# upper bounds of the histograms' buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+ROWS_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+BYTES_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+# how often (seconds) a worker saves its histograms at most
+METRICS_SAVE_INTERVAL = 1
+
+# where the histograms of workers that have exited are kept
+ARCHIVE_PATH = METRICS_DIR / "archive.json"
+
+class Histogram:
+    '''Counts of observed values in buckets, per set of labels, like a Prometheus histogram
+
+    Inputs:
+        name, str: the metric's name, e.g. mexer_stage_seconds
+        description, str: what it measures
+        buckets, tuple: the buckets' upper bounds, in order
+    '''
+
+    def __init__(self, name: str, description: str, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._lock = Lock() # observed from every request's thread
+        # labels -> [count per bucket (the last for values past every bound), sum, count]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if (series := self._series.get(key)) is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def series(self) -> dict[tuple, list]:
+        '''Get a copy of every series, labels -> [count per bucket, sum, count]'''
+        with self._lock:
+            return {key: [list(counts), total, count] for key, (counts, total, count) in self._series.items()}
+
+    def render(self, series: dict[tuple, list] = None) -> list[str]:
+        '''Get the lines of the histogram (or of the given series of it) in Prometheus' text format'''
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        if series is None:
+            series = self.series()
+
+        for key, (counts, total, count) in sorted(series.items()):
+            labels = ",".join(f'{label}="{_escape(value)}"' for label, value in key)
+            cumulative = 0
+            for bound, bucket_count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels + "," if labels else ""}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+
+        return lines
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+STAGE_SECONDS = Histogram("mexer_stage_seconds", "Time taken by each stage of making plots and data", SECONDS_BUCKETS)
+STAGE_ROWS = Histogram("mexer_stage_rows", "Rows handled by each stage", ROWS_BUCKETS)
+STAGE_BYTES = Histogram("mexer_stage_bytes", "Bytes made by each stage", BYTES_BUCKETS)
+REQUEST_SECONDS = Histogram("mexer_request_seconds", "Time taken to answer requests", SECONDS_BUCKETS)
+RESPONSE_BYTES = Histogram("mexer_response_bytes", "Size of responses (not counting streamed ones)", BYTES_BUCKETS)
+
+HISTOGRAMS = [STAGE_SECONDS, STAGE_ROWS, STAGE_BYTES, REQUEST_SECONDS, RESPONSE_BYTES]
+
+# the stages of the request being answered, as dicts (see record())
+# threads made with sync_to_async get a copy of the context, so they add to the same list
+_request_stages: ContextVar[list | None] = ContextVar("request_stages", default = None)
+
+def start_request():
+    '''Start collecting the stages of a request
+
+    Outputs:
+        a token to give finish_request()
+    '''
+    return _request_stages.set([])
+
+def finish_request(token) -> list[dict]:
+    '''Stop collecting the stages of a request
+
+    Outputs:
+        the stages the request went through, in the order they finished
+    '''
+    stages = _request_stages.get()
+    _request_stages.reset(token)
+    return stages or []
+
+def record(name: str, seconds: float, rows: int = None, nbytes: int = None):
+    '''Record that a stage ran'''
+    STAGE_SECONDS.observe(seconds, stage = name)
+    if rows is not None:
+        STAGE_ROWS.observe(rows, stage = name)
+    if nbytes is not None:
+        STAGE_BYTES.observe(nbytes, stage = name)
+
+    if (stages := _request_stages.get()) is not None:
+        stages.append(dict(stage = name, seconds = round(seconds, 6), rows = rows, bytes = nbytes))
+
+class stage:
+    '''Time a stage of a request, as a context manager or decorator (see the top of this file)
+
+    Inputs:
+        name, str: the stage, e.g. "fetch", "translate", "figure", "serialize"
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = None
+        self.nbytes = None
+
+    def __enter__(self):
+        self._t0 = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.name, perf_counter() - self._t0, self.rows, self.nbytes)
+        return False
+
+    def __call__(self, func):
+        # a new stage every call, so calls at the same time don't share a start time
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def timed(*args, **kwargs):
+                with stage(self.name):
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def timed(*args, **kwargs):
+                with stage(self.name):
+                    return func(*args, **kwargs)
+
+        return timed
+
+# when this process last saved its histograms, and the save waiting to happen if there is one
+__saved_at = 0.0
+__save_timer = None
+__save_lock = Lock()
+
+def save_metrics():
+    '''Save this process' histograms for render_metrics() to add up, called after every request
+
+    Saves at most every METRICS_SAVE_INTERVAL seconds,
+    what comes in before then is saved once the interval is up
+    '''
+    global __save_timer
+    with __save_lock:
+        if __save_timer is not None:
+            return # already waiting to save
+
+        wait = __saved_at + METRICS_SAVE_INTERVAL - monotonic()
+        if wait > 0:
+            __save_timer = Timer(wait, __timed_save)
+            __save_timer.daemon = True
+            __save_timer.start()
+            return
+
+    __save()
+
+def flush_metrics():
+    '''Save this process' histograms now, and drop any save waiting to happen, e.g. as a worker exits'''
+    global __save_timer
+    with __save_lock:
+        if __save_timer is not None:
+            __save_timer.cancel()
+            __save_timer = None
+    __save()
+
+def __timed_save():
+    global __save_timer
+    with __save_lock:
+        __save_timer = None
+    __save()
+
+def __save():
+    global __saved_at
+    with __save_lock:
+        __saved_at = monotonic()
+    write_json(__process_path(os.getpid()), __dump({histogram.name: histogram.series() for histogram in HISTOGRAMS}))
+
+def render_metrics() -> str:
+    '''Get every histogram, added up over every worker (see the top of this file), in Prometheus' text format'''
+    __save()
+    totals = {histogram.name: {} for histogram in HISTOGRAMS}
+    with file_lock(METRICS_DIR / "archive.lock"): # so a worker isn't counted in both its file and the archive
+        for path in METRICS_DIR.glob("*.json"):
+            if (read := read_json(path, "metrics")) is not None:
+                __add(totals, __load(read[0]))
+
+    return "\n".join(line for histogram in HISTOGRAMS for line in histogram.render(totals[histogram.name])) + "\n"
+
+def archive_metrics(pid: int):
+    '''Fold the saved histograms of a process that has exited into the archive
+
+    Only call it once the process is gone, so it can't save again afterwards
+    '''
+    path = __process_path(pid)
+    with file_lock(METRICS_DIR / "archive.lock"):
+        if (read := read_json(path, "metrics")) is None:
+            return
+
+        totals = {histogram.name: {} for histogram in HISTOGRAMS}
+        if (archive := read_json(ARCHIVE_PATH, "metrics archive")) is not None:
+            __add(totals, __load(archive[0]))
+        __add(totals, __load(read[0]))
+
+        write_json(ARCHIVE_PATH, __dump(totals))
+        os.unlink(path)
+
+def clear_metrics():
+    '''Forget every saved histogram, e.g. when the server starts'''
+    shutil.rmtree(METRICS_DIR, ignore_errors = True)
+
+def __process_path(pid: int):
+    return METRICS_DIR / f"{pid}.json"
+
+def __dump(totals: dict) -> dict:
+    # histogram name -> labels -> series to JSON, which has no tuple keys
+    return {name: [[list(key), *values] for key, values in series.items()] for name, series in totals.items()}
+
+def __load(contents: dict) -> dict:
+    return {name: {tuple(map(tuple, key)): values for key, *values in series} for name, series in contents.items()}
+
+def __add(totals: dict, other: dict):
+    # add the series of other into totals, both histogram name -> labels -> series
+    for name, series in other.items():
+        if name not in totals:
+            continue # a histogram that has since been removed
+        for key, (counts, total, count) in series.items():
+            if (into := totals[name].get(key)) is None:
+                totals[name][key] = [list(counts), total, count]
+            else:
+                into[0] = [a + b for a, b in zip(into[0], counts)]
+                into[1] += total
+                into[2] += count
@@ -12,25 +12,21 @@
 #          Edom Maru - eam43@calvin.edu
 #####################
 
-from time import time
 def time_view(v):
     '''Wrapper to time how long it takes to deliver a view
 
+    The time is recorded as the stage "view <name>" (see utils/metrics.py),
+    so it shows up on /metrics and in the metrics log
+
     Inputs:
-        v, function: the view to time
+        v, function: the view to time, can be sync or async
 
     Outputs:
-        A function which wil prints how long the given view took to run
+        The view, timed
     '''
+    from utils.metrics import stage
 
-    def wrap(*args, **kwargs):
-        t0 = time()
-        ret = v(*args, **kwargs)
-        t1 = time()
-        print(f"Time to run {v.__name__}: {t1 - t0}")
-        return ret
-
-    return wrap
+    return stage(f"view {v.__name__}")(v)
 
 import sys
 from os import devnull
@@ -0,0 +1,113 @@
+####################################################################
+# option_catalog.py includes the catalog of choices on the visualizer page
+#
+# The visualizer page offers every dataset, version, country, energy type,
+# aggregation, matrix, ... of the database. Those only change when the
+# lookup tables do, so they are worked out once per translation snapshot
+# (see utils/translation_snapshot.py) instead of on every page load.
+#
+# Each catalog has a version made from the snapshots it came from and
+# whether it is for admins, which also keys the cached fragment of the
+# rendered page (see templates/visualizer.html), so the option lists
+# are only rendered again when the lookup tables change.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+from threading import Lock
+from utils.translator import Translator
+from utils.translation_snapshot import snapshot_version
+from Mexer_meta.settings import SANDBOX_PREFIX
+
+# choices that aren't offered even though they are in the lookup tables
+SHOWN_METHODS = ["PCM"]
+SHOWN_LAST_STAGES = ["Final", "Useful"]
+
+# what the page starts with
+DEFAULT_DATASET = "CL-PFU MW"
+DEFAULT_VERSION = "v2.0"
+DEFAULT_SANDBOX_VERSION = SANDBOX_PREFIX + "v2.0a7"
+DEFAULT_COUNTRY = "Ghana"
+
+# admin flag -> the catalog, see get_option_catalog()
+__catalogs: dict[bool, dict] = {}
+__catalogs_lock = Lock()
+
+def catalog_version(admin_user: bool) -> str:
+    '''Get the version of the catalog for admins or everyone else,
+    it changes whenever a lookup table it comes from does'''
+    version = "default-" + snapshot_version("default")
+    if admin_user:
+        version = "admin-" + version + "-sandbox-" + snapshot_version("sandbox")
+
+    return version
+
+def get_option_catalog(admin_user: bool) -> dict:
+    '''Get every choice of the visualizer page, and its default
+
+    Inputs:
+        admin_user, bool: if the catalog should include sandbox datasets and versions
+
+    Outputs:
+        a dict of the page's template context, with the catalog's version under "catalog_version".
+        It is shared, so it must not be changed
+    '''
+    version = catalog_version(admin_user)
+    catalog = __catalogs.get(admin_user)
+    if catalog is not None and catalog["catalog_version"] == version:
+        return catalog
+
+    with __catalogs_lock:
+        catalog = __catalogs.get(admin_user)
+        if catalog is None or catalog["catalog_version"] != version:
+            catalog = __catalogs[admin_user] = __make_catalog(admin_user, version)
+
+        return catalog
+
+def __make_catalog(admin_user: bool, version: str) -> dict:
+    datasets = Translator.get_all("datasets:admin" if admin_user else "datasets:public")
+    versions = Translator.get_all("version")
+    sandbox_versions = [SANDBOX_PREFIX + ver for ver in Translator.get_all("version", "sandbox")] if admin_user else []
+    countries = sorted(Translator.get_all("country"))
+    energy_types = Translator.get_all("energytype")
+    grossnets = Translator.get_all("grossnet")
+    aggregations = Translator.get_all("agglevel")
+    matnames = sorted(Translator.get_all("matname"), key = len) # sort matrix names by how long they are... seems reasonable
+
+    return {
+        "catalog_version": version,
+
+        "datasets": datasets,
+        "default_dataset": DEFAULT_DATASET,
+
+        "versions": versions,
+        "default_version": DEFAULT_VERSION,
+
+        "sandbox_versions": sandbox_versions,
+        "default_sandbox_version": DEFAULT_SANDBOX_VERSION,
+
+        "countries": countries,
+        "default_country": DEFAULT_COUNTRY,
+
+        "methods": SHOWN_METHODS,
+        "default_method": SHOWN_METHODS[0],
+
+        "energy_types": energy_types,
+        "default_energy_type": energy_types[0],
+
+        "last_stages": SHOWN_LAST_STAGES,
+        "default_last_stage": SHOWN_LAST_STAGES[0],
+
+        "grossnets": grossnets,
+        "default_grossnet": grossnets[0],
+
+        "matnames": matnames,
+        "default_matname": matnames[0],
+
+        "product_aggregations": aggregations,
+        "default_product_aggregation": aggregations[0],
+
+        "industry_aggregations": aggregations,
+        "default_industry_aggregation": aggregations[0],
+    }
@@ -0,0 +1,129 @@
+####################################################################
+# plot_pool.py contains the process pool plots are built in
+#
+# Making the actual figures (sankey JSON, plotly HTML, altair HTML)
+# is CPU heavy pure Python work. Done in a request's own thread, it holds
+# the GIL and slows down every other request on the same worker.
+# So the /plot view (see Mexer/views/visualizer.py) does its database
+# work itself and hands figure building off to this pool of processes.
+#
+# The pool is bounded: at most PLOT_POOL_PROCESSES figures are built at
+# once, and at most PLOT_POOL_MAX_QUEUE more wait for a process. Past that,
+# PlotPoolFull is raised so the request can be turned away instead of
+# piling up. How busy the pool is can be seen with PLOT_POOL.stats().
+#
+# The stages (see utils/metrics.py) a function goes through in the pool
+# are sent back with its result and recorded in the calling process.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import asyncio
+import multiprocessing
+from os import environ
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from utils.logging import LOGGER
+from utils.metrics import stage, record, start_request, finish_request
+
+# how many processes build figures at once, per server worker
+PLOT_POOL_PROCESSES = int(environ.get("MEXER_PLOT_PROCESSES", 2))
+
+# how many figures can wait for a process before requests are turned away
+PLOT_POOL_MAX_QUEUE = int(environ.get("MEXER_PLOT_MAX_QUEUE", 4 * PLOT_POOL_PROCESSES))
+
+class PlotPoolFull(Exception):
+    '''Raised when the plot pool has too much work queued to take more'''
+
+def _init_process():
+    # functions run in the pool live in modules that use Django models
+    # so set Django up in each new process
+    import django
+    environ.setdefault("DJANGO_SETTINGS_MODULE", "Mexer_meta.settings")
+    django.setup()
+
+def _run_measured(func, *args):
+    # runs in a pool process, collecting the stages func goes through
+    token = start_request()
+    result = func(*args)
+    return result, finish_request(token)
+
+class PlotPool:
+    '''A bounded pool of processes to run figure building functions in
+
+    The processes are only started the first time the pool is used,
+    so each server worker gets its own pool after it starts
+    '''
+
+    def __init__(self, processes: int, max_queue: int):
+        self.processes = processes
+        self.max_queue = max_queue
+        self._executor = None
+        self._lock = Lock() # the counts are shared by every request's thread/event loop
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            LOGGER.info(f"Starting plot pool with {self.processes} processes")
+            self._executor = ProcessPoolExecutor(
+                max_workers = self.processes,
+                # spawn, forking a process with open database connections and threads is unsafe
+                mp_context = multiprocessing.get_context("spawn"),
+                initializer = _init_process,
+            )
+        return self._executor
+
+    async def run(self, func, *args):
+        '''Run func(*args) in the pool and wait for its result
+
+        func and args must be picklable, i.e. func is a module level function
+
+        Raises PlotPoolFull if the pool has too much work already
+        '''
+
+        with self._lock:
+            if self._in_flight >= self.processes + self.max_queue:
+                self._rejected += 1
+                raise PlotPoolFull()
+            self._in_flight += 1
+            executor = self._get_executor()
+
+        try:
+            # includes the time spent waiting for a process
+            with stage("plot pool"):
+                result, stages = await asyncio.wrap_future(executor.submit(_run_measured, func, *args))
+        except Exception:
+            with self._lock:
+                self._failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+        with self._lock:
+            self._completed += 1
+        for measured in stages:
+            record(measured["stage"], measured["seconds"], measured["rows"], measured["bytes"])
+        return result
+
+    def stats(self) -> dict:
+        '''Get how busy the pool is (for this server worker)'''
+        with self._lock:
+            running = min(self._in_flight, self.processes)
+            return dict(
+                processes = self.processes,
+                running = running,
+                queued = self._in_flight - running,
+                max_queue = self.max_queue,
+                # 1 means every process is busy and the queue is full
+                saturation = self._in_flight / (self.processes + self.max_queue),
+                completed = self._completed,
+                failed = self._failed,
+                rejected = self._rejected,
+            )
+
+PLOT_POOL = PlotPool(PLOT_POOL_PROCESSES, PLOT_POOL_MAX_QUEUE)
@@ -7,74 +7,98 @@
 # Which will return the data needed to pass to the JS library
 # SanKEY.js (https://github.com/Krzysiekzd/SanKEY.js)
 #
+# Finished sankey data is cached (see utils/cache.py),
+# so a repeated query doesn't go to the database at all
+#
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
 import json
+import numpy as np
 from utils.translator import Translator
-from utils.data import _query_database, DatabaseTarget
+from utils.index_registry import IndexRegistry
+from utils.data import _fetch_arrays, DatabaseTarget
 from Mexer_meta.settings import SANKEY_COLORS_PATH
 from utils.logging import LOGGER
+from utils.cache import SANKEY_CACHE
+from utils.metrics import stage
 
 INDUSTRY_COLOR = "midnightblue"
+OTHER_COLOR = "lightgray" # for nodes (and their links) made of small flows
+OTHER_LABEL = "Other"
 OVERRIDE_COL = 1 # where to put energy carrier nodes
 OVERRIDE_COL_ON = False # only affects energy carrier columns
 
 with open(SANKEY_COLORS_PATH) as f:
     SANKEY_COLORS: dict[str, str] = json.loads(f.read())
 
-def _get_sankey_color(node_name: str) -> str:
-    carrier_name = -1
-
-    for carrier_category in SANKEY_COLORS:
-        if carrier_category in node_name.lower():
-            carrier_name = carrier_category
-            break
-
-    return SANKEY_COLORS.get(carrier_name) or LOGGER.error("Couldn't find sankey color for " + node_name)
-
-def _get_sankey_node_info(
-        label_num: int, label_col: int,
-        node_list: list[list], idx_dict: dict, label_info_dict: dict,
-        translator: Translator,
-        carrier: bool,
-):
-    name = translator.index_translate(label_num)
-    # try to get saved information about the label
-    label_info = label_info_dict.get(label_num, -1)
-    if label_info == -1:
-        # add it if it is a new label and get new node_idx
-        node_list[label_col].append(dict(label=name,
-                                         color=_get_sankey_color(name) or "red" if carrier else INDUSTRY_COLOR))
-        
-        label_info = (idx_dict[label_col], label_col)
-        idx_dict[label_col] += 1
-
-        # remember which index and column the label is in so future nodes can find this one
-        label_info_dict[label_num] = label_info
-        node_idx = label_info[0]
-
-    else:
-        # if node is not new, just get the recorded col and idx
-        label_col = label_info[1]
-        node_idx = label_info[0]
-    
+# matname -> (column of the rows (i), column of the columns (j), whether the rows are energy carriers)
+# the columns of the diagram are:
+# 0 resources -> 1 carriers -> 2 industries -> 3 carriers -> 4 final demand
+# the columns (j) are energy carriers when the rows (i) aren't
+STAGE_COLUMNS = {
+    "R": (0, 1 if not OVERRIDE_COL_ON else OVERRIDE_COL, False),
+    "U": (1 if not OVERRIDE_COL_ON else OVERRIDE_COL, 2, True),
+    "V": (2, 3 if not OVERRIDE_COL_ON else OVERRIDE_COL, False),
+    "Y": (3 if not OVERRIDE_COL_ON else OVERRIDE_COL, 4, True),
+}
+
+def sankey_color(node_name: str) -> str | None:
+    ''' Get the color of an energy carrier node from its name, or None if it has none
+
+    Checked against every carrier category, so use the precomputed
+    colors of the IndexRegistry instead of calling this for every node
+    '''
+    node_name = node_name.lower()
+    for carrier_category, color in SANKEY_COLORS.items():
+        if carrier_category in node_name:
+            return color
 
-    return (node_idx, label_col)
+    return None
 
-def get_sankey(target: DatabaseTarget, query: dict) -> tuple[str, str, str] | tuple[None, None, None]:
+def get_sankey(
+        target: DatabaseTarget, query: dict,
+        flow_threshold: float = 0, relative_threshold: bool = True,
+) -> tuple[str, str, str] | tuple[None, None, None]:
     ''' Gets a sankey diagram for a query
 
     Input:
 
         query, dict: a query ready to hit the database, i.e. translated as neccessary (see translate_query())
 
+        flow_threshold and relative_threshold: how small flows are merged together (see build_sankey())
+
+    Outputs:
+
+        a 3-tuple of the JSON nodes, links, and options for SanKEY.js
+
+        or 3 Nones if there is no cooresponding data for the query
+    '''
+
+    cache_key, sankey, build_args = prepare_sankey(target, query, flow_threshold, relative_threshold)
+
+    if sankey is None:
+        sankey = build_sankey(*build_args)
+        SANKEY_CACHE.set(cache_key, sankey)
+
+    return sankey
+
+def prepare_sankey(
+        target: DatabaseTarget, query: dict,
+        flow_threshold: float = 0, relative_threshold: bool = True,
+) -> tuple[str, tuple | None, tuple | None]:
+    ''' Does everything for a sankey diagram that needs the database (see get_sankey())
+
     Outputs:
 
-        a plotly Figure with the sankey data
+        a 3-tuple of
+
+            the sankey's cache key
+
+            the finished sankey if it is already known (cached, or there is no data), else None
 
-        or None if there is no cooresponding data for the query
+            the arguments to give build_sankey() if the sankey isn't finished, else None
     '''
 
     # we do a little shaping
@@ -91,19 +115,78 @@ def get_sankey(target: DatabaseTarget, query: dict) -> tuple[str, str, str] | tu
             translator.matname_translate("Y")
         ]})
 
+    # give back the finished sankey if it has already been made
+    cache_key = SANKEY_CACHE.key(
+        target[0], target[1].__name__, query,
+        flow_threshold = flow_threshold, relative_threshold = relative_threshold
+    )
+    if (cached := SANKEY_CACHE.get(cache_key)) is not None:
+        return cache_key, cached, None
+
     # get all four matrices to make the full RUVY matrix
-    data = _query_database(target, query, ["matname", "i", "j", "value"])
+    data = _fetch_arrays(target, query, ["matname", "i", "j", "value"])
 
     # if no cooresponding data, return as such
-    if not data:
-        return (None, None, None)
+    if len(data) == 0:
+        SANKEY_CACHE.set(cache_key, (None, None, None))
+        return cache_key, (None, None, None), None
+
+    # build_sankey() gets plain dicts and arrays of the translations it needs
+    # so it doesn't need the database (or a Translator) at all
+    registry = IndexRegistry(target[0])
+    return cache_key, None, (
+        data,
+        dict(translator.get_id_map("matname")),
+        registry.names,
+        registry.colors,
+        flow_threshold,
+        relative_threshold,
+    )
+
+@stage("figure")
+def build_sankey(
+        data, matnames: dict, index_names: np.ndarray, index_colors: np.ndarray,
+        flow_threshold: float = 0, relative_threshold: bool = True,
+) -> tuple[str, str, str]:
+    ''' Builds the sankey diagram JSON from the data of prepare_sankey()
+
+    Needs no database, so it can be run in another process (see utils/plot_pool.py)
+
+    Input:
+
+        data, NumPy structured array: the RUVY rows with fields matname, i, j, value
+
+        matnames, dict: matname ID -> matname
+
+        index_names, NumPy array: index ID -> index name (see IndexRegistry)
+
+        index_colors, NumPy array: index ID -> sankey color of the index (see IndexRegistry)
+
+        flow_threshold, float: nodes with less flowing through them than this are
+        merged into an "Other" node for their column (see _prune_sankey()), 0 to keep every node
+
+        relative_threshold, bool: whether flow_threshold is a fraction of
+        the biggest node's flow (True) or an amount of energy (False)
+
+    Outputs:
+
+        a 3-tuple of the JSON nodes, links, and options for SanKEY.js
+    '''
+
+    # NaN and infinite flows can't be drawn (and aren't valid JSON), leave them out
+    if not (finite := np.isfinite(data["value"])).all():
+        LOGGER.warning(f"Left {np.count_nonzero(~finite)} NaN or infinite flows out of a sankey diagram")
+        data = data[finite]
 
     # get rid of any duplicate i,j,x combinations (many exist)
-    data = set(data)
+    # sorting each field is much faster than np.unique on the whole records
+    data = data[np.lexsort((data["value"], data["j"], data["i"], data["matname"]))]
+    duplicate = np.ones(len(data), dtype=bool)
+    for field in ("matname", "i", "j", "value"):
+        duplicate[1:] &= data[field][1:] == data[field][:-1]
+    duplicate[0] = False
+    data = data[~duplicate]
 
-    # 5 lists, one for each column in the plot
-    nodes = [list(), list(), list(), list(), list()]
-    links = list()
     options = dict(
         plot_background_color = '#f4edf7',
         default_links_opacity = 0.8,
@@ -113,58 +196,145 @@ def get_sankey(target: DatabaseTarget, query: dict) -> tuple[str, str, str] | tu
         linear_gradient_links = False
     )
 
-    # track which label is which index in the column lists
-    label2info = dict()
-
-    # keep track of the index a new label is added to
-    # this prevents having to repeatedly calculate the length of the
-    # column lists
-    # keys = column lists by index in nodes list above
-    # values = index at which a new label will be added to a column list
-    idx = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0}
-
-    # what columns we think the node should go in
-    # filled in below
-
-    for matname, i, j, magnitude in data:
-        from_node_col = to_node_col = -1
-        carrier_row = False
-        carrier_col = False
-        # figure out which column the info should go in
-        match(translator.matname_translate(matname)):
-            case("R"):
-                from_node_col = 0
-                to_node_col = 1 if not OVERRIDE_COL_ON else OVERRIDE_COL
-                carrier_col = True
-
-            case("U"):
-                from_node_col = 1 if not OVERRIDE_COL_ON else OVERRIDE_COL
-                to_node_col = 2
-                carrier_row = True
-
-            case("V"):
-                from_node_col = 2
-                to_node_col = 3 if not OVERRIDE_COL_ON else OVERRIDE_COL
-                carrier_col = True
-
-            case("Y"):
-                from_node_col = 3 if not OVERRIDE_COL_ON else OVERRIDE_COL
-                to_node_col = 4
-                carrier_row = True
-
-        # if the column values were not filled in above
-        if from_node_col < 0 or to_node_col < 0:
+    # figure out which columns each matrix's rows and columns go in
+    # once per matname instead of once per row
+    matname_ids = np.unique(data["matname"])
+    stages = np.zeros((matname_ids.max() + 1, 3), dtype=np.int8)
+    for matname_id in matname_ids.tolist():
+        if (columns := STAGE_COLUMNS.get(matnames[matname_id])) is None:
             raise ValueError("Unknown matrix name processed")
+        stages[matname_id] = columns
+    from_cols, to_cols, carrier_rows = stages[data["matname"]].T
+    carrier_rows = carrier_rows.astype(bool)
+
+    # every row is a link from node i to node j
+    # lay them out as i0, j0, i1, j1, ... which is the order nodes are first seen in
+    labels = np.column_stack((data["i"], data["j"])).ravel()
+    label_cols = np.column_stack((from_cols, to_cols)).ravel()
+    label_carriers = np.column_stack((carrier_rows, ~carrier_rows)).ravel()
+
+    # a node belongs in the column it is first seen in
+    node_ids, first_seen, label_nodes = np.unique(labels, return_index=True, return_inverse=True)
+    node_cols = label_cols[first_seen]
+    node_labels = index_names[node_ids]
+
+    # carriers are colored by what they are, red if unknown
+    # everything else is an industry
+    carrier_colors = index_colors[node_ids]
+    node_colors = carrier_colors.copy()
+    node_colors[np.equal(node_colors, None)] = "red"
+    node_colors = np.where(label_carriers[first_seen], node_colors, INDUSTRY_COLOR)
+
+    # links are colored by the energy carrier flowing through them
+    link_from, link_to = label_nodes[0::2], label_nodes[1::2]
+    values = data["value"]
+    link_carriers = np.where(carrier_rows, link_from, link_to)
+    if (missing := np.unique(node_ids[link_carriers][np.equal(carrier_colors[link_carriers], None)])).size:
+        LOGGER.error("Couldn't find sankey color for " + ", ".join(index_names[missing].tolist()))
+
+    if flow_threshold > 0:
+        if relative_threshold:
+            # relative to the biggest node
+            flow_threshold *= _node_throughput(link_from, link_to, values, len(node_ids)).max()
+        (
+            node_cols, first_seen, node_labels, node_colors, carrier_colors,
+            link_from, link_to, carrier_rows, values,
+        ) = _prune_sankey(
+            flow_threshold,
+            node_cols, first_seen, node_labels, node_colors, carrier_colors,
+            link_from, link_to, carrier_rows, values,
+        )
+
+    # within a column, nodes are in the order they were first seen
+    # node_idxs is each node's place in its column
+    order = np.lexsort((first_seen, node_cols))
+    col_starts = np.searchsorted(node_cols[order], np.arange(6))
+    node_idxs = np.empty(len(node_cols), dtype=np.int64)
+    node_idxs[order] = np.arange(len(order)) - col_starts[node_cols[order]]
+
+    # 5 lists, one for each column in the plot
+    nodes = [
+        [dict(label=label, color=color) for label, color in zip(
+            node_labels[order[col_starts[col]:col_starts[col + 1]]].tolist(),
+            node_colors[order[col_starts[col]:col_starts[col + 1]]].tolist(),
+        )]
+        for col in range(5)
+    ]
+
+    with stage("serialize") as measured:
+        # set up the flow between the nodes of each row
+        # written straight to JSON, making a dict for every link is most of the time for big diagrams
+        # (every value is finite, so its repr is the same as its JSON)
+        link_nodes = np.column_stack((node_cols[link_from], node_idxs[link_from], node_cols[link_to], node_idxs[link_to]))
+        link_colors = carrier_colors[np.where(carrier_rows, link_from, link_to)]
+        color_json = {color: json.dumps(color) for color in set(link_colors.tolist())}
+        links = "[" + ", ".join(
+            f'{{"from": {{"column": {from_col}, "node": {from_idx}}}, '
+            f'"to": {{"column": {to_col}, "node": {to_idx}}}, '
+            f'"value": {magnitude!r}, "color": {color_json[color]}}}'
+            for (from_col, from_idx, to_col, to_idx), magnitude, color in zip(
+                link_nodes.tolist(), values.tolist(), link_colors.tolist()
+            )
+        ) + "]"
+
+        # convert everything to json to send it to the javascript renderer
+        nodes, options = json.dumps(nodes), json.dumps(options)
+        measured.rows, measured.nbytes = len(values), len(nodes) + len(links) + len(options)
+
+    return nodes, links, options
+
+def _node_throughput(link_from: np.ndarray, link_to: np.ndarray, values: np.ndarray, node_count: int) -> np.ndarray:
+    # how much flows through each node, the bigger of what flows in and what flows out
+    return np.maximum(
+        np.bincount(link_from, weights=values, minlength=node_count),
+        np.bincount(link_to, weights=values, minlength=node_count),
+    )
 
-        # get the index and column the node truely belongs in
-        from_node_idx, from_node_col = _get_sankey_node_info(i, from_node_col, nodes, idx, label2info, translator, carrier_row)
-        to_node_idx, to_node_col = _get_sankey_node_info(j, to_node_col, nodes, idx, label2info, translator, carrier_col)
+def _prune_sankey(
+        flow_threshold: float,
+        node_cols, first_seen, node_labels, node_colors, carrier_colors,
+        link_from, link_to, carrier_rows, values,
+) -> tuple:
+    ''' Merges every node with less than flow_threshold flowing through it into an "Other" node for its column
 
-        # set up the flow from the two labels above
-        links.append({"from": dict(column=from_node_col, node = from_node_idx),
-                      "to": dict(column=to_node_col, node = to_node_idx),
-                      "value": magnitude,
-                      "color": _get_sankey_color(translator.index_translate(i if carrier_row else j))})
+    Links of merged nodes are added together, so the diagram only has as many nodes
+    and links as there are significant flows (and at most one "Other" node per column)
 
-    # convert everything to json to send it to the javascript renderer
-    return json.dumps(nodes), json.dumps(links), json.dumps(options)
+    Takes and gives back the node and link arrays of build_sankey()
+    '''
+
+    node_count = len(node_cols)
+    small = _node_throughput(link_from, link_to, values, node_count) < flow_threshold
+    if not small.any():
+        return (node_cols, first_seen, node_labels, node_colors, carrier_colors,
+                link_from, link_to, carrier_rows, values)
+
+    # node node_count + col is the "Other" node of column col
+    # they go after every other node in their column
+    node_cols = np.concatenate((node_cols, np.arange(5)))
+    first_seen = np.concatenate((first_seen, np.full(5, first_seen.max() + 1)))
+    node_labels = np.concatenate((node_labels, np.full(5, OTHER_LABEL, dtype=object)))
+    node_colors = np.concatenate((node_colors, np.full(5, OTHER_COLOR, dtype=object)))
+    carrier_colors = np.concatenate((carrier_colors, np.full(5, OTHER_COLOR, dtype=object)))
+
+    merged_into = np.arange(node_count)
+    merged_into[small] = node_count + node_cols[:node_count][small]
+    link_from, link_to = merged_into[link_from], merged_into[link_to]
+
+    # add together links that now go between the same nodes (and carry the same carrier)
+    link_keys = (link_from * (node_count + 5) + link_to) * 2 + carrier_rows
+    link_keys, link_groups = np.unique(link_keys, return_inverse=True)
+    values = np.bincount(link_groups, weights=values)
+    carrier_rows = (link_keys % 2).astype(bool)
+    link_to = (link_keys // 2) % (node_count + 5)
+    link_from = (link_keys // 2) // (node_count + 5)
+
+    # only keep nodes that still have links, renumbered to leave no gaps
+    kept = np.zeros(node_count + 5, dtype=bool)
+    kept[link_from] = kept[link_to] = True
+    renumber = np.cumsum(kept) - 1
+
+    return (
+        node_cols[kept], first_seen[kept], node_labels[kept], node_colors[kept], carrier_colors[kept],
+        renumber[link_from], renumber[link_to], carrier_rows, values,
+    )
@@ -0,0 +1,225 @@
+####################################################################
+# shadow_table.py includes the tools to rebuild a big table while the site uses it
+#
+# Tables like PSUTReAllChopAllDsAllGrAll are too big to rebuild in place:
+# everything reading them (every plot) would wait until it is done.
+# Instead, a "shadow" of the table is built next to it and swapped in
+# at the end with a quick rename:
+#
+#   shadow = ShadowTable(database, table, "__compressing")
+#   make the shadow table (e.g. CREATE TABLE shadow.shadow (LIKE ...))
+#   with shadow.building() as cursor:
+#       fill it, e.g. shadow.run_parts(shadow.parts(), fill_part, jobs)
+#       shadow.copy_indexes(cursor)
+#       shadow.swap(cursor)
+#   shadow.finish()
+#
+# While building, the real table is locked in SHARE mode, so it can
+# still be read but not written to (so the shadow misses nothing).
+#
+# Only plain tables can be rebuilt: a partitioned table's shadow would
+# be made without its partitions, and pg_indexes gives its indexes
+# as "ON ONLY", which copy_indexes() can't rename. building() refuses them.
+#
+# Used by the compress_table and partition_table management commands.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import perf_counter, sleep
+from django.db import connections, transaction, OperationalError
+from utils.logging import LOGGER
+
+# suffix of the original table after the swap, if it is kept
+OLD_SUFFIX = "__old"
+
+# tables are split into parts by these columns' values, so parts can be done at the same time
+PART_COLUMNS = ["Dataset", "Country"]
+
+def quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+def suffixed(identifier: str, suffix: str) -> str:
+    # PostgreSQL cuts names off at 63 characters, so cut before the suffix instead
+    return identifier[:63 - len(suffix)] + suffix
+
+class ShadowTable:
+    '''A table being rebuilt next to the real one (see the top of this file)
+
+    Inputs:
+        database, str: the database the table is in
+        table, str: the real table
+        suffix, str: added to the table's name to name the shadow table
+        old_suffix, str: added to the table's name to name the original table after the swap
+        log, function: gets progress messages, e.g. a command's self.stdout.write
+    '''
+
+    def __init__(self, database: str, table: str, suffix: str, old_suffix: str = OLD_SUFFIX, log = LOGGER.info):
+        self.database = database
+        self.table = table
+        self.shadow = suffixed(table, suffix)
+        self.old = suffixed(table, old_suffix)
+        self.suffix = suffix
+        self.old_suffix = old_suffix
+        self.log = log
+
+    def columns(self, exclude = ()) -> list[str]:
+        '''Get the real table's column names, in order'''
+        with connections[self.database].cursor() as cursor:
+            cursor.execute(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = 'public' AND table_name = %s ORDER BY ordinal_position",
+                [self.table]
+            )
+            return [col for (col,) in cursor.fetchall() if col not in exclude]
+
+    def estimated_rows(self) -> int:
+        '''Get the planner's guess of how many rows the real table has, fast but rough (-1 if never analyzed)'''
+        with connections[self.database].cursor() as cursor:
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [self.table])
+            return cursor.fetchone()[0]
+
+    def is_partitioned(self) -> bool:
+        '''See if the real table is partitioned (see the partition_table management command)'''
+        with connections[self.database].cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [quote(self.table)])
+            return cursor.fetchone() is not None
+
+    def parts(self) -> list[dict]:
+        '''Split the real table into parts, each a dict of PART_COLUMNS -> value'''
+        part_cols = [col for col in PART_COLUMNS if col in self.columns()]
+        if not part_cols:
+            return [{}]
+
+        with connections[self.database].cursor() as cursor:
+            cursor.execute(f"SELECT DISTINCT {', '.join(map(quote, part_cols))} FROM {quote(self.table)}")
+            return [dict(zip(part_cols, row)) for row in cursor.fetchall()]
+
+    @staticmethod
+    def part_where(part: dict) -> tuple[str, list]:
+        '''Get the WHERE condition (and its parameters) picking out a part's rows'''
+        return " AND ".join(f"{quote(col)} = %s" for col in part) or "TRUE", list(part.values())
+
+    def run_parts(self, parts: list[dict], work, jobs: int, verb: str = "Did") -> int:
+        '''Run work(part) on every part, jobs at a time (each in its own connection), reporting progress
+
+        Outputs:
+            the sum of what work gave back for each part, e.g. rows
+        '''
+        total = 0
+        t0 = perf_counter()
+        with ThreadPoolExecutor(max_workers = jobs) as pool:
+            futures = [pool.submit(self._in_own_connection, work, part) for part in parts]
+            for done, future in enumerate(as_completed(futures), start = 1):
+                total += future.result()
+                elapsed = perf_counter() - t0
+                self.log(
+                    f"{verb} {done}/{len(parts)} parts, {total} rows, "
+                    f"{elapsed:.0f}s elapsed, about {elapsed / done * (len(parts) - done):.0f}s left"
+                )
+        return total
+
+    def _in_own_connection(self, work, part: dict) -> int:
+        # each thread gets its own database connection, closed when it is done
+        try:
+            return work(part)
+        finally:
+            connections[self.database].close()
+
+    def indexes(self) -> list[tuple[str, str]]:
+        '''Get the name and definition of every index on the real table'''
+        with connections[self.database].cursor() as cursor:
+            cursor.execute("SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s", [self.table])
+            return cursor.fetchall()
+
+    @contextmanager
+    def building(self):
+        '''Lock the real table against writes while the shadow is built
+
+        Gives the cursor of the locking transaction, the swap has to be done with it.
+        If anything goes wrong, the shadow table is dropped and the real table is untouched.
+        Partitioned tables can't be rebuilt (see the top of this file), ValueError is raised for them.
+        '''
+        if self.is_partitioned():
+            raise ValueError(f"{self.table} is partitioned, it can't be rebuilt as a shadow table")
+
+        self._indexes = self.indexes() # remembered for finish()
+        try:
+            with transaction.atomic(using=self.database), connections[self.database].cursor() as cursor:
+                cursor.execute(f"LOCK TABLE {quote(self.table)} IN SHARE MODE")
+                yield cursor
+        except BaseException:
+            with connections[self.database].cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {quote(self.shadow)}")
+            raise
+
+    def copy_indexes(self, cursor, skip = lambda name, definition: False):
+        '''Make the real table's indexes on the shadow table, best done after it is filled
+
+        Inputs:
+            cursor: the cursor building() gave
+            skip, function: given an index's name and definition, whether not to make it on the shadow table
+        '''
+        skipped = [(name, definition) for name, definition in self._indexes if skip(name, definition)]
+        for name, _ in skipped:
+            self.log(f"Skipping index {name}")
+        self._indexes = [index for index in self._indexes if index not in skipped]
+
+        for name, definition in self._indexes:
+            self.log(f"Making index {name}")
+            cursor.execute(
+                definition
+                .replace(f"INDEX {quote(name)} ", f"INDEX {quote(suffixed(name, self.suffix))} ", 1)
+                .replace(f"INDEX {name} ", f"INDEX {quote(suffixed(name, self.suffix))} ", 1)
+                .replace(f"ON public.{quote(self.table)} ", f"ON public.{quote(self.shadow)} ", 1)
+                .replace(f"ON public.{self.table} ", f"ON public.{quote(self.shadow)} ", 1)
+            )
+        cursor.execute(f"ANALYZE {quote(self.shadow)}")
+
+    def swap(self, cursor, lock_timeout: int = 5, attempts: int = 10):
+        '''Rename the shadow table into place, waiting at most lock_timeout seconds at a time for the lock
+
+        Readers queue up behind a waiting exclusive lock, so rather than
+        waiting a long time for a long running read to finish, give up and try again
+        '''
+        cursor.execute(f"SET LOCAL lock_timeout = '{int(lock_timeout)}s'")
+        for attempt in range(1, attempts + 1):
+            try:
+                # a savepoint, so a timeout doesn't undo everything (the SHARE lock is kept)
+                with transaction.atomic(using=self.database):
+                    cursor.execute(f"LOCK TABLE {quote(self.table)} IN ACCESS EXCLUSIVE MODE")
+                break
+            except OperationalError:
+                self.log(f"Couldn't get the lock to swap tables (try {attempt}), trying again")
+                sleep(attempt)
+        else:
+            raise OperationalError(f"Couldn't get the lock to swap in {self.shadow}, {self.table} was not changed")
+
+        cursor.execute(f"ALTER TABLE {quote(self.table)} RENAME TO {quote(self.old)}")
+        cursor.execute(f"ALTER TABLE {quote(self.shadow)} RENAME TO {quote(self.table)}")
+
+    def finish(self, keep_old: bool = False) -> bool:
+        '''After the swap, drop the original table (unless keep_old) and give its index names to the new table
+
+        Outputs:
+            whether the original table was dropped, it is kept if something (like a view) still uses it
+        '''
+        with connections[self.database].cursor() as cursor:
+            dropped = False
+            if not keep_old:
+                try:
+                    cursor.execute(f"DROP TABLE {quote(self.old)}")
+                    dropped = True
+                except Exception as e:
+                    # e.g. views (like the xy summaries) still use it
+                    self.log(f"Kept {self.old}, couldn't drop it: {e}")
+
+            for name, _ in self._indexes:
+                if not dropped:
+                    cursor.execute(f"ALTER INDEX {quote(name)} RENAME TO {quote(suffixed(name, self.old_suffix))}")
+                cursor.execute(f"ALTER INDEX {quote(suffixed(name, self.suffix))} RENAME TO {quote(name)}")
+
+        return dropped
@@ -0,0 +1,133 @@
+####################################################################
+# shared_files.py includes the helpers for data shared between processes through files
+#
+# Some things (e.g. the translation snapshots, the availability indexes)
+# are made by one process and used by every server worker. They are
+# written as JSON files that every worker reads:
+#   write_json() writes a file so readers never see half of it
+#   read_json() reads one, if it is there and readable
+#   file_lock() makes sure only one process makes a file at a time
+#   CheckedCache keeps what was read in memory, and only looks
+#       at the file again every so often, one thread at a time
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from threading import RLock
+from time import monotonic
+from utils.logging import LOGGER
+
+try:
+    import fcntl # file locks, not on Windows
+except ImportError:
+    fcntl = None
+
+def file_mtime(path: Path) -> float | None:
+    '''Get when a file was last changed, None if it doesn't exist'''
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+def write_json(path: Path, contents) -> float:
+    '''Write contents to a JSON file, all at once as far as readers can tell
+
+    The file is written next to the real one and renamed over it,
+    so readers see either the old file or the new one, never half of one
+
+    Outputs:
+        when the new file was last changed (see file_mtime())
+    '''
+    path.parent.mkdir(parents = True, exist_ok = True)
+    with NamedTemporaryFile("w", dir = path.parent, suffix = ".tmp", delete = False) as f:
+        try:
+            json.dump(contents, f)
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+    return file_mtime(path)
+
+def read_json(path: Path, description: str) -> tuple | None:
+    '''Read a JSON file written by write_json()
+
+    Inputs:
+        path, Path: the file
+        description, str: what the file is, for the log
+
+    Outputs:
+        the file's contents and when it was last changed,
+        or None if there is no file or it can't be read
+    '''
+    try:
+        mtime = file_mtime(path)
+        with open(path) as f:
+            return json.load(f), mtime
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        LOGGER.warning(f"Ignoring unreadable {description} {path}: {e}")
+        return None
+
+@contextmanager
+def file_lock(path: Path):
+    '''Hold a lock file, so only one process at a time does what is in the with block'''
+    path.parent.mkdir(parents = True, exist_ok = True)
+    with open(path, "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class CheckedCache:
+    '''Values (e.g. read from files) kept in memory, and checked again at most every interval seconds
+
+    Checking is single-flight: while one thread checks a key, the others wait for it
+
+    Inputs:
+        interval, float: how often (seconds) to check a value again
+    '''
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # key -> (when it was last checked, the value)
+        self._entries: dict = {}
+        self._lock = RLock() # locked() can be held while calling set()
+
+    def get(self, key, check):
+        '''Get a key's value, calling check(the current value or None) for a new one if it is due to be checked'''
+        entry = self._entries.get(key)
+        if entry is not None and monotonic() - entry[0] < self.interval:
+            return entry[1]
+
+        with self._lock:
+            # another thread may have just checked it
+            entry = self._entries.get(key)
+            if entry is not None and monotonic() - entry[0] < self.interval:
+                return entry[1]
+
+            value = check(entry[1] if entry is not None else None)
+            self._entries[key] = (monotonic(), value)
+            return value
+
+    def set(self, key, value):
+        '''Replace a key's value, e.g. with one this process just made'''
+        with self._lock:
+            self._entries[key] = (monotonic(), value)
+
+    @contextmanager
+    def locked(self):
+        '''Keep other threads from checking any key while in the with block'''
+        with self._lock:
+            yield
@@ -0,0 +1,156 @@
+####################################################################
+# static_files.py includes the in memory cache for static files
+#
+# Static files are served by Mexer itself (see handle_static in
+# Mexer/views/misc.py), so instead of reading them from disk every
+# request, they are kept in memory in a least recently used cache
+# along with everything needed to answer a request for them:
+#   - the gzip (and brotli, if installed) compressed versions
+#   - a strong ETag for each version
+#   - the Last-Modified time
+#
+# A cached file is checked against the file on disk every time
+# it is used (with a cheap stat), so changed files are picked up.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import gzip
+from os import stat
+from pathlib import Path
+from hashlib import sha256
+from threading import Lock
+from collections import OrderedDict
+from utils.logging import LOGGER
+
+# brotli is optional, only gzip is used without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# How many bytes of files (and their compressed versions) to keep in memory
+STATIC_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Files bigger than this are not cached, just read when asked for
+STATIC_CACHE_MAX_FILE_BYTES = 8 * 1024 * 1024
+
+# Only text-like files are worth compressing, images are already compressed
+COMPRESSIBLE_MIME_TYPES = ("text/css", "text/javascript", "image/svg+xml")
+
+class StaticFile:
+    '''A static file and all its versions, ready to be served
+
+    encodings maps a content encoding ("identity", "gzip", "br")
+    to a tuple of that version's bytes and its ETag
+    '''
+
+    def __init__(self, path: Path, mime_type: str):
+        file_stat = stat(path)
+        content = path.read_bytes()
+
+        self.mime_type = mime_type
+        self.last_modified = file_stat.st_mtime
+        # to check if the file on disk changed
+        self.signature = (file_stat.st_mtime_ns, file_stat.st_size)
+
+        digest = sha256(content).hexdigest()[:32]
+        self.encodings = {"identity": (content, f'"{digest}"')}
+
+        if mime_type in COMPRESSIBLE_MIME_TYPES:
+            # mtime = 0 so the same file always compresses to the same bytes
+            gzipped = gzip.compress(content, compresslevel = 9, mtime = 0)
+            if len(gzipped) < len(content):
+                self.encodings["gzip"] = (gzipped, f'"{digest}-gz"')
+
+            if brotli is not None:
+                brotlied = brotli.compress(content)
+                if len(brotlied) < len(content):
+                    self.encodings["br"] = (brotlied, f'"{digest}-br"')
+
+    @property
+    def size(self) -> int:
+        return sum(len(content) for content, _ in self.encodings.values())
+
+    def pick_encoding(self, accept_encoding: str) -> str:
+        '''Pick the smallest version of the file the client accepts
+
+        An encoding is accepted if it is listed, or "*" is, without q=0, e.g.
+        "br;q=0, gzip" accepts gzip but not br
+        '''
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+        return "identity"
+
+def _accepted_encodings(accept_encoding: str) -> dict[str, float]:
+    # encoding (lower case) -> its q value, from an Accept-Encoding header
+    accepted = {}
+    for part in accept_encoding.split(","):
+        encoding, *params = [piece.strip() for piece in part.split(";")]
+        if not encoding:
+            continue
+
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0 # unreadable, safest not to use it
+        accepted[encoding.lower()] = q
+
+    return accepted
+
+class StaticFileCache:
+    '''Least recently used cache of StaticFiles, bounded by total bytes'''
+
+    def __init__(self, base: Path, max_bytes: int = STATIC_CACHE_MAX_BYTES):
+        self.base = Path(base).resolve()
+        self.max_bytes = max_bytes
+        self._files: OrderedDict[Path, StaticFile] = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def resolve(self, filepath: str) -> Path:
+        '''Get the full path of a static file, making sure it is inside the static directory'''
+        path = (self.base / filepath).resolve()
+        if not path.is_relative_to(self.base):
+            raise FileNotFoundError(f"{filepath} is not a static file")
+        return path
+
+    def get(self, filepath: str, mime_type: str) -> StaticFile:
+        '''Get a static file, from memory if it is there and unchanged, or else from disk
+
+        Raises FileNotFoundError (or another OSError) if the file can't be read
+        '''
+        path = self.resolve(filepath)
+        file_stat = stat(path)
+
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and cached.signature == (file_stat.st_mtime_ns, file_stat.st_size):
+                self._files.move_to_end(path) # now the most recently used
+                return cached
+
+        static_file = StaticFile(path, mime_type)
+        if static_file.size > STATIC_CACHE_MAX_FILE_BYTES:
+            return static_file
+
+        with self._lock:
+            if (old := self._files.pop(path, None)) is not None:
+                self._bytes -= old.size
+
+            self._files[path] = static_file
+            self._bytes += static_file.size
+
+            # throw out the least recently used files until everything fits
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                _, evicted = self._files.popitem(last = False)
+                self._bytes -= evicted.size
+
+        LOGGER.debug(f"Cached static file {filepath}")
+        return static_file
@@ -0,0 +1,165 @@
+####################################################################
+# translation_snapshot.py includes the shared snapshot of the lookup tables
+#
+# The Translator and IndexRegistry need every lookup table
+# (Index, Country, matname, Version, ...) of a database in memory.
+# Rather than every worker process loading every table itself,
+# they are all loaded at once into a snapshot, which is written to
+# a file (TRANSLATION_SNAPSHOT_DIR/<database>.json) that every
+# worker on the server reads.
+#
+# Loading is single-flight: within a process only one thread loads
+# a snapshot (the others wait for it), and across processes only one
+# builds a stale snapshot from the database (a file lock) while the
+# others wait and read the file it wrote.
+#
+# A snapshot is rebuilt when it is older than TRANSLATOR_CACHE_TTL hours.
+# Processes look for a newer file every SNAPSHOT_CHECK_INTERVAL seconds,
+# so a rebuild (e.g. by the invalidate_cache command) is picked up everywhere.
+#
+# Every snapshot has a version, a hash of its contents, so anything
+# made from the tables can be cached by it (see snapshot_version())
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import json
+from hashlib import sha256
+from time import time
+from bidict import bidict
+from django.apps import apps
+from utils.logging import LOGGER
+from utils.shared_files import CheckedCache, file_lock, file_mtime, read_json, write_json
+from Mexer_meta.settings import TRANSLATION_SNAPSHOT_DIR
+
+# how long a snapshot is used before it is rebuilt from the database
+# in *hours*
+TRANSLATOR_CACHE_TTL = 24
+
+# how often (seconds) to look for a snapshot file newer than the one in memory
+SNAPSHOT_CHECK_INTERVAL = 60
+
+# model name -> (ID field, human readable name field) of every lookup table in a snapshot
+SNAPSHOT_TABLES = {
+    "Index": ("IndexID", "Index"),
+    "Dataset": ("DatasetID", "Dataset"),
+    "Version": ("VersionID", "Version"),
+    "Country": ("CountryID", "FullName"),
+    "Method": ("MethodID", "Method"),
+    "EnergyType": ("EnergyTypeID", "FullName"),
+    "LastStage": ("ECCStageID", "ECCStage"),
+    "matname": ("matnameID", "matname"),
+    "AggLevel": ("AggLevelID", "AggLevel"),
+    "GrossNet": ("GrossNetID", "GrossNet"),
+}
+
+class TranslationSnapshot:
+    '''Every lookup table of a database, read-only
+
+    Attributes:
+        database, str: the database the tables are from
+        version, str: a hash of the tables, changes only when they do
+        built, float: when the snapshot was built (seconds since the epoch)
+        tables, dict: model name -> bidict of name <-> ID
+        index_orders, dict: IndexID -> Order of the Index table
+        public_datasets, list[str]: names of the public datasets (only for default)
+    '''
+
+    def __init__(self, database: str, contents: dict, mtime: float = None):
+        self.database = database
+        self.version: str = contents["version"]
+        self.built: float = contents["built"]
+        self.tables: dict[str, bidict] = {
+            model_name: bidict((name, id) for id, name in rows)
+            for model_name, rows in contents["tables"].items()
+        }
+        self.index_orders: dict[int, int] = dict(contents["index_orders"])
+        self.public_datasets: list[str] = contents["public_datasets"]
+        self.mtime = mtime # of the file it was read from
+
+    def is_stale(self) -> bool:
+        return time() - self.built > TRANSLATOR_CACHE_TTL * 60 * 60
+
+# database name -> the snapshot in memory
+__snapshots = CheckedCache(SNAPSHOT_CHECK_INTERVAL)
+
+def snapshot_path(database: str):
+    return TRANSLATION_SNAPSHOT_DIR / f"{database}.json"
+
+def get_snapshot(database: str) -> TranslationSnapshot:
+    '''Get the snapshot of a database's lookup tables, loading (or building) it if needed'''
+    return __snapshots.get(database, lambda current: __load(database, current))
+
+def snapshot_version(database: str) -> str:
+    '''Get the version of a database's snapshot, e.g. to key caches of things made from the lookup tables'''
+    return get_snapshot(database).version
+
+def rebuild_snapshot(database: str) -> TranslationSnapshot:
+    '''Build a database's snapshot from the database now, even if the current one isn't stale'''
+    with __snapshots.locked(), __file_lock(database):
+        snapshot = __build(database)
+        __snapshots.set(database, snapshot)
+        return snapshot
+
+def __load(database: str, current: TranslationSnapshot | None) -> TranslationSnapshot:
+    # the newest usable snapshot: the one in memory, the file, or a new one from the database
+    path = snapshot_path(database)
+    if current is not None and file_mtime(path) == current.mtime and not current.is_stale():
+        return current
+
+    if (snapshot := __read(database)) is not None and not snapshot.is_stale():
+        return snapshot
+
+    with __file_lock(database):
+        # another process may have built it while we waited for the lock
+        if (snapshot := __read(database)) is not None and not snapshot.is_stale():
+            return snapshot
+
+        try:
+            return __build(database)
+        except Exception as e:
+            # a stale snapshot is better than none
+            if (stale := snapshot or current) is None:
+                raise
+            LOGGER.error(f"Couldn't rebuild the {database} translation snapshot, still using the old one: {e}")
+            return stale
+
+def __build(database: str) -> TranslationSnapshot:
+    LOGGER.info(f"Building the {database} translation snapshot")
+
+    tables = {}
+    for model_name, (id_field, name_field) in SNAPSHOT_TABLES.items():
+        model = apps.get_model(app_label='Mexer', model_name=model_name)
+        tables[model_name] = list(model.objects.using(database).order_by(id_field).values_list(id_field, name_field))
+
+    index_model = apps.get_model(app_label='Mexer', model_name="Index")
+    index_orders = list(index_model.objects.using(database).order_by("IndexID").values_list("IndexID", "Order"))
+
+    # the public flag only means something on the main database
+    public_datasets = []
+    if database == "default":
+        dataset_model = apps.get_model(app_label='Mexer', model_name="Dataset")
+        public_datasets = list(dataset_model.objects.using(database).filter(Public = True).values_list("Dataset", flat = True))
+
+    contents = dict(tables = tables, index_orders = index_orders, public_datasets = public_datasets)
+    contents["version"] = sha256(json.dumps(contents, sort_keys = True).encode()).hexdigest()[:16]
+    contents["built"] = time()
+
+    mtime = write_json(snapshot_path(database), contents)
+    return TranslationSnapshot(database, contents, mtime)
+
+def __read(database: str) -> TranslationSnapshot | None:
+    path = snapshot_path(database)
+    if (read := read_json(path, "translation snapshot")) is None:
+        return None
+
+    try:
+        return TranslationSnapshot(database, *read)
+    except (KeyError, TypeError, ValueError) as e:
+        LOGGER.warning(f"Ignoring unreadable translation snapshot {path}: {e}")
+        return None
+
+def __file_lock(database: str):
+    # only one process builds a database's snapshot at a time
+    return file_lock(TRANSLATION_SNAPSHOT_DIR / f"{database}.lock")
@@ -6,93 +6,69 @@
 # it's quicker to load them as dictionaries in memory and use them
 # instead of doing foreign key translation database-side.
 # 
-# Any results from the database are globally cached for 
-# TRANSLATOR_CACHE_TTL number of hours. All users use the same dictionaries
-# for translations, so little memory is used for this as possible.
+# The dictionaries come from the translation snapshot of each database
+# (see utils/translation_snapshot.py), loaded once and shared by every
+# worker, and refreshed every TRANSLATOR_CACHE_TTL number of hours.
+# All users use the same dictionaries for translations,
+# so little memory is used for this as possible.
 #
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
 from bidict import bidict
-from django.apps import apps
-from utils.logging import LOGGER
-from datetime import datetime, timedelta
-from Mexer.models import Dataset
+from utils.translation_snapshot import get_snapshot
+from utils.availability import get_index
 from Mexer_meta.settings import SANDBOX_PREFIX, IEA_TABLES
 
-# how long to cache information from the database 
-# in *hours*
-TRANSLATOR_CACHE_TTL = 24
-
 class Translator:
-    # A dictionary where keys are model names and
-    # values are tuples of date times and bidict objects
-    # the date times mark when the entry was cached
-    # the bidict has the translation information
-    __translations: dict[str: tuple[datetime, bidict]] = {}
-
-    # A tuple of a datetime of when this entry was cached
-    # and a list of strings for all the public datasets
-    __public_datasets: tuple[datetime, list[str]] = (None, [])
-
-    # how long entries are allowed to exist before getting refreshed
-    __cache_ttl = timedelta(hours=TRANSLATOR_CACHE_TTL)
+    # Dictionary mapping attribute names to model details
+    # (model name, ID field, human readable name field)
+    __model_mappings = {
+        'index': ('Index', 'IndexID', 'Index'),
+        'dataset': ('Dataset', 'DatasetID', 'Dataset'),
+        'version': ('Version', 'VersionID', 'Version'),
+        'country': ('Country', 'CountryID', 'FullName'),
+        'method': ('Method', 'MethodID', 'Method'),
+        'energytype': ('EnergyType', 'EnergyTypeID', 'FullName'),
+        'laststage': ('LastStage', 'ECCStageID', 'ECCStage'),
+        'matname': ('matname', 'matnameID', 'matname'),
+        'agglevel': ('AggLevel', 'AggLevelID', 'AggLevel'),
+        'grossnet': ('GrossNet', 'GrossNetID', 'GrossNet'),
+    }
+
+    # Attributes the availability index has -> its field for them
+    __available_fields = {
+        'dataset': 'Dataset',
+        'version': 'Version',
+        'country': 'Country',
+        'energytype': 'EnergyType',
+        'laststage': 'LastStage',
+    }
 
     def __init__(self, database: str):
         self._db = database
 
     @staticmethod
-    def __load_bidict(model_name: str, id_field: str, name_field: str, database: str) -> bidict:
+    def __load_bidict(model_name: str, database: str) -> bidict:
         """
-        Load translations for a specific model if not already loaded.
+        Get the translations of a model from the database's snapshot.
         
         Args:
-            model_name (str): The name of the model to load translations for.
-            id_field (str): The name of the ID field in the model.
-            name_field (str): The name of the field containing the human-readable name.
+            model_name (str): The name of the model to get translations for.
+            database (str): The database the model's table is in.
         
         Returns:
-            bidict: A bidirectional dictionary of translations for the model.
+            bidict: A bidirectional dictionary of translations (name <-> ID) for the model.
         """
 
-        # check if we have the desired information
-        if (database + ":" + model_name) not in Translator.__translations:
-            Translator.__load_and_cache(model_name, id_field, name_field, database)
-        
-        model_translations = Translator.__translations[database + ":" + model_name]
-        
-        # if the data's cache ttl is expired,
-        # recache and reload
-        if (datetime.today().date() - model_translations[0]) > Translator.__cache_ttl:
-            Translator.__load_and_cache(model_name, id_field, name_field, database)
-            model_translations = Translator.__translations[database + ":" + model_name]
-        
-        # return the bidict of model translations
-        return model_translations[1]
-    
-    @staticmethod
-    def __load_and_cache(model_name: str, id_field: str, name_field: str, database: str):
-        LOGGER.info(f"Loading and caching {database}:{model_name} for {id_field} <-> {name_field}")
-
-        # Get the model class dynamically
-        model = apps.get_model(app_label='Mexer', model_name=model_name)
-
-        # Create a bidict with name:id pairs
-        Translator.__translations[database + ":" + model_name] = (
-            # a datetime to see how long this has been cached
-            datetime.today().date(),
-            # the bidict containing all the data information
-            bidict(
-                {getattr(item, name_field): getattr(item, id_field) for item in model.objects.using(database).all()}
-            )
-        )
+        return get_snapshot(database).tables[model_name]
 
     def _translate(self, model_name, value, id_field, name_field):
         # Translate a value between its ID and name for a specific model.
         # value: The value to translate (can be either an ID or a name).
         # Returns: The translated value (either ID or name, depending on input).
-        translations = self.__load_bidict(model_name, id_field, name_field, self._db)
+        translations = self.__load_bidict(model_name, self._db)
         
         # try to get the translation
         if translation := translations.get(value) or translations.inverse.get(value):
@@ -136,6 +112,38 @@ class Translator:
     def includesNEU_translate(self, value):
         return int(value) if isinstance(value, bool) else int(bool(value))
 
+    def get_id_map(self, attribute):
+        """
+        Get the whole ID -> human readable name translation for an attribute.
+
+        Meant for translating many values at once, e.g. a whole column with
+        Series.map(translator.get_id_map("country")), instead of
+        going through the *_translate methods one value at a time.
+
+        Inputs:
+            attribute (str): The name of the attribute, same names as get_all().
+
+        Outputs:
+            A read-only mapping of IDs to names for the attribute.
+        """
+
+        if attribute not in Translator.__model_mappings:
+            raise ValueError(f"Unknown attribute: {attribute}")
+
+        model_name, id_field, name_field = Translator.__model_mappings[attribute]
+        return self.__load_bidict(model_name, self._db).inverse
+
+    @staticmethod
+    def warm_up(database = "default"):
+        """
+        Load every translation for a database ahead of time (see utils/warmup.py).
+        
+        Inputs:
+            database (str): The database to load translations for.
+        """
+
+        get_snapshot(database)
+
     @staticmethod
     def get_all(attribute, database = "default"):
         """
@@ -154,48 +162,23 @@ class Translator:
         if attribute == "datasets:admin":
             return Translator.__fetch_admin_datasets()
         
-        # Dictionary mapping attribute names to model details
-        model_mappings = {
-            'dataset': ('Dataset', 'DatasetID', 'Dataset'),
-            'version': ('Version', 'VersionID', 'Version'),
-            'country': ('Country', 'CountryID', 'FullName'),
-            'method': ('Method', 'MethodID', 'Method'),
-            'energytype': ('EnergyType', 'EnergyTypeID', 'FullName'),
-            'laststage': ('LastStage', 'ECCStageID', 'ECCStage'),
-            'matname': ('matname', 'matnameID', 'matname'),
-            'agglevel': ('AggLevel', 'AggLevelID', 'AggLevel'),
-            'grossnet': ('GrossNet', 'GrossNetID', 'GrossNet'),
-        }
-        
-        if attribute not in model_mappings:
+        if attribute not in Translator.__model_mappings:
             raise ValueError(f"Unknown attribute: {attribute}")
         
         # Get model details and load translations
-        model_name, id_field, name_field = model_mappings[attribute]
-        translations = Translator.__load_bidict(model_name, id_field, name_field, database)
+        model_name, id_field, name_field = Translator.__model_mappings[attribute]
+        translations = Translator.__load_bidict(model_name, database)
         return list(translations.keys())
     
     @staticmethod
     def __fetch_public_datasets():
-        if (
-            # the list is empty and needs to be filled
-            len(Translator.__public_datasets[1]) == 0
-            # the entry needs to be recached
-            or (datetime.today().date() - Translator.__public_datasets[0]) > Translator.__cache_ttl
-        ):
-            # reload and recache
-            Translator.__public_datasets = (
-                datetime.today().date(),
-                list(Dataset.objects.filter(Public = True).values_list("Dataset", flat = True))
-            )
-
-        return Translator.__public_datasets[1]
+        return get_snapshot("default").public_datasets
     
     @staticmethod
     def __fetch_admin_datasets():
         # get all datasets from both MexerDB and SandboxDB
-        mexerdb_datasets = Translator.__load_bidict("Dataset", 'DatasetID', 'Dataset', "default")
-        sandboxdb_datasets = Translator.__load_bidict("Dataset", 'DatasetID', 'Dataset', "sandbox")
+        mexerdb_datasets = Translator.__load_bidict("Dataset", "default")
+        sandboxdb_datasets = Translator.__load_bidict("Dataset", "sandbox")
 
         # combine them and add the sandbox prefix
         # onto the sandbox datasets to differentitate
@@ -205,35 +188,26 @@ class Translator:
     def get_includesNEUs():
         return [True, False]
 
-    # TODO: This needs to be finished...
     @staticmethod
-    def get_all_available(attribute):
-        """Get all available values for a given attribute from the PSUT model.
+    def get_all_available(attribute, database = "default"):
+        """Get the values of an attribute that have data in the fact tables (PSUT, AggEtaPFU),
+        from the availability index (see utils/availability.py).
         
         Inputs:
-            attribute (str): The name of the attribute to get values for.
+            attribute (str): The name of the attribute to get values for,
+                one of dataset, version, country, energytype or laststage.
+            database (str): The database to look in.
         
         Outputs:
-            A list of distinct values for the attribute from the PSUT model.
+            A list of the values (names) of the attribute that have data,
+            or every value if the database's index hasn't been built yet.
         """
-        # Dictionary mapping attribute names to model details
-        model_mappings = {
-            'dataset': ('Dataset', 'DatasetID', 'Dataset'),
-            'version': ('Version', 'VersionID', 'Version'),
-            'country': ('Country', 'CountryID', 'FullName'),
-            'method': ('Method', 'MethodID', 'Method'),
-            'energytype': ('EnergyType', 'EnergyTypeID', 'FullName'),
-            'laststage': ('LastStage', 'ECCStageID', 'ECCStage'),
-            'matname': ('matname', 'matnameID', 'matname'),
-            'agglevel': ('AggLevel', 'AggLevelID', 'AggLevel'),
-            'grossnet': ('GrossNet', 'GrossNetID', 'GrossNet'),
-        }
-        
-        if attribute not in model_mappings:
+        if attribute not in Translator.__available_fields:
             raise ValueError(f"Unknown attribute: {attribute}")
-        
-        model_name, id_field, name_field = model_mappings[attribute]
-        translations = Translator.__load_bidict(model_name, id_field, name_field)
 
-        # Print distinct values for the attribute from the PSUT model
-        # print(PSUT.objects.order_by().values_list(model_name, flat=True).distinct())
\ No newline at end of file
+        if (index := get_index(database)) is None:
+            return Translator.get_all(attribute, database)
+
+        model_name, id_field, name_field = Translator.__model_mappings[attribute]
+        names = Translator.__load_bidict(model_name, database).inverse
+        return [names[id] for id in sorted(index.ids(Translator.__available_fields[attribute])) if id in names]
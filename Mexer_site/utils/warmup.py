@@ -0,0 +1,30 @@
+####################################################################
+# warmup.py loads all the in memory caches ahead of time
+#
+# The Translator and IndexRegistry load their tables the first time
+# they are used. warm_up() does that up front (when the app starts
+# serving, see Mexer_meta/wsgi.py and asgi.py) so the first user request doesn't have to.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+from utils.logging import LOGGER
+from utils.translator import Translator
+from utils.index_registry import IndexRegistry
+
+# databases holding PSUT data (users only has accounts)
+DATA_DATABASES = ["default", "sandbox"]
+
+def warm_up(databases: list[str] = DATA_DATABASES):
+    '''Load the Translator and IndexRegistry caches for each database'''
+
+    for database in databases:
+        try:
+            Translator.warm_up(database)
+            IndexRegistry(database)
+        except Exception as e:
+            # a cold cache is slower, not broken, so never stop startup over it
+            LOGGER.error(f"Couldn't warm up caches for {database}: {e}")
+
+    LOGGER.info(f"Warmed up caches for {databases}")
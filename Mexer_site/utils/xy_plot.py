@@ -5,6 +5,8 @@
 # together a plotly Figure object, which can then be turned 
 # into HTML or further modified.
 #
+# The data for xy plots is cached (see get_xy_data()).
+#
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
@@ -12,7 +14,42 @@
 import plotly.express as px
 import pandas as pd
 import plotly.graph_objects as go
+from plotly.offline import plot
 from utils.data import get_translated_dataframe, DatabaseTarget
+from utils.cache import XY_CACHE
+from utils.metrics import stage
+
+# Map the names to the actual database field names
+FIELD_MAPPING = {
+    'country': 'Country',
+    'energy_type': 'EnergyType'
+}
+
+def get_xy_data(efficiency_metric: str, target: DatabaseTarget, query: dict,
+                color_by: str, line_by: str, facet_col_by: str = None, facet_row_by: str = None) -> pd.DataFrame:
+    """ Get the data for an xy plot (see get_xy()).
+
+    The data is cached (see utils/cache.py) and doesn't depend on how the plot is
+    colored, lined, or faceted, so restyling a plot doesn't go to the database at all
+
+    Outputs:
+        pd.DataFrame: the translated data, or None if there is no data for the query
+    """
+
+    # Always select 'Year', the efficiency metric, and every field the plot can be styled by
+    # so the same data works for any color_by, line_by, facet_col_by, and facet_row_by
+    fields_to_select = ["Year", efficiency_metric, *FIELD_MAPPING.values()]
+
+    cache_key = XY_CACHE.key(target[0], target[1].__name__, query, columns = fields_to_select)
+    df = XY_CACHE.get(cache_key)
+    if df is None:
+        # get the respective data from the database
+        df = get_translated_dataframe(target, query, fields_to_select)
+        XY_CACHE.set(cache_key, df)
+    
+    if df.empty: return None # if no data, return as such
+
+    return df
 
 def get_xy(efficiency_metric: str, target: DatabaseTarget, query: dict,
            color_by: str, line_by: str, facet_col_by: str = None, facet_row_by: str = None, energy_type: str = None) -> go.Figure:
@@ -31,25 +68,17 @@ def get_xy(efficiency_metric: str, target: DatabaseTarget, query: dict,
         go.Figure: A Plotly figure object containing the generated plot.
     """
 
-    # Create a list of fields to select, always including 'Year' and the efficiency metric
-    fields_to_select = ["Year", efficiency_metric]
+    df = get_xy_data(efficiency_metric, target, query, color_by, line_by, facet_col_by, facet_row_by)
+    if df is None: return None # if no data, return as such
 
-    # Map the names to the actual database field names
-    field_mapping = {
-        'country': 'Country',
-        'energy_type': 'EnergyType'
-    }
-    
-    # Add color_by, line_by, facet_col_by, and facet_row_by fields to the selection list
-    for field in {color_by, line_by, facet_col_by, facet_row_by}:
-        if field in field_mapping:
-            fields_to_select.append(field_mapping[field])
+    return build_xy(df, efficiency_metric, color_by, line_by, facet_col_by, facet_row_by, energy_type)
 
-    # get the respective data from the database
-    df = get_translated_dataframe(target, query, fields_to_select)
-        
-    
-    if df.empty: return None # if no data, return as such
+def build_xy(df: pd.DataFrame, efficiency_metric: str,
+             color_by: str, line_by: str, facet_col_by: str = None, facet_row_by: str = None, energy_type: str = None) -> go.Figure:
+    """ Make the line plot for get_xy() from data gotten with get_xy_data().
+
+    Needs no database, so it can be run in another process (see utils/plot_pool.py)
+    """
 
     # convert year column to datetime if present
     # and sort on that so that the xy plots come out right
@@ -60,10 +89,10 @@ def get_xy(efficiency_metric: str, target: DatabaseTarget, query: dict,
         # Create the line plot using Plotly Express
         fig = px.line(
             df, x="Year", y=efficiency_metric, 
-            color=field_mapping.get(color_by),
-            line_dash=field_mapping.get(line_by),
-            facet_col=field_mapping.get(facet_col_by),
-            facet_row=field_mapping.get(facet_row_by),
+            color=FIELD_MAPPING.get(color_by),
+            line_dash=FIELD_MAPPING.get(line_by),
+            facet_col=FIELD_MAPPING.get(facet_col_by),
+            facet_row=FIELD_MAPPING.get(facet_row_by),
             facet_col_spacing=0.05,
             category_orders={"EnergyType": ["Energy", "Exergy"]},
         )
@@ -121,4 +150,18 @@ def get_xy(efficiency_metric: str, target: DatabaseTarget, query: dict,
     
     except Exception as e:
         # Return a message if plot fails.
-        return go.Figure().add_annotation(text=f"Error creating plot: {str(e)}", showarrow=False)
\ No newline at end of file
+        return go.Figure().add_annotation(text=f"Error creating plot: {str(e)}", showarrow=False)
+
+@stage("figure")
+def render_xy_html(df: pd.DataFrame, efficiency_metric: str, title: str,
+                   color_by: str, line_by: str, facet_col_by: str = None, facet_row_by: str = None, energy_type: str = None) -> str:
+    """ Make the line plot (see build_xy()) and render it as an HTML div with the given title. """
+
+    xy = build_xy(df, efficiency_metric, color_by, line_by, facet_col_by, facet_row_by, energy_type)
+    xy.update_layout(title=title)
+
+    with stage("serialize") as measured:
+        html = plot(xy, output_type="div", include_plotlyjs=False)
+        measured.rows, measured.nbytes = len(df), len(html)
+
+    return html
@@ -0,0 +1,102 @@
+####################################################################
+# xy_summaries.py includes everything for the per dataset summaries of AggEtaPFU
+#
+# Every xy plot query filters the whole AggEtaPFU table down to one dataset
+# and then by country, energy type, etc. So each dataset gets its own
+# materialized view of its rows, sorted and indexed in the order
+# xy plot queries filter them in (see XY_SUMMARY_ORDER).
+#
+# The views are made and refreshed with the refresh_xy_summaries
+# management command. Once a dataset's view exists, xy plot queries for
+# that dataset go to it instead of AggEtaPFU (see _get_database_target()
+# in utils/data.py). The views have exactly the columns of AggEtaPFU,
+# so nothing else about the queries changes.
+#
+# Which views exist is checked with the database and cached
+# for SUMMARY_CHECK_TTL seconds, so new views get picked up on their own.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+from time import monotonic
+from threading import Lock
+from django.db import connections
+from Mexer.models import AggEtaPFUBase
+from utils.logging import LOGGER
+
+SUMMARY_TABLE_PREFIX = "AggEtaPFU_"
+
+# how often to check the database for which summaries exist
+SUMMARY_CHECK_TTL = 5 * 60
+
+# the order xy plot queries filter by,
+# summaries are sorted and indexed by these columns
+XY_SUMMARY_ORDER = [
+    "Country", "EnergyType", "LastStage", "IncludesNEU", "GrossNet",
+    "ProductAggregation", "IndustryAggregation", "ValidFromVersion", "ValidToVersion", "Year",
+]
+
+# database name -> (when it was checked, set of dataset IDs that have a summary)
+__available: dict[str, tuple[float, set[int]]] = {}
+__available_lock = Lock()
+
+# dataset ID -> model of its summary
+__models: dict[int, type] = {}
+
+def summary_table_name(dataset_id: int) -> str:
+    '''Get the name of a dataset's summary (materialized view)'''
+    return f"{SUMMARY_TABLE_PREFIX}{int(dataset_id)}"
+
+def summary_model(dataset_id: int) -> type[AggEtaPFUBase]:
+    '''Get the model of a dataset's summary, made the first time it is asked for
+
+    Each model is only made once, Django doesn't allow registering a model twice
+    '''
+    with __available_lock:
+        if (model := __models.get(dataset_id)) is None:
+            name = summary_table_name(dataset_id)
+            model = type(name, (AggEtaPFUBase,), {
+                "__module__": AggEtaPFUBase.__module__,
+                "Meta": type("Meta", (), {"db_table": name, "managed": False}),
+            })
+            __models[dataset_id] = model
+
+    return model
+
+def available_summaries(database: str) -> set[int]:
+    '''Get the IDs of the datasets that have a summary in a database'''
+    with __available_lock:
+        entry = __available.get(database)
+        if entry is not None and monotonic() - entry[0] < SUMMARY_CHECK_TTL:
+            return entry[1]
+
+    try:
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                "SELECT matviewname FROM pg_matviews WHERE ispopulated AND matviewname LIKE %s",
+                [SUMMARY_TABLE_PREFIX.replace("_", r"\_") + "%"]
+            )
+            names = [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        # no summaries is always safe, queries just go to AggEtaPFU
+        LOGGER.warning(f"Couldn't check for xy summaries in {database}: {e}")
+        names = []
+
+    datasets = {
+        int(suffix) for name in names
+        if (suffix := name.removeprefix(SUMMARY_TABLE_PREFIX)).isdigit()
+    }
+
+    with __available_lock:
+        __available[database] = (monotonic(), datasets)
+
+    return datasets
+
+def forget_available_summaries(database: str = None):
+    '''Make the next available_summaries() check the database again'''
+    with __available_lock:
+        if database is None:
+            __available.clear()
+        else:
+            __available.pop(database, None)